@@ -0,0 +1,99 @@
+"""
+Capture of incoming updates for regression replays (see replay.py).
+
+With CAPTURE_FILE set, every update is appended to that file as one compact
+JSON line, anonymised and stamped with its offset from the start of the
+capture:
+
+    {"capture":1,"started":"2026-10-19T12:00:00","admins":[...]}   session header
+    {"t":12.345,"bot":123456,"u":{...update...}}                    one per update
+
+Anonymisation: user/chat ids and any 7+ digit number in texts and callback
+data are replaced by a keyed hash (the key is random per session and never
+written), names/usernames/phone numbers are blanked, and letters of free
+text are masked while digits, punctuation and a few flow keywords are kept,
+so amounts, dates, order ids and CSV layouts still drive the same handlers.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Any, Iterable
+
+PERSONAL_KEYS = {"first_name", "last_name", "username", "title", "phone_number", "bio", "description"}
+DROPPED_KEYS = {"contact", "location", "venue", "photo", "sticker", "voice", "video", "audio", "thumbnail"}
+TEXT_KEYS = {"text", "caption", "data", "query", "file_name"}
+ID_PARENTS = {"from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat"}
+# Words kept as-is in masked text (bulk CSV headers/actions)
+KEEP_WORDS = {"allow", "deny", "ban", "unban", "user_id", "action", "limit", "balance_delta"}
+
+_LONG_NUMBER = re.compile(r"\d{7,}")
+_WORD = re.compile(r"[^\W\d]+")
+
+
+class UpdateRecorder:
+    def __init__(self, path: str, admin_ids: Iterable[int]):
+        self._key = os.urandom(16)
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self._f = open(path, "a", encoding="utf-8")
+        self._write({
+            "capture": 1,
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "admins": [self.anon_id(a) for a in admin_ids],
+        })
+
+    def anon_id(self, value: int) -> int:
+        """Stable pseudonym (10 digits) for a user/chat id within this session."""
+        h = hashlib.blake2b(str(value).encode(), key=self._key, digest_size=8).digest()
+        return 1_000_000_000 + int.from_bytes(h, "big") % 9_000_000_000
+
+    def record(self, tenant: int, update: dict) -> None:
+        self._write({"t": round(time.monotonic() - self._t0, 3), "bot": tenant, "u": self._scrub(update)})
+
+    def close(self) -> None:
+        with self._lock:
+            self._f.close()
+
+    def _write(self, obj: dict) -> None:
+        line = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if not self._f.closed:
+                self._f.write(line + "\n")
+                self._f.flush()
+
+    def _scrub(self, obj: Any, parent: str = "") -> Any:
+        if isinstance(obj, list):
+            return [self._scrub(v, parent) for v in obj]
+        if not isinstance(obj, dict):
+            return obj
+        out = {}
+        for k, v in obj.items():
+            if k in DROPPED_KEYS:
+                continue
+            if k in PERSONAL_KEYS and isinstance(v, str):
+                out[k] = "x"
+            elif k == "id" and parent in ID_PARENTS and isinstance(v, int):
+                out[k] = self.anon_id(v)
+            elif k in ("file_id", "file_unique_id"):
+                out[k] = "x"
+            elif k in TEXT_KEYS and isinstance(v, str):
+                out[k] = self._scrub_text(v, mask=k != "data")
+            else:
+                out[k] = self._scrub(v, k)
+        return out
+
+    def _scrub_text(self, s: str, mask: bool) -> str:
+        s = _LONG_NUMBER.sub(lambda m: str(self.anon_id(int(m.group()))), s)
+        if not mask:
+            return s
+        command = ""
+        if s.startswith("/"):
+            command, _, s = s.partition(" ")
+            command += " " if s else ""
+        return command + _WORD.sub(lambda m: m.group() if m.group().lower() in KEEP_WORDS else "x" * len(m.group()), s)
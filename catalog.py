@@ -0,0 +1,64 @@
+"""
+In-memory index of the sellable catalog (db `catalog` table) and provider stock.
+Refreshed periodically in the background so the buy menu never waits on the provider.
+"""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+
+@dataclass(frozen=True)
+class CatalogItem:
+    id: int
+    country: str
+    service_code: str
+    title: str
+    price_usd: Optional[float]  # None = default price setting
+
+
+class Catalog:
+    def __init__(self):
+        self.items: Dict[int, CatalogItem] = {}
+        # None = provider does not report availability: every enabled item is offered
+        self.stock: Optional[Dict[Tuple[str, str], int]] = None
+        self.refreshed_at = 0.0
+
+    def load_items(self, rows: List[dict]) -> None:
+        self.items = {
+            int(r["id"]): CatalogItem(
+                id=int(r["id"]),
+                country=r["country"],
+                service_code=r["service_code"],
+                title=r["title"],
+                price_usd=float(r["price_usd"]) if r["price_usd"] is not None else None,
+            )
+            for r in rows
+        }
+
+    def load_stock(self, stock: Optional[Dict[Tuple[str, str], int]]) -> None:
+        self.stock = stock
+        self.refreshed_at = time.monotonic()
+        metrics.set_gauge("catalog_in_stock", len(self.in_stock()))
+
+    def get(self, item_id: int) -> Optional[CatalogItem]:
+        return self.items.get(item_id)
+
+    def available(self, item: CatalogItem) -> bool:
+        if self.stock is None:
+            return True
+        return self.stock.get((item.country, item.service_code), 0) > 0
+
+    def in_stock(self) -> List[CatalogItem]:
+        return [it for it in self.items.values() if self.available(it)]
+
+    def mark_sold_out(self, item: CatalogItem) -> None:
+        """After a failed create_order, hide the item until the next refresh."""
+        if self.stock is not None:
+            self.stock[(item.country, item.service_code)] = 0
+
+    def price(self, item: CatalogItem, default_price: float) -> float:
+        return item.price_usd if item.price_usd is not None else default_price
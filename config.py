@@ -2,6 +2,9 @@ import os
 
 # Telegram
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
+# Several bots in one process: comma-separated tokens (defaults to BOT_TOKEN).
+# Users, orders and settings are kept apart per bot; the first one owns pre-existing data.
+BOT_TOKENS = [t.strip() for t in os.getenv("BOT_TOKENS", BOT_TOKEN).split(",") if t.strip()]
 
 # Admin IDs: comma-separated, example: "123456789,987654321"
 ADMIN_IDS = [
@@ -9,15 +12,86 @@ ADMIN_IDS = [
     if x.strip().isdigit()
 ]
 
-# Railway Postgres
+# Railway Postgres, or sqlite:///path/to/bot.db for a single-node embedded database (see db_sqlite.py)
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
 
 # (Optional) Provider API key - reserved for later integration
 HOTSIM_API_KEY = os.getenv("HOTSIM_API_KEY", "").strip()
 
+# Shared database connection pool (all bots and worker threads of the process)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))  # open connections per database URL
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+
 # Defaults used by db.py/settings
 DEFAULT_PRICE_USD = float(os.getenv("DEFAULT_PRICE_USD", "0.5"))
 DEFAULT_DAILY_LIMIT = int(os.getenv("DEFAULT_DAILY_LIMIT", "5"))
 
 # UI behavior
 SHOW_ADMIN_BUTTON_FOR_ADMINS = os.getenv("SHOW_ADMIN_BUTTON_FOR_ADMINS", "1").strip() == "1"
+
+# Partitioning / archival of transactions and admin_logs
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "2"))
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "21600"))  # seconds
+# Partitions older than this many months are archived (0 = keep everything)
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "0"))
+# Directory for compressed archives; empty = detach old partitions without dumping/dropping them
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive").strip()
+
+# Admin CSV exports (sent as a document)
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", str(49 * 1024 * 1024)))  # Bot API upload limit is 50MB
+
+# /profile N (admin): sample all threads for N seconds
+PROFILE_DEFAULT_SECONDS = int(os.getenv("PROFILE_DEFAULT_SECONDS", "15"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+
+# Admin audit log buffering
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "2"))  # seconds
+AUDIT_MAX_BUFFER = int(os.getenv("AUDIT_MAX_BUFFER", "20000"))
+
+# Stale waiting orders reaper
+ORDER_TTL_MINUTES = int(os.getenv("ORDER_TTL_MINUTES", "20"))  # 0 = disabled
+REAPER_INTERVAL = int(os.getenv("REAPER_INTERVAL", "60"))  # seconds
+REAPER_BATCH = int(os.getenv("REAPER_BATCH", "200"))
+REAPER_CONCURRENCY = int(os.getenv("REAPER_CONCURRENCY", "5"))
+
+# "Refresh all waiting orders" on the orders screen
+ORDERS_REFRESH_MAX = int(os.getenv("ORDERS_REFRESH_MAX", "20"))  # waiting orders per press
+ORDERS_REFRESH_CONCURRENCY = int(os.getenv("ORDERS_REFRESH_CONCURRENCY", "4"))  # status calls in flight per press
+
+# Optional read replica for lag-tolerant reads
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL", "").strip()
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "10"))  # seconds
+
+# Per-process cache of users rows and settings (0 TTL = disabled)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))  # seconds
+
+# Per-user flood control (token bucket)
+FLOOD_CAPACITY = float(os.getenv("FLOOD_CAPACITY", "6"))
+FLOOD_REFILL_PER_SEC = float(os.getenv("FLOOD_REFILL_PER_SEC", "1"))
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS", "50000"))
+
+# Pending prompts (top-up amount, admin actions): idle time before they expire, and a size cap
+CONV_TTL = float(os.getenv("CONV_TTL", "900"))  # seconds, admin flows
+CONV_TOPUP_TTL = float(os.getenv("CONV_TOPUP_TTL", "300"))  # seconds
+CONV_MAX_USERS = int(os.getenv("CONV_MAX_USERS", "20000"))
+
+# Update processing: updates of different users run concurrently, each user's in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+
+# Provider work queue
+PROVIDER_WORKERS = int(os.getenv("PROVIDER_WORKERS", "8"))
+PROVIDER_QUEUE_BUSY_AT = int(os.getenv("PROVIDER_QUEUE_BUSY_AT", "50"))  # queued jobs before new ones are refused
+
+# Catalog / provider availability refresh
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_REFRESH_INTERVAL", "60"))  # seconds
+
+# Provider push callbacks (optional; polling via order_status keeps working)
+PUSH_LISTEN_HOST = os.getenv("PUSH_LISTEN_HOST", "127.0.0.1").strip()
+PUSH_LISTEN_PORT = int(os.getenv("PUSH_LISTEN_PORT", "0"))  # 0 = disabled
+PUSH_SECRET = os.getenv("PUSH_SECRET", "").strip()
+
+# Anonymised capture of incoming updates for replay.py (empty = off)
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "").strip()
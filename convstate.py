@@ -0,0 +1,73 @@
+"""
+In-memory conversation state: the prompt a user's next message answers
+(top-up amount, admin action...), replacing PTB's per-user `user_data` dicts,
+which are never freed.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import metrics
+
+
+class ConversationStore:
+    """
+    One pending flow per key; starting a flow replaces the previous one.
+    Each flow expires `ttls[flow]` (or `default_ttl`) seconds after it was
+    last touched, and an expired flow reads as no flow at all. Memory is
+    bounded: at most `max_keys` entries are kept (LRU), and expired entries
+    are dropped as they reach the old end.
+    """
+
+    def __init__(self, ttls: Dict[str, float], default_ttl: float, max_keys: int = 20000):
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.max_keys = max_keys
+        self._data: "OrderedDict[Hashable, Tuple[float, Dict[str, Any]]]" = OrderedDict()  # key -> (expires, state)
+        self._lock = threading.Lock()
+
+    def start(self, key: Hashable, flow: str, **data: Any) -> None:
+        self._put(key, {"flow": flow, **data})
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        """The live state ({"flow": ..., **data}) or None."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                metrics.incr(f"conversation_expired.{item[1]['flow']}")
+                return None
+            return dict(item[1])
+
+    def update(self, key: Hashable, **data: Any) -> None:
+        """Add data to the live flow and restart its TTL."""
+        state = self.get(key)
+        if state is not None:
+            self._put(key, {**state, **data})
+
+    def end(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            metrics.set_gauge("conversations", len(self._data))
+
+    def _put(self, key: Hashable, state: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (now + self.ttls.get(state["flow"], self.default_ttl), state)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_keys:
+                self._data.popitem(last=False)
+            while self._data:
+                expires, _state = next(iter(self._data.values()))
+                if expires >= now:
+                    break
+                self._data.popitem(last=False)
+            metrics.set_gauge("conversations", len(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -1,24 +1,517 @@
 from __future__ import annotations
 
+import functools
+import gzip
 import json
-from dataclasses import dataclass
-from datetime import date
+import logging
+import os
+import re
+import select
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from datetime import date, datetime, timedelta
 from typing import Any, Dict, List, Optional, Tuple
 
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
 
-from config import DATABASE_URL, DEFAULT_DAILY_LIMIT, DEFAULT_PRICE_USD
+from config import (
+    ARCHIVE_AFTER_MONTHS,
+    ARCHIVE_DIR,
+    AUDIT_BATCH_SIZE,
+    AUDIT_FLUSH_INTERVAL,
+    AUDIT_MAX_BUFFER,
+    BOT_TOKENS,
+    DATABASE_URL,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DEFAULT_DAILY_LIMIT,
+    DEFAULT_PRICE_USD,
+    PARTITION_MONTHS_AHEAD,
+    READ_DATABASE_URL,
+    REPLICA_CHECK_INTERVAL,
+    REPLICA_MAX_LAG_SECONDS,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+)
+import metrics
 
+log = logging.getLogger(__name__)
 
-def _conn():
-    return psycopg2.connect(DATABASE_URL)
+
+# ---------- Tenants ----------
+# One process may host several bots (BOT_TOKENS) on one database. Users, orders,
+# settings and the ledgers carry a `tenant` column holding the bot id; the
+# current tenant is set per update (use_tenant) and, being a ContextVar, follows
+# the work into asyncio.to_thread and provider queue threads.
+def tenant_of(token: str) -> int:
+    """Bot id: the numeric part of a bot token before ':'."""
+    head = token.split(":", 1)[0]
+    return int(head) if head.isdigit() else 0
+
+
+DEFAULT_TENANT = tenant_of(BOT_TOKENS[0]) if BOT_TOKENS else 0
+_tenant: ContextVar[int] = ContextVar("db_tenant", default=DEFAULT_TENANT)
+
+
+def use_tenant(tenant: int) -> None:
+    _tenant.set(tenant)
+
+
+def current_tenant() -> int:
+    return _tenant.get()
+
+
+# ---------- Deadlines ----------
+# A handler may run under a deadline (use_deadline; a ContextVar, so it follows
+# the work into threads). Connections handed out while one is set get
+# statement_timeout/lock_timeout for the time left, for the whole session so
+# they hold across every commit of the function (the pool resets them when the
+# connection comes back), and provider calls cap their HTTP timeout the same way.
+_deadline: ContextVar[Optional[float]] = ContextVar("db_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def use_deadline(seconds: Optional[float]) -> None:
+    """Give the current update `seconds` from now (None = no deadline)."""
+    _deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def time_left() -> Optional[float]:
+    """Seconds until the current deadline (may be negative), or None without one."""
+    d = _deadline.get()
+    return None if d is None else d - time.monotonic()
+
+
+def is_deadline_error(exc: BaseException) -> bool:
+    """A deadline ran out, here or as a cancelled/lock-timed-out statement in Postgres."""
+    return isinstance(exc, (DeadlineExceeded, psycopg2.errors.QueryCanceled, psycopg2.errors.LockNotAvailable))
+
+
+def _apply_deadline(conn) -> None:
+    left = time_left()
+    if left is None:
+        return
+    if left <= 0:
+        conn.close()
+        raise DeadlineExceeded("deadline passed before the query")
+    timeout = f"{max(int(left * 1000), 1)}ms"
+    cur = conn.cursor()
+    cur.execute("SELECT set_config('statement_timeout', %s, false), set_config('lock_timeout', %s, false)",
+                (timeout, timeout))
+    # committed so a rollback of the caller's first transaction cannot undo it
+    conn.commit()
+    cur.close()
+    conn._deadline_set = True
+
+
+# ---------- Connection routing ----------
+# Functions are marked @reads (may be served by READ_DATABASE_URL) or @writes.
+# Once a write happened in the current update (see begin_request), reads go to
+# the primary so the user sees their own changes. The flag is a mutable cell so
+# that writes made through asyncio.to_thread (which runs in a copy of the
+# context) still count for the reads that follow.
+_route: ContextVar[str] = ContextVar("db_route", default="write")
+_wrote: ContextVar[Optional[List[bool]]] = ContextVar("db_wrote", default=None)
+
+_replica_lock = threading.Lock()
+_replica_state = {"checked": 0.0, "ok": False}
+
+
+def begin_request() -> None:
+    """Call at the start of every update to reset read-your-writes tracking."""
+    _wrote.set([False])
+
+
+def _mark_wrote() -> None:
+    flag = _wrote.get()
+    if flag is None:
+        _wrote.set([True])
+    else:
+        flag[0] = True
+
+
+def _has_written() -> bool:
+    flag = _wrote.get()
+    return flag is not None and flag[0]
+
+
+def reads(retry_empty: bool = False):
+    """
+    Mark a lag-tolerant read. With retry_empty, an empty/None result from the
+    replica is retried on the primary (e.g. a row created moments ago).
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not READ_DATABASE_URL or _has_written() or not _replica_ok():
+                return fn(*args, **kwargs)
+            token = _route.set("read")
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                _route.reset(token)
+            if retry_empty and not result:
+                metrics.incr("db_replica_retry_empty")
+                return fn(*args, **kwargs)
+            return result
+        return wrapper
+    return deco
+
+
+def writes(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _route.set("write")
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _route.reset(token)
+            _mark_wrote()
+    return wrapper
+
+
+def _replica_ok() -> bool:
+    """Replica reachable and within REPLICA_MAX_LAG_SECONDS; re-checked every REPLICA_CHECK_INTERVAL."""
+    if time.monotonic() - _replica_state["checked"] < REPLICA_CHECK_INTERVAL:
+        return _replica_state["ok"]
+    with _replica_lock:
+        if time.monotonic() - _replica_state["checked"] < REPLICA_CHECK_INTERVAL:
+            return _replica_state["ok"]
+        try:
+            conn = psycopg2.connect(READ_DATABASE_URL, connect_timeout=3)
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                END
+            """)
+            lag = float(cur.fetchone()[0])
+            cur.close()
+            conn.close()
+            ok = lag <= REPLICA_MAX_LAG_SECONDS
+            metrics.set_gauge("db_replica_lag_seconds", round(lag, 3))
+        except psycopg2.Error as e:
+            log.warning("read replica unavailable: %s", e)
+            ok = False
+        if not ok and _replica_state["ok"]:
+            log.warning("routing reads to the primary (replica lagging or down)")
+        _replica_state.update(checked=time.monotonic(), ok=ok)
+        return ok
+
+
+# ---------- Process-local cache (users / settings) ----------
+class _TTLCache:
+    """Bounded LRU with a per-entry TTL."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_user_cache = _TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_settings_cache = _TTLCache(256, USER_CACHE_TTL)
+
+# Other processes are told about changes through NOTIFY on this channel.
+# Payload: "<instance>:u:<tenant>:<user_id>", "<instance>:u:<tenant>:*" or
+# "<instance>:s:<tenant>:<key>". Cache keys are (tenant, user_id) / (tenant, key).
+_CACHE_CHANNEL = "cache_invalidate"
+_INSTANCE = uuid.uuid4().hex[:12]
+_listener_stop = threading.Event()
+_listener_thread: Optional[threading.Thread] = None
+
+
+def _notify_changed(cur, kind: str, key: Any, tenant: Optional[int] = None) -> None:
+    if USER_CACHE_TTL > 0:
+        tenant = _tenant.get() if tenant is None else tenant
+        cur.execute("SELECT pg_notify(%s, %s)", (_CACHE_CHANNEL, f"{_INSTANCE}:{kind}:{tenant}:{key}"))
+
+
+def _apply_invalidation(payload: str) -> None:
+    instance, _, rest = payload.partition(":")
+    if instance == _INSTANCE:
+        return
+    kind, _, rest = rest.partition(":")
+    tenant, _, key = rest.partition(":")
+    if not tenant.isdigit():
+        return
+    if kind == "s":
+        _settings_cache.invalidate((int(tenant), key))
+    elif key == "*":
+        _user_cache.clear()
+    elif key.isdigit():
+        _user_cache.invalidate((int(tenant), int(key)))
+    metrics.incr("cache_remote_invalidations")
+
+
+def _listen_loop() -> None:
+    while not _listener_stop.is_set():
+        try:
+            conn = psycopg2.connect(DATABASE_URL)
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {_CACHE_CHANNEL}")
+            # anything may have changed while we were not listening
+            _user_cache.clear()
+            _settings_cache.clear()
+            while not _listener_stop.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _apply_invalidation(conn.notifies.pop(0).payload)
+            conn.close()
+        except Exception:
+            log.exception("cache invalidation listener failed; retrying")
+            _user_cache.clear()
+            _settings_cache.clear()
+            _listener_stop.wait(5)
+
+
+def start_cache_listener() -> None:
+    global _listener_thread
+    if USER_CACHE_TTL <= 0 or _listener_thread is not None:
+        return
+    _listener_stop.clear()
+    _listener_thread = threading.Thread(target=_listen_loop, name="cache-listener", daemon=True)
+    _listener_thread.start()
 
 
-def init_db() -> None:
+def stop_cache_listener() -> None:
+    global _listener_thread
+    if _listener_thread is None:
+        return
+    _listener_stop.set()
+    _listener_thread.join()
+    _listener_thread = None
+
+
+# ---------- Connection pool ----------
+class _PooledConnection(psycopg2.extensions.connection):
+    """close() hands the connection back to its pool instead of disconnecting."""
+
+    _pool: Optional["_Pool"] = None
+    _release = None
+    _deadline_set = False  # session timeouts from _apply_deadline, reset by _Pool.put
+
+    def close(self):
+        pool, self._pool = self._pool, None
+        if pool is None:
+            super().close()
+        else:
+            pool.put(self)
+
+
+class _Pool:
+    """
+    Connections to one database shared by every thread and tenant of the
+    process: at most `size` are checked out at once and idle ones are reused.
+    Callers keep the open/close-per-function pattern; close() returns the
+    connection. One that is never closed (e.g. an exception skipped close())
+    frees its slot when it is garbage collected.
+    """
+
+    def __init__(self, dsn: str, size: int, timeout: float, **connect_kwargs):
+        self.dsn = dsn
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        self._idle: List[_PooledConnection] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def get(self) -> _PooledConnection:
+        if not self._slots.acquire(timeout=self.timeout):
+            metrics.incr("db_pool_timeouts")
+            raise psycopg2.OperationalError("database connection pool exhausted")
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(self.dsn, connection_factory=_PooledConnection, **self.connect_kwargs)
+                metrics.incr("db_pool_connects")
+        except BaseException:
+            self._slots.release()
+            raise
+        conn._pool = self
+        conn._release = weakref.finalize(conn, self._slots.release)
+        return conn
+
+    def put(self, conn: _PooledConnection) -> None:
+        try:
+            if conn.closed:
+                return
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn._deadline_set:
+                    cur = conn.cursor()
+                    cur.execute("RESET statement_timeout; RESET lock_timeout")
+                    conn.commit()
+                    cur.close()
+                    conn._deadline_set = False
+            except psycopg2.Error:
+                conn.close()
+                return
+            with self._lock:
+                self._idle.append(conn)
+        finally:
+            conn._release()
+
+    def close_idle(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pools: Dict[str, _Pool] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(dsn: str, **connect_kwargs) -> _Pool:
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                pool = _pools[dsn] = _Pool(dsn, DB_POOL_SIZE, DB_POOL_TIMEOUT, **connect_kwargs)
+    return pool
+
+
+def close_pools() -> None:
+    """Disconnect idle pooled connections (at shutdown)."""
+    for pool in list(_pools.values()):
+        pool.close_idle()
+
+
+def _conn():
+    if _route.get() == "read":
+        try:
+            conn = _pool(READ_DATABASE_URL, connect_timeout=3).get()
+            metrics.incr("db_replica_reads")
+            _apply_deadline(conn)
+            return conn
+        except psycopg2.OperationalError:
+            _replica_state.update(checked=time.monotonic(), ok=False)
+            metrics.incr("db_replica_fallbacks")
+    conn = _pool(DATABASE_URL).get()
+    _apply_deadline(conn)
+    return conn
+
+
+# Bump whenever _apply_schema() changes, so running instances pick up the DDL once.
+SCHEMA_VERSION = 6
+_SCHEMA_LOCK_KEY = 0x5EB07  # pg_advisory_xact_lock key serialising migrations
+
+
+@writes
+def init_db(tenants: Optional[List[int]] = None) -> bool:
+    """
+    Bring the schema up to date and seed default settings for every tenant
+    (default: DEFAULT_TENANT). Reads a single schema_version row; DDL only runs
+    (under an advisory lock) when it is missing or older than SCHEMA_VERSION.
+    Returns True if it migrated.
+    """
     conn = _conn()
     cur = conn.cursor()
 
+    migrated = False
+    if _schema_version(cur) != SCHEMA_VERSION:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (_SCHEMA_LOCK_KEY,))
+        # another instance may have migrated while we waited for the lock
+        if _schema_version(cur) != SCHEMA_VERSION:
+            _apply_schema(cur)
+            cur.execute("""
+                INSERT INTO schema_version(id, version) VALUES(1, %s)
+                ON CONFLICT (id) DO UPDATE SET version=EXCLUDED.version, updated_at=NOW()
+            """, (SCHEMA_VERSION,))
+            migrated = True
+
+    defaults = [("price_usd", str(DEFAULT_PRICE_USD)),
+                ("maintenance", "0"),
+                ("start_message", DEFAULT_START_MESSAGE())]
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO settings(tenant,key,value) VALUES %s ON CONFLICT (tenant, key) DO NOTHING",
+        [(t, k, v) for t in (tenants or [DEFAULT_TENANT]) for k, v in defaults],
+    )
+
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    if migrated:
+        ensure_partitions()
+    return migrated
+
+
+def _schema_version(cur) -> Optional[int]:
+    cur.execute("SAVEPOINT schema_check")
+    try:
+        cur.execute("SELECT version FROM schema_version WHERE id=1")
+    except psycopg2.errors.UndefinedTable:
+        cur.execute("ROLLBACK TO SAVEPOINT schema_check")
+        return None
+    row = cur.fetchone()
+    cur.execute("RELEASE SAVEPOINT schema_check")
+    return int(row[0]) if row else None
+
+
+def _apply_schema(cur) -> None:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version(
+        id INT PRIMARY KEY CHECK (id = 1),
+        version INT NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+    """)
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users(
         user_id BIGINT PRIMARY KEY,
@@ -41,26 +534,11 @@ def init_db() -> None:
     )
     """)
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS admin_logs(
-        id SERIAL PRIMARY KEY,
-        admin_id BIGINT NOT NULL,
-        action TEXT NOT NULL,
-        payload JSONB,
-        created_at TIMESTAMP NOT NULL DEFAULT NOW()
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS transactions(
-        id SERIAL PRIMARY KEY,
-        user_id BIGINT NOT NULL,
-        amount NUMERIC(12,2) NOT NULL,
-        kind TEXT NOT NULL, -- 'topup','deduct','adjust'
-        note TEXT,
-        created_at TIMESTAMP NOT NULL DEFAULT NOW()
-    )
-    """)
+    # Append-only tables: monthly range partitions on created_at
+    for table, columns in PARTITIONED_TABLES.items():
+        _create_partitioned(cur, table, columns)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions(created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_admin_logs_created ON admin_logs(created_at)")
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS topup_requests(
@@ -90,20 +568,228 @@ def init_db() -> None:
         updated_at TIMESTAMP NOT NULL DEFAULT NOW()
     )
     """)
+    # Only waiting orders are indexed, for the stale-order reaper
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_orders_waiting_created
+    ON orders(created_at) WHERE status='waiting'
+    """)
+
+    # Lookups by provider id (push callbacks)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_provider_order_id ON orders(provider_order_id)")
+
+    # Sellable country/service pairs; price_usd NULL = use the price_usd setting
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS catalog(
+        id SERIAL PRIMARY KEY,
+        country TEXT NOT NULL,
+        service_code TEXT NOT NULL,
+        title TEXT NOT NULL,
+        price_usd NUMERIC(12,2),
+        enabled BOOLEAN NOT NULL DEFAULT TRUE,
+        sort_order INT NOT NULL DEFAULT 0,
+        UNIQUE (country, service_code)
+    )
+    """)
+    cur.execute("""
+    INSERT INTO catalog(country, service_code, title) VALUES('UK', 'UK_SERVICE', '🇬🇧 UK')
+    ON CONFLICT (country, service_code) DO NOTHING
+    """)
+
+    # Multi-bot hosting: rows belong to a tenant (bot id); existing rows to the first bot
+    for table in TENANT_TABLES:
+        _add_tenant_column(cur, table)
+    for table, key in (("users", "user_id"), ("settings", "key")):
+        cur.execute("""
+            SELECT 1 FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = %s::regclass AND i.indisprimary AND a.attname = 'tenant'
+        """, (table,))
+        if not cur.fetchone():
+            cur.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_pkey, ADD PRIMARY KEY (tenant, {key})")
+
+    # Admin user directory: keyset paging by user_id within each filter
+    cur.execute("DROP INDEX IF EXISTS idx_users_allowed, idx_users_banned, idx_users_balance, "
+                "idx_users_updated, idx_users_id_text")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_t_allowed ON users(tenant, user_id) WHERE is_allowed")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_t_banned ON users(tenant, user_id) WHERE is_banned")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_t_balance ON users(tenant, balance)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_t_updated ON users(tenant, updated_at)")
+    # ID-prefix search as an ordered range scan on the decimal text
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_users_t_id_text ON users(tenant, ((user_id::text) COLLATE "C"))""")
+
+    # Provider call budget shared by all processes: one token bucket per endpoint
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS provider_budget(
+        endpoint TEXT PRIMARY KEY,
+        refill_per_sec DOUBLE PRECISION NOT NULL,
+        capacity DOUBLE PRECISION NOT NULL,
+        tokens DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+    )
+    """)
+
+
+TENANT_TABLES = ("users", "settings", "transactions", "admin_logs", "topup_requests", "orders")
+
+
+def _add_tenant_column(cur, table: str) -> None:
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'tenant'
+    """, (table,))
+    if cur.fetchone():
+        return
+    # a constant default fills existing rows without a rewrite; it is dropped
+    # again so every INSERT has to name its tenant
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN tenant BIGINT NOT NULL DEFAULT {int(DEFAULT_TENANT)}")
+    cur.execute(f"ALTER TABLE {table} ALTER COLUMN tenant DROP DEFAULT")
+
+
+# ---------- Partitions ----------
+PARTITIONED_TABLES = {
+    "transactions": """
+        id INTEGER NOT NULL DEFAULT nextval('transactions_id_seq'),
+        user_id BIGINT NOT NULL,
+        amount NUMERIC(12,2) NOT NULL,
+        kind TEXT NOT NULL, -- 'topup','deduct','adjust','refund'
+        note TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, created_at)
+    """,
+    "admin_logs": """
+        id INTEGER NOT NULL DEFAULT nextval('admin_logs_id_seq'),
+        admin_id BIGINT NOT NULL,
+        action TEXT NOT NULL,
+        payload JSONB,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, created_at)
+    """,
+}
+
+
+def _month_start(d: date) -> date:
+    return d.replace(day=1)
 
-    _set_default(cur, "price_usd", str(DEFAULT_PRICE_USD))
-    _set_default(cur, "maintenance", "0")
-    _set_default(cur, "start_message", DEFAULT_START_MESSAGE())
 
+def _add_months(d: date, n: int) -> date:
+    m = d.month - 1 + n
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+
+def _create_partitioned(cur, table: str, columns: str) -> None:
+    """
+    Create `table` as a monthly range-partitioned table.
+    A pre-existing plain table is kept as-is and attached as one partition
+    covering everything up to the end of the current month.
+    """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    kind = row[0] if row else None
+    if kind == "p":
+        return
+
+    cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {table}_id_seq")
+    if kind == "r":
+        cur.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+        # The partitioned parent's key is (id, created_at); the old PK on id alone can't stay
+        cur.execute(f"ALTER TABLE {table}_legacy DROP CONSTRAINT IF EXISTS {table}_pkey")
+
+    cur.execute(f"CREATE TABLE {table}({columns}) PARTITION BY RANGE (created_at)")
+    cur.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+
+    if kind == "r":
+        cur.execute(f"SELECT MAX(created_at) FROM {table}_legacy")
+        newest = cur.fetchone()[0]
+        upper = _add_months(_month_start(max(newest.date(), date.today()) if newest else date.today()), 1)
+        cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {table}_legacy FOR VALUES FROM (MINVALUE) TO (%s)",
+                    (upper,))
+
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+
+
+def _range_partitions(cur, table: str) -> List[Tuple[str, Optional[date], date]]:
+    """(name, lower, upper) for every non-default partition; lower is None for MINVALUE."""
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (table,))
+    out = []
+    for name, bound in cur.fetchall():
+        m = re.search(r"FROM \((.+?)\) TO \((.+?)\)", bound or "")
+        if not m:
+            continue  # DEFAULT partition
+        lo, hi = m.group(1), m.group(2)
+        lo_d = None if lo == "MINVALUE" else date.fromisoformat(lo.strip("'")[:10])
+        out.append((name, lo_d, date.fromisoformat(hi.strip("'")[:10])))
+    return out
+
+
+@writes
+def ensure_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """Create monthly partitions from the current month up to `months_ahead` months ahead."""
+    conn = _conn()
+    cur = conn.cursor()
+    created = []
+    start = _month_start(date.today())
+    for table in PARTITIONED_TABLES:
+        existing = _range_partitions(cur, table)
+        for i in range(months_ahead + 1):
+            lo, hi = _add_months(start, i), _add_months(start, i + 1)
+            if any((p_lo is None or p_lo < hi) and lo < p_hi for _, p_lo, p_hi in existing):
+                continue
+            name = f"{table}_p{lo:%Y%m}"
+            cur.execute("SAVEPOINT mkpart")
+            try:
+                cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", (lo, hi))
+                cur.execute("RELEASE SAVEPOINT mkpart")
+                created.append(name)
+            except psycopg2.Error:
+                # e.g. rows for that month already sit in the default partition
+                cur.execute("ROLLBACK TO SAVEPOINT mkpart")
     conn.commit()
     cur.close()
     conn.close()
+    return created
+
+
+@writes
+def archive_partitions(older_than_months: int, directory: Optional[str] = None) -> List[str]:
+    """
+    Detach partitions whose whole range ends before the start of the month
+    `older_than_months` ago. With `directory`, each one is first dumped to
+    <directory>/<partition>.csv.gz and then dropped; without it the detached
+    table is left in place.
+    """
+    cutoff = _add_months(_month_start(date.today()), -older_than_months)
+    conn = _conn()
+    cur = conn.cursor()
+    done = []
+    for table in PARTITIONED_TABLES:
+        for name, _lo, hi in _range_partitions(cur, table):
+            if hi > cutoff:
+                continue
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, f"{name}.csv.gz")
+                with gzip.open(path + ".tmp", "wb") as f:
+                    cur.copy_expert(f"COPY {name} TO STDOUT WITH CSV HEADER", f)
+                os.replace(path + ".tmp", path)
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+            if directory:
+                cur.execute(f"DROP TABLE {name}")
+            conn.commit()
+            done.append(name)
+    cur.close()
+    conn.close()
+    return done
 
 
-def _set_default(cur, key: str, value: str) -> None:
-    cur.execute("SELECT key FROM settings WHERE key=%s", (key,))
-    if not cur.fetchone():
-        cur.execute("INSERT INTO settings(key,value) VALUES(%s,%s)", (key, value))
+def maintain_partitions() -> Dict[str, List[str]]:
+    created = ensure_partitions()
+    archived = []
+    if ARCHIVE_AFTER_MONTHS > 0:
+        archived = archive_partitions(ARCHIVE_AFTER_MONTHS, ARCHIVE_DIR or None)
+    return {"created": created, "archived": archived}
 
 
 def DEFAULT_START_MESSAGE() -> str:
@@ -119,26 +805,40 @@ def DEFAULT_START_MESSAGE() -> str:
 
 # ---------- Settings ----------
 def get_setting(key: str) -> Optional[str]:
+    ckey = (_tenant.get(), key)
+    cached = _settings_cache.get(ckey)
+    if cached is not None:
+        return cached[0]
+    value = _get_setting(key)
+    _settings_cache.put(ckey, (value,))
+    return value
+
+
+@reads()
+def _get_setting(key: str) -> Optional[str]:
     conn = _conn()
     cur = conn.cursor()
-    cur.execute("SELECT value FROM settings WHERE key=%s", (key,))
+    cur.execute("SELECT value FROM settings WHERE tenant=%s AND key=%s", (_tenant.get(), key))
     row = cur.fetchone()
     cur.close()
     conn.close()
     return row[0] if row else None
 
 
+@writes
 def set_setting(key: str, value: str) -> None:
     conn = _conn()
     cur = conn.cursor()
     cur.execute("""
-        INSERT INTO settings(key,value,updated_at)
-        VALUES(%s,%s,NOW())
-        ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=NOW()
-    """, (key, value))
+        INSERT INTO settings(tenant,key,value,updated_at)
+        VALUES(%s,%s,%s,NOW())
+        ON CONFLICT (tenant, key) DO UPDATE SET value=EXCLUDED.value, updated_at=NOW()
+    """, (_tenant.get(), key, value))
+    _notify_changed(cur, "s", key)
     conn.commit()
     cur.close()
     conn.close()
+    _settings_cache.put((_tenant.get(), key), (value,))
 
 
 def get_price_usd() -> float:
@@ -158,8 +858,25 @@ def get_start_message() -> str:
     return v if v else DEFAULT_START_MESSAGE()
 
 
+# ---------- Catalog ----------
+@reads()
+def list_catalog() -> List[Dict]:
+    conn = _conn()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute("""
+        SELECT id, country, service_code, title, price_usd
+        FROM catalog
+        WHERE enabled
+        ORDER BY sort_order, id
+    """)
+    rows = [dict(r) for r in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return rows
+
+
 # ---------- Users ----------
-@dataclass
+@dataclass(frozen=True)
 class User:
     user_id: int
     balance: float
@@ -170,19 +887,16 @@ class User:
     daily_date: date
 
 
-def ensure_user(user_id: int) -> User:
-    conn = _conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+# daily_count is evaluated lazily: a row whose daily_date is not today counts as 0
+_USER_COLUMNS = """
+    user_id, balance, is_allowed, is_banned, daily_limit,
+    CASE WHEN daily_date = CURRENT_DATE THEN daily_count ELSE 0 END AS daily_count,
+    GREATEST(daily_date, CURRENT_DATE) AS daily_date
+"""
 
-    cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        cur.execute("INSERT INTO users(user_id) VALUES(%s)", (user_id,))
-        conn.commit()
-        cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
-        row = cur.fetchone()
 
-    user = User(
+def _row_to_user(row) -> User:
+    return User(
         user_id=int(row["user_id"]),
         balance=float(row["balance"]),
         is_allowed=bool(row["is_allowed"]),
@@ -192,97 +906,224 @@ def ensure_user(user_id: int) -> User:
         daily_date=row["daily_date"],
     )
 
-    cur.close()
-    conn.close()
+
+def _cached_user(tenant: int, user_id: int) -> Optional[User]:
+    """The cached User, with daily_count rolled over as _USER_COLUMNS would if it was cached before today."""
+    user = _user_cache.get((tenant, user_id))
+    today = date.today()
+    if user is not None and user.daily_date < today:
+        user = replace(user, daily_count=0, daily_date=today)
     return user
 
 
-def set_allowed(user_id: int, allowed: bool) -> None:
+def _update_user(sql: str, params: Tuple) -> Optional[User]:
+    """Run a single-user UPDATE ... RETURNING {_USER_COLUMNS} and write the result through to the cache."""
     conn = _conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET is_allowed=%s, updated_at=NOW() WHERE user_id=%s", (allowed, user_id))
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute(sql, params)
+    row = cur.fetchone()
+    user = _row_to_user(row) if row else None
+    if user:
+        _notify_changed(cur, "u", user.user_id)
     conn.commit()
     cur.close()
     conn.close()
+    if user:
+        _user_cache.put((_tenant.get(), user.user_id), user)
+    return user
 
 
-def set_banned(user_id: int, banned: bool) -> None:
+# Not marked @writes: it only writes (and affects read routing) when the row is missing.
+def ensure_user(user_id: int) -> User:
+    tenant = _tenant.get()
+    cached = _cached_user(tenant, user_id)
+    if cached is not None:
+        metrics.incr("user_cache_hits")
+        return cached
+    metrics.incr("user_cache_misses")
+
     conn = _conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET is_banned=%s, updated_at=NOW() WHERE user_id=%s", (banned, user_id))
-    conn.commit()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    cur.execute(f"SELECT {_USER_COLUMNS} FROM users WHERE tenant=%s AND user_id=%s", (tenant, user_id))
+    row = cur.fetchone()
+    if not row:
+        cur.execute("INSERT INTO users(tenant,user_id) VALUES(%s,%s)", (tenant, user_id))
+        conn.commit()
+        _mark_wrote()
+        cur.execute(f"SELECT {_USER_COLUMNS} FROM users WHERE tenant=%s AND user_id=%s", (tenant, user_id))
+        row = cur.fetchone()
+
+    user = _row_to_user(row)
+
     cur.close()
     conn.close()
+    _user_cache.put((tenant, user_id), user)
+    return user
+
+
+@writes
+def set_allowed(user_id: int, allowed: bool) -> None:
+    _update_user(f"UPDATE users SET is_allowed=%s, updated_at=NOW() WHERE tenant=%s AND user_id=%s RETURNING {_USER_COLUMNS}",
+                 (allowed, _tenant.get(), user_id))
 
 
+@writes
+def set_banned(user_id: int, banned: bool) -> None:
+    _update_user(f"UPDATE users SET is_banned=%s, updated_at=NOW() WHERE tenant=%s AND user_id=%s RETURNING {_USER_COLUMNS}",
+                 (banned, _tenant.get(), user_id))
+
+
+@writes
 def set_daily_limit(user_id: int, limit: int) -> None:
+    _update_user(f"UPDATE users SET daily_limit=%s, updated_at=NOW() WHERE tenant=%s AND user_id=%s RETURNING {_USER_COLUMNS}",
+                 (limit, _tenant.get(), user_id))
+
+
+@writes
+def increment_daily(user_id: int) -> None:
+    _update_user(f"""
+        UPDATE users SET
+            daily_count = CASE WHEN daily_date = CURRENT_DATE THEN daily_count + 1 ELSE 1 END,
+            daily_date = CURRENT_DATE,
+            updated_at = NOW()
+        WHERE tenant=%s AND user_id=%s
+        RETURNING {_USER_COLUMNS}
+    """, (_tenant.get(), user_id))
+
+
+@writes
+def normalize_daily_counters() -> int:
+    """Housekeeping: zero out counters left over from previous days (not needed for correctness)."""
     conn = _conn()
     cur = conn.cursor()
-    cur.execute("UPDATE users SET daily_limit=%s, updated_at=NOW() WHERE user_id=%s", (limit, user_id))
+    cur.execute("""
+        UPDATE users SET daily_count=0, daily_date=CURRENT_DATE
+        WHERE daily_date < CURRENT_DATE
+    """)
+    n = cur.rowcount
     conn.commit()
     cur.close()
     conn.close()
+    return n
+
+
+# ---------- User directory (admin) ----------
+_ID_TEXT = '(user_id::text) COLLATE "C"'
+
+
+@reads()
+def search_users(
+    allowed: Optional[bool] = None,
+    banned: Optional[bool] = None,
+    min_balance: Optional[float] = None,
+    max_balance: Optional[float] = None,
+    active_days: Optional[int] = None,
+    id_prefix: Optional[str] = None,
+    after: Optional[int] = None,
+    limit: int = 20,
+) -> List[Dict]:
+    """
+    Keyset-paged user listing. Pass the last user_id of a page as `after`
+    to get the next one. With id_prefix, users are ordered by their decimal
+    ID text so the prefix range index can be walked in order.
+    """
+    where, params = ["tenant = %s"], [_tenant.get()]
+    if allowed is not None:
+        where.append("is_allowed" if allowed else "NOT is_allowed")
+    if banned is not None:
+        where.append("is_banned" if banned else "NOT is_banned")
+    if min_balance is not None:
+        where.append("balance >= %s")
+        params.append(min_balance)
+    if max_balance is not None:
+        where.append("balance <= %s")
+        params.append(max_balance)
+    if active_days is not None:
+        where.append("updated_at >= NOW() - make_interval(days => %s)")
+        params.append(active_days)
+
+    if id_prefix:
+        # digits sort before ':' so [prefix, prefix':') is exactly "starts with prefix"
+        where += [f"{_ID_TEXT} >= %s", f"{_ID_TEXT} < %s"]
+        params += [id_prefix, id_prefix + ":"]
+        if after is not None:
+            where.append(f"{_ID_TEXT} > %s")
+            params.append(str(after))
+        order = _ID_TEXT
+    else:
+        if after is not None:
+            where.append("user_id > %s")
+            params.append(after)
+        order = "user_id"
 
+    sql = "SELECT user_id, balance, is_allowed, is_banned, updated_at FROM users"
+    sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order} LIMIT %s"
+    params.append(limit)
 
-def reset_daily_if_needed(user_id: int) -> None:
     conn = _conn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT daily_date FROM users WHERE user_id=%s", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        cur.close(); conn.close()
-        return
-    if row["daily_date"] != date.today():
-        cur.execute("""
-            UPDATE users SET daily_date=CURRENT_DATE, daily_count=0, updated_at=NOW()
-            WHERE user_id=%s
-        """, (user_id,))
-        conn.commit()
-    cur.close()
-    conn.close()
-
-
-def increment_daily(user_id: int) -> None:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET daily_count=daily_count+1, updated_at=NOW() WHERE user_id=%s", (user_id,))
-    conn.commit()
+    cur.execute(sql, params)
+    rows = [dict(r) for r in cur.fetchall()]
     cur.close()
     conn.close()
+    return rows
 
 
 # ---------- Balance / Transactions ----------
+@writes
 def add_balance(user_id: int, amount: float, kind: str, note: str | None = None) -> None:
     conn = _conn()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO users(user_id,balance)
-        VALUES(%s,%s)
-        ON CONFLICT (user_id) DO UPDATE SET balance = users.balance + EXCLUDED.balance, updated_at=NOW()
-    """, (user_id, amount))
-    cur.execute("INSERT INTO transactions(user_id,amount,kind,note) VALUES(%s,%s,%s,%s)",
-                (user_id, amount, kind, note))
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    tenant = _tenant.get()
+    cur.execute(f"""
+        INSERT INTO users(tenant,user_id,balance)
+        VALUES(%s,%s,%s)
+        ON CONFLICT (tenant, user_id) DO UPDATE SET balance = users.balance + EXCLUDED.balance, updated_at=NOW()
+        RETURNING {_USER_COLUMNS}
+    """, (tenant, user_id, amount))
+    user = _row_to_user(cur.fetchone())
+    cur.execute("INSERT INTO transactions(tenant,user_id,amount,kind,note) VALUES(%s,%s,%s,%s,%s)",
+                (tenant, user_id, amount, kind, note))
+    _notify_changed(cur, "u", user_id)
     conn.commit()
     cur.close()
     conn.close()
+    _user_cache.put((tenant, user_id), user)
 
 
-def deduct_balance(user_id: int, amount: float, kind: str, note: str | None = None) -> None:
+@writes
+def deduct_balance(user_id: int, amount: float, kind: str, note: str | None = None) -> bool:
+    """Charge amount only if the current balance covers it; returns whether it was charged."""
     conn = _conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET balance=balance-%s, updated_at=NOW() WHERE user_id=%s", (amount, user_id))
-    cur.execute("INSERT INTO transactions(user_id,amount,kind,note) VALUES(%s,%s,%s,%s)",
-                (user_id, -abs(amount), kind, note))
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    tenant = _tenant.get()
+    cur.execute(f"""
+        UPDATE users SET balance=balance-%s, updated_at=NOW()
+        WHERE tenant=%s AND user_id=%s AND balance >= %s
+        RETURNING {_USER_COLUMNS}
+    """, (amount, tenant, user_id, amount))
+    row = cur.fetchone()
+    if row:
+        cur.execute("INSERT INTO transactions(tenant,user_id,amount,kind,note) VALUES(%s,%s,%s,%s,%s)",
+                    (tenant, user_id, -abs(amount), kind, note))
+        _notify_changed(cur, "u", user_id)
     conn.commit()
     cur.close()
     conn.close()
+    if row:
+        _user_cache.put((tenant, user_id), _row_to_user(row))
+    return row is not None
 
 
 # ---------- Topup Requests ----------
+@writes
 def create_topup_request(user_id: int, amount: float) -> int:
     conn = _conn()
     cur = conn.cursor()
-    cur.execute("INSERT INTO topup_requests(user_id,amount) VALUES(%s,%s) RETURNING id", (user_id, amount))
+    cur.execute("INSERT INTO topup_requests(tenant,user_id,amount) VALUES(%s,%s,%s) RETURNING id",
+                (_tenant.get(), user_id, amount))
     req_id = cur.fetchone()[0]
     conn.commit()
     cur.close()
@@ -290,26 +1131,28 @@ def create_topup_request(user_id: int, amount: float) -> int:
     return int(req_id)
 
 
+@reads()
 def list_pending_topups(limit: int = 20) -> List[Tuple]:
     conn = _conn()
     cur = conn.cursor()
     cur.execute("""
         SELECT id, user_id, amount, created_at
         FROM topup_requests
-        WHERE status='pending'
+        WHERE tenant=%s AND status='pending'
         ORDER BY id ASC
         LIMIT %s
-    """, (limit,))
+    """, (_tenant.get(), limit))
     rows = cur.fetchall()
     cur.close()
     conn.close()
     return rows
 
 
+@writes
 def decide_topup(req_id: int, admin_id: int, approve: bool) -> Optional[Tuple[int, float]]:
     conn = _conn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT * FROM topup_requests WHERE id=%s AND status='pending'", (req_id,))
+    cur.execute("SELECT * FROM topup_requests WHERE id=%s AND tenant=%s AND status='pending'", (req_id, _tenant.get()))
     row = cur.fetchone()
     if not row:
         cur.close(); conn.close()
@@ -329,32 +1172,230 @@ def decide_topup(req_id: int, admin_id: int, approve: bool) -> Optional[Tuple[in
     return (user_id, amount)
 
 
+# ---------- Bulk user administration ----------
+@writes
+def bulk_apply_users(rows: List[Tuple[int, Optional[str], Optional[int], Optional[float]]],
+                     admin_id: int) -> Dict[str, Any]:
+    """
+    Apply many user changes in a single transaction.
+    rows: (user_id, action, daily_limit, balance_delta); action is one of
+    allow/deny/ban/unban or None. Rows for the same user are merged in order.
+    A delta that would take a balance below zero or past NUMERIC(12,2) is not
+    applied; those user ids are returned in "rejected".
+    """
+    merged: Dict[int, List[Any]] = {}
+    for uid, action, limit, delta in rows:
+        m = merged.setdefault(uid, [uid, None, None, None, None])
+        if action == "allow":
+            m[1] = True
+        elif action == "deny":
+            m[1] = False
+        elif action == "ban":
+            m[2] = True
+        elif action == "unban":
+            m[2] = False
+        if limit is not None:
+            m[3] = limit
+        if delta:
+            m[4] = round((m[4] or 0) + delta, 2)
+
+    if not merged:
+        return {"users": 0, "created": 0, "balance_rows": 0, "rejected": []}
+
+    tenant = _tenant.get()
+    conn = _conn()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            CREATE TEMP TABLE bulk_users(
+                user_id BIGINT PRIMARY KEY,
+                is_allowed BOOLEAN,
+                is_banned BOOLEAN,
+                daily_limit INT,
+                balance_delta NUMERIC(12,2)
+            ) ON COMMIT DROP
+        """)
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO bulk_users(user_id,is_allowed,is_banned,daily_limit,balance_delta) VALUES %s",
+            list(merged.values()),
+            page_size=1000,
+        )
+
+        cur.execute("""
+            INSERT INTO users(tenant,user_id)
+            SELECT %s, user_id FROM bulk_users
+            ON CONFLICT (tenant, user_id) DO NOTHING
+        """, (tenant,))
+        created = cur.rowcount
+
+        # lock the rows whose balance changes, then drop deltas that would leave it out of range
+        cur.execute("""
+            UPDATE bulk_users b SET balance_delta = NULL
+            FROM (
+                SELECT user_id, balance FROM users
+                WHERE tenant = %s
+                  AND user_id IN (SELECT user_id FROM bulk_users WHERE balance_delta IS NOT NULL)
+                FOR UPDATE
+            ) u
+            WHERE b.user_id = u.user_id
+              AND (u.balance + b.balance_delta < 0 OR u.balance + b.balance_delta >= 10000000000)
+            RETURNING b.user_id
+        """, (tenant,))
+        rejected = sorted(r[0] for r in cur.fetchall())
+
+        cur.execute("""
+            UPDATE users u SET
+                is_allowed = COALESCE(b.is_allowed, u.is_allowed),
+                is_banned = COALESCE(b.is_banned, u.is_banned),
+                daily_limit = COALESCE(b.daily_limit, u.daily_limit),
+                balance = u.balance + COALESCE(b.balance_delta, 0),
+                updated_at = NOW()
+            FROM bulk_users b
+            WHERE u.tenant = %s AND u.user_id = b.user_id
+        """, (tenant,))
+        updated = cur.rowcount
+
+        cur.execute("""
+            INSERT INTO transactions(tenant,user_id,amount,kind,note)
+            SELECT %s, user_id, balance_delta, 'adjust', %s
+            FROM bulk_users
+            WHERE balance_delta IS NOT NULL AND balance_delta <> 0
+        """, (tenant, f"Admin bulk by {admin_id}"))
+        balance_rows = cur.rowcount
+
+        summary = {"users": updated, "created": created, "balance_rows": balance_rows, "rejected": rejected}
+        cur.execute("INSERT INTO admin_logs(tenant,admin_id,action,payload) VALUES(%s,%s,%s,%s)",
+                    (tenant, admin_id, "bulk_users", json.dumps(summary)))
+        _notify_changed(cur, "u", "*")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    for uid in merged:
+        _user_cache.invalidate((tenant, uid))
+    return summary
+
+
 # ---------- Admin Logs ----------
-def admin_log(admin_id: int, action: str, payload: Dict[str, Any] | None = None) -> None:
+class AuditWriter:
+    """
+    In-memory buffer for admin_logs rows, written with one multi-row INSERT
+    per batch by a background thread (when AUDIT_BATCH_SIZE rows are queued or
+    every AUDIT_FLUSH_INTERVAL seconds). Until start() is called rows are
+    written immediately.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_buffer: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buf: List[Tuple] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def append(self, admin_id: int, action: str, payload: Dict[str, Any] | None) -> None:
+        row = (_tenant.get(), admin_id, action, json.dumps(payload or {}), datetime.now())
+        with self._lock:
+            self._buf.append(row)
+            if len(self._buf) > self.max_buffer:
+                dropped = len(self._buf) - self.max_buffer
+                del self._buf[:dropped]
+                log.warning("audit buffer full, dropped %d oldest rows", dropped)
+            pending = len(self._buf)
+
+        if self._thread is None:
+            self.flush()
+        elif pending >= self.batch_size:
+            self._wake.set()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buf = self._buf, []
+            if not rows:
+                return 0
+            try:
+                _write_audit_rows(rows)
+            except Exception:
+                # keep the rows for the next attempt, ahead of anything queued meanwhile
+                with self._lock:
+                    self._buf[:0] = rows
+                raise
+            return len(rows)
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception("audit flush failed")
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread and write whatever is still buffered."""
+        if self._thread is not None:
+            self._stopping.set()
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+def _write_audit_rows(rows: List[Tuple]) -> None:
     conn = _conn()
     cur = conn.cursor()
-    cur.execute("INSERT INTO admin_logs(admin_id,action,payload) VALUES(%s,%s,%s)",
-                (admin_id, action, json.dumps(payload or {})))
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO admin_logs(tenant,admin_id,action,payload,created_at) VALUES %s",
+        rows,
+        page_size=1000,
+    )
     conn.commit()
     cur.close()
     conn.close()
 
 
+audit_writer = AuditWriter(AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_MAX_BUFFER)
+
+
+def admin_log(admin_id: int, action: str, payload: Dict[str, Any] | None = None) -> None:
+    audit_writer.append(admin_id, action, payload)
+
+
 # ---------- Stats ----------
+@reads()
 def stats_today() -> Dict[str, Any]:
     conn = _conn()
     cur = conn.cursor()
 
-    cur.execute("SELECT COUNT(*) FROM transactions WHERE created_at::date = CURRENT_DATE")
-    tx_count = int(cur.fetchone()[0])
-
-    cur.execute("SELECT COALESCE(SUM(amount),0) FROM transactions WHERE created_at::date = CURRENT_DATE")
-    sum_amount = float(cur.fetchone()[0])
+    # Range predicate (not created_at::date) so only today's partition is scanned
+    tenant = _tenant.get()
+    cur.execute("""
+        SELECT COUNT(*), COALESCE(SUM(amount),0) FROM transactions
+        WHERE tenant=%s AND created_at >= CURRENT_DATE AND created_at < CURRENT_DATE + 1
+    """, (tenant,))
+    tx_count, sum_amount = cur.fetchone()
+    tx_count, sum_amount = int(tx_count), float(sum_amount)
 
-    cur.execute("SELECT COUNT(*) FROM users")
+    cur.execute("SELECT COUNT(*) FROM users WHERE tenant=%s", (tenant,))
     users_count = int(cur.fetchone()[0])
 
-    cur.execute("SELECT COUNT(*) FROM users WHERE updated_at::date = CURRENT_DATE")
+    cur.execute("SELECT COUNT(*) FROM users WHERE tenant=%s AND updated_at >= CURRENT_DATE", (tenant,))
     active_today = int(cur.fetchone()[0])
 
     cur.close()
@@ -367,18 +1408,106 @@ def stats_today() -> Dict[str, Any]:
     }
 
 
+# ---------- CSV export ----------
+EXPORTS = {
+    "transactions": "SELECT id, user_id, amount, kind, note, created_at FROM transactions",
+    "orders": """SELECT id, user_id, country, service_code, sell_price, provider_order_id,
+                        phone_number, status, sms_code, created_at, updated_at FROM orders""",
+    "topups": "SELECT id, user_id, amount, status, admin_id, created_at, decided_at FROM topup_requests",
+}
+
+
+@reads()
+def export_csv(kind: str, start: date, end: date, out) -> None:
+    """
+    Stream rows of EXPORTS[kind] created between start and end (inclusive) as
+    CSV into the binary file object `out` via COPY TO STDOUT.
+    """
+    conn = _conn()
+    cur = conn.cursor()
+    query = cur.mogrify(
+        f"{EXPORTS[kind]} WHERE tenant = %s AND created_at >= %s AND created_at < %s ORDER BY created_at, id",
+        (_tenant.get(), start, end + timedelta(days=1)),
+    ).decode()
+    cur.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", out)
+    cur.close()
+    conn.close()
+
+
 # ---------- User listing (for broadcast) ----------
+@reads()
 def list_user_ids_nonbanned() -> List[int]:
     conn = _conn()
     cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users WHERE is_banned=FALSE")
+    cur.execute("SELECT user_id FROM users WHERE tenant=%s AND is_banned=FALSE", (_tenant.get(),))
     ids = [int(r[0]) for r in cur.fetchall()]
     cur.close()
     conn.close()
     return ids
 
 
+# ---------- Provider call budget ----------
+# Level of a bucket right now: stored tokens plus the refill since updated_at, capped
+_BUDGET_LEVEL = "LEAST(capacity, tokens + refill_per_sec * EXTRACT(EPOCH FROM clock_timestamp() - updated_at)::float8)"
+
+
+def configure_provider_budget(limits: Dict[str, Tuple[float, float]]) -> None:
+    """Make provider_budget match `limits` ({endpoint: (calls_per_sec, burst)})."""
+    conn = _conn()
+    cur = conn.cursor()
+    if limits:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO provider_budget(endpoint, refill_per_sec, capacity, tokens) VALUES %s
+            ON CONFLICT (endpoint) DO UPDATE SET
+                refill_per_sec = EXCLUDED.refill_per_sec,
+                capacity = EXCLUDED.capacity,
+                tokens = LEAST(provider_budget.tokens, EXCLUDED.capacity)
+        """, [(name, rate, burst, burst) for name, (rate, burst) in limits.items()])
+    cur.execute("DELETE FROM provider_budget WHERE NOT (endpoint = ANY(%s))", (list(limits),))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+# Not @writes: runs in provider worker threads for every call and must not
+# push the caller's later reads to the primary.
+def take_provider_token(endpoint: str, reserve: float = 0.0) -> float:
+    """
+    Take one call from the endpoint's bucket and from the shared '*' bucket.
+    `reserve` is the share of the '*' capacity this call has to leave
+    untouched (low-priority calls). Returns 0 when the call may go ahead,
+    otherwise the seconds until it could; nothing is taken in that case.
+    Endpoints without a bucket are unlimited.
+    """
+    conn = _conn()
+    cur = conn.cursor()
+    # ORDER BY: every process locks the rows in the same order
+    cur.execute(f"""
+        SELECT endpoint, capacity, refill_per_sec, {_BUDGET_LEVEL}
+        FROM provider_budget
+        WHERE endpoint IN (%s, '*')
+        ORDER BY endpoint
+        FOR UPDATE
+    """, (endpoint,))
+    wait = 0.0
+    rows = cur.fetchall()
+    for name, capacity, rate, level in rows:
+        need = 1 + (reserve * capacity if name == "*" else 0)
+        if level < need:
+            wait = max(wait, (need - level) / rate if rate > 0 else 60.0)
+    if rows and wait == 0:
+        cur.execute(f"""
+            UPDATE provider_budget SET tokens = {_BUDGET_LEVEL} - 1, updated_at = clock_timestamp()
+            WHERE endpoint IN (%s, '*')
+        """, (endpoint,))
+    conn.commit()
+    cur.close()
+    conn.close()
+    return wait
+
+
 # ---------- Orders (Provider integration helpers) ----------
+@writes
 def create_order_row(
     user_id: int,
     country: str,
@@ -391,10 +1520,10 @@ def create_order_row(
     conn = _conn()
     cur = conn.cursor()
     cur.execute("""
-        INSERT INTO orders(user_id, country, service_code, sell_price, provider_order_id, phone_number, status)
-        VALUES(%s,%s,%s,%s,%s,%s,%s)
+        INSERT INTO orders(tenant, user_id, country, service_code, sell_price, provider_order_id, phone_number, status)
+        VALUES(%s,%s,%s,%s,%s,%s,%s,%s)
         RETURNING id
-    """, (user_id, country, service_code, sell_price, provider_order_id, phone_number, status))
+    """, (_tenant.get(), user_id, country, service_code, sell_price, provider_order_id, phone_number, status))
     oid = int(cur.fetchone()[0])
     conn.commit()
     cur.close()
@@ -402,59 +1531,196 @@ def create_order_row(
     return oid
 
 
+@reads(retry_empty=True)
 def get_order(order_id: int, user_id: Optional[int] = None) -> Optional[Dict]:
     conn = _conn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     if user_id is None:
-        cur.execute("SELECT * FROM orders WHERE id=%s", (order_id,))
+        cur.execute("SELECT * FROM orders WHERE id=%s AND tenant=%s", (order_id, _tenant.get()))
     else:
-        cur.execute("SELECT * FROM orders WHERE id=%s AND user_id=%s", (order_id, user_id))
+        cur.execute("SELECT * FROM orders WHERE id=%s AND tenant=%s AND user_id=%s", (order_id, _tenant.get(), user_id))
     row = cur.fetchone()
     cur.close()
     conn.close()
     return dict(row) if row else None
 
 
-def list_orders_for_user(user_id: int, limit: int = 10) -> List[Dict]:
+# Not @reads: push callbacks can arrive right after the order INSERT, so always use the primary.
+# Provider ids are global (one provider account for all tenants); the row carries its tenant.
+def get_order_by_provider_id(provider_order_id: str) -> Optional[Dict]:
+    conn = _conn()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute("SELECT * FROM orders WHERE provider_order_id=%s ORDER BY id DESC LIMIT 1", (provider_order_id,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    return dict(row) if row else None
+
+
+@reads()
+def list_orders_for_user(user_id: int, limit: int = 10, status: Optional[str] = None) -> List[Dict]:
     conn = _conn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     cur.execute("""
         SELECT * FROM orders
-        WHERE user_id=%s
+        WHERE tenant=%s AND user_id=%s AND (%s::text IS NULL OR status=%s)
         ORDER BY id DESC
         LIMIT %s
-    """, (user_id, limit))
+    """, (_tenant.get(), user_id, status, status, limit))
     rows = [dict(r) for r in cur.fetchall()]
     cur.close()
     conn.close()
     return rows
 
 
-def set_order_status(order_id: int, status: str) -> None:
+# Status changes only apply to orders still 'waiting' and return whether they did:
+# a late refresh/push/cancel must not revive a received, cancelled or refunded
+# order (a revived refunded order would be reaped and refunded again).
+@writes
+def set_order_status(order_id: int, status: str) -> bool:
     conn = _conn()
     cur = conn.cursor()
-    cur.execute("UPDATE orders SET status=%s, updated_at=NOW() WHERE id=%s", (status, order_id))
+    cur.execute("UPDATE orders SET status=%s, updated_at=NOW() WHERE id=%s AND status='waiting'", (status, order_id))
+    changed = cur.rowcount == 1
     conn.commit()
     cur.close()
     conn.close()
+    return changed
 
 
-def set_order_sms(order_id: int, sms_code: str) -> None:
+@writes
+def set_order_sms(order_id: int, sms_code: str) -> bool:
     conn = _conn()
     cur = conn.cursor()
     cur.execute("""
         UPDATE orders SET sms_code=%s, status='received', updated_at=NOW()
-        WHERE id=%s
+        WHERE id=%s AND status='waiting'
     """, (sms_code, order_id))
+    changed = cur.rowcount == 1
+    conn.commit()
+    cur.close()
+    conn.close()
+    return changed
+
+
+@writes
+def set_orders_sms(codes: List[Tuple[int, str]]) -> int:
+    """
+    Record SMS codes for several orders with one UPDATE ([(order_id, sms_code)]).
+    Only orders still 'waiting' are changed, so a code cannot revive an order
+    that was cancelled or refunded meanwhile. Returns the number of rows changed.
+    """
+    if not codes:
+        return 0
+    conn = _conn()
+    cur = conn.cursor()
+    psycopg2.extras.execute_values(cur, """
+        UPDATE orders o SET sms_code = c.sms_code, status='received', updated_at=NOW()
+        FROM (VALUES %s) AS c(id, sms_code)
+        WHERE o.id = c.id AND o.status='waiting'
+    """, codes, template="(%s::int, %s::text)", page_size=len(codes))
+    n = cur.rowcount
     conn.commit()
     cur.close()
     conn.close()
+    return n
 
 
-def set_order_cancelled(order_id: int) -> None:
+@writes
+def set_order_cancelled(order_id: int) -> bool:
     conn = _conn()
     cur = conn.cursor()
-    cur.execute("UPDATE orders SET status='cancelled', updated_at=NOW() WHERE id=%s", (order_id,))
+    cur.execute("UPDATE orders SET status='cancelled', updated_at=NOW() WHERE id=%s AND status='waiting'", (order_id,))
+    changed = cur.rowcount == 1
     conn.commit()
     cur.close()
     conn.close()
+    return changed
+
+
+@reads()
+def list_stale_waiting_orders(ttl_minutes: int, limit: int = 200) -> List[Dict]:
+    conn = _conn()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute("""
+        SELECT id, tenant, user_id, provider_order_id, sell_price
+        FROM orders
+        WHERE status='waiting' AND created_at < NOW() - make_interval(mins => %s)
+        ORDER BY created_at ASC
+        LIMIT %s
+    """, (ttl_minutes, limit))
+    rows = [dict(r) for r in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return rows
+
+
+@writes
+def close_waiting_orders(cancelled_ids: List[int], refund_ids: List[int], note: str = "Order expired") -> Dict[str, int]:
+    """
+    Close waiting orders in one transaction: `cancelled_ids` become 'cancelled',
+    `refund_ids` become 'refunded' and their sell_price goes back to the user
+    through the transactions ledger. Orders that left 'waiting' meanwhile are skipped.
+    Works across tenants: each refund follows the tenant stored on its order.
+    """
+    conn = _conn()
+    cur = conn.cursor()
+    try:
+        cancelled = 0
+        if cancelled_ids:
+            cur.execute("""
+                UPDATE orders SET status='cancelled', updated_at=NOW()
+                WHERE id = ANY(%s) AND status='waiting'
+            """, (cancelled_ids,))
+            cancelled = cur.rowcount
+
+        refunded = []
+        if refund_ids:
+            cur.execute("""
+                UPDATE orders SET status='refunded', updated_at=NOW()
+                WHERE id = ANY(%s) AND status='waiting'
+                RETURNING id, tenant, user_id, sell_price
+            """, (refund_ids,))
+            refunded = cur.fetchall()
+
+        if refunded:
+            psycopg2.extras.execute_values(cur, """
+                UPDATE users u SET balance = u.balance + r.amount, updated_at=NOW()
+                FROM (VALUES %s) AS r(tenant, user_id, amount)
+                WHERE u.tenant = r.tenant AND u.user_id = r.user_id
+            """, _sum_by_user(((t, uid), amt) for _, t, uid, amt in refunded),
+                template="(%s::bigint, %s::bigint, %s::numeric)")
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO transactions(tenant,user_id,amount,kind,note) VALUES %s",
+                [(t, uid, amt, "refund", f"{note} #{oid}") for oid, t, uid, amt in refunded],
+            )
+            for t, uid in {(t, uid) for _, t, uid, _ in refunded}:
+                _notify_changed(cur, "u", uid, tenant=t)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    for _, t, uid, _ in refunded:
+        _user_cache.invalidate((t, uid))
+    return {"cancelled": cancelled, "refunded": len(refunded)}
+
+
+def _sum_by_user(pairs) -> List[Tuple[int, int, Any]]:
+    """((tenant, user_id), amount) pairs -> [(tenant, user_id, total)]."""
+    totals: Dict[Tuple[int, int], Any] = {}
+    for key, amt in pairs:
+        totals[key] = totals.get(key, 0) + amt
+    return [(t, uid, total) for (t, uid), total in totals.items()]
+
+
+# ---------- Embedded backend ----------
+# DATABASE_URL=sqlite:///path swaps the storage functions above for db_sqlite's;
+# tenants, deadlines, caches and everything built on those functions stay as they are.
+if DATABASE_URL.startswith("sqlite:"):
+    import db_sqlite
+
+    globals().update({name: getattr(db_sqlite, name) for name in db_sqlite.__all__})
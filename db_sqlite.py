@@ -0,0 +1,885 @@
+"""
+Embedded SQLite storage for single-node deployments and tests
+(DATABASE_URL=sqlite:///path/to/bot.db).
+
+db.py swaps these in for its Postgres functions of the same names when the
+URL is a sqlite one; tenants, deadlines, the user/settings caches and the
+settings helpers stay in db.py and are shared. Import db, not this module.
+
+The file runs in WAL mode: readers (one connection per thread) never block
+the writer or each other, and every write goes through one writer connection
+under a lock, in a BEGIN IMMEDIATE transaction. sqlite3 keeps the prepared
+statements of each connection (cached_statements), so the constant SQL below
+is parsed once per connection.
+
+Differences from Postgres that callers cannot see: money is stored in integer
+cents and returned as Decimal, timestamps are ISO text in local time and
+returned as datetime, booleans are 0/1 and returned as bool. There are no
+partitions (archival moves or dumps whole months instead) and no
+cross-process cache invalidation, so run one bot process per file.
+"""
+from __future__ import annotations
+
+import csv
+import gzip
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import db
+import metrics
+from config import DATABASE_URL, DEFAULT_DAILY_LIMIT, DEFAULT_PRICE_USD
+
+__all__ = [
+    "is_deadline_error",
+    "start_cache_listener", "stop_cache_listener", "close_pools",
+    "init_db", "ensure_partitions", "archive_partitions",
+    "_get_setting", "set_setting", "list_catalog",
+    "ensure_user", "set_allowed", "set_banned", "set_daily_limit", "increment_daily", "normalize_daily_counters",
+    "search_users", "add_balance", "deduct_balance",
+    "create_topup_request", "list_pending_topups", "decide_topup", "bulk_apply_users",
+    "_write_audit_rows", "stats_today", "export_csv", "list_user_ids_nonbanned",
+    "configure_provider_budget", "take_provider_token",
+    "create_order_row", "get_order", "get_order_by_provider_id", "list_orders_for_user",
+    "set_order_status", "set_order_sms", "set_orders_sms", "set_order_cancelled",
+    "list_stale_waiting_orders", "close_waiting_orders",
+]
+
+PATH = DATABASE_URL.split("sqlite:///", 1)[-1]
+
+# Called with every statement run on connections opened after it is set (replay.py counts them)
+trace: Optional[Callable[[str], None]] = None
+
+
+# ---------- Values ----------
+def _cents(amount: Any) -> int:
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def _money(cents: Optional[int]) -> Optional[Decimal]:
+    return None if cents is None else Decimal(cents).scaleb(-2)
+
+
+def _now() -> str:
+    return datetime.now().isoformat(sep=" ", timespec="microseconds")
+
+
+def _today() -> str:
+    return date.today().isoformat()
+
+
+def _dt(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+# ---------- Connections ----------
+_local = threading.local()
+_writer: Optional[sqlite3.Connection] = None
+_writer_lock = threading.Lock()
+_open: List[sqlite3.Connection] = []
+_open_lock = threading.Lock()
+
+
+def _past_deadline() -> int:
+    left = db.time_left()
+    return 1 if left is not None and left <= 0 else 0
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(PATH, timeout=5, isolation_level=None, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # a running statement is interrupted once the handler's deadline has passed
+    conn.set_progress_handler(_past_deadline, 1000)
+    if trace is not None:
+        conn.set_trace_callback(trace)
+    with _open_lock:
+        _open.append(conn)
+    return conn
+
+
+def _check_deadline() -> None:
+    if _past_deadline():
+        raise db.DeadlineExceeded("deadline passed before the query")
+
+
+def _read() -> sqlite3.Connection:
+    """This thread's reader connection (autocommit: each statement sees the latest commit)."""
+    _check_deadline()
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    return conn
+
+
+@contextmanager
+def _write() -> Iterator[sqlite3.Connection]:
+    """The writer connection inside one transaction, committed on success."""
+    global _writer
+    left = db.time_left()
+    if left is not None and left <= 0:
+        raise db.DeadlineExceeded("deadline passed before the query")
+    if not _writer_lock.acquire(timeout=-1 if left is None else left):
+        raise db.DeadlineExceeded("deadline passed waiting for the writer")
+    try:
+        if _writer is None:
+            _writer = _connect()
+        conn = _writer
+        conn.execute(f"PRAGMA busy_timeout={5000 if left is None else max(int(left * 1000), 1)}")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    finally:
+        _writer_lock.release()
+
+
+def is_deadline_error(exc: BaseException) -> bool:
+    return isinstance(exc, db.DeadlineExceeded) or (isinstance(exc, sqlite3.OperationalError) and str(exc) == "interrupted")
+
+
+def start_cache_listener() -> None:
+    """Nothing to listen to: one process owns the file, and it updates its caches itself."""
+
+
+def stop_cache_listener() -> None:
+    pass
+
+
+def close_pools() -> None:
+    global _writer
+    with _open_lock:
+        conns, _open[:] = list(_open), []
+    for conn in conns:
+        conn.close()
+    _writer = None
+    _local.__dict__.clear()
+
+
+# ---------- Schema ----------
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS schema_version(
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+-- money columns (balance, amount, sell_price, price_usd) hold cents
+CREATE TABLE IF NOT EXISTS users(
+    tenant INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    balance INTEGER NOT NULL DEFAULT 0,
+    is_allowed INTEGER NOT NULL DEFAULT 0,
+    is_banned INTEGER NOT NULL DEFAULT 0,
+    daily_limit INTEGER NOT NULL DEFAULT {int(DEFAULT_DAILY_LIMIT)},
+    daily_count INTEGER NOT NULL DEFAULT 0,
+    daily_date TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (tenant, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_users_t_allowed ON users(tenant, user_id) WHERE is_allowed;
+CREATE INDEX IF NOT EXISTS idx_users_t_banned ON users(tenant, user_id) WHERE is_banned;
+CREATE INDEX IF NOT EXISTS idx_users_t_balance ON users(tenant, balance);
+CREATE INDEX IF NOT EXISTS idx_users_t_updated ON users(tenant, updated_at);
+CREATE INDEX IF NOT EXISTS idx_users_t_id_text ON users(tenant, CAST(user_id AS TEXT));
+
+CREATE TABLE IF NOT EXISTS settings(
+    tenant INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (tenant, key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS transactions(
+    id INTEGER PRIMARY KEY,
+    tenant INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    note TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_t_created ON transactions(tenant, created_at);
+
+CREATE TABLE IF NOT EXISTS admin_logs(
+    id INTEGER PRIMARY KEY,
+    tenant INTEGER NOT NULL,
+    admin_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    payload TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_admin_logs_created ON admin_logs(created_at);
+
+CREATE TABLE IF NOT EXISTS topup_requests(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tenant INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    admin_id INTEGER,
+    created_at TEXT NOT NULL,
+    decided_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_topups_t_pending ON topup_requests(tenant, id) WHERE status='pending';
+
+CREATE TABLE IF NOT EXISTS orders(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    country TEXT NOT NULL DEFAULT 'UK',
+    service_code TEXT NOT NULL DEFAULT 'UK_SERVICE',
+    sell_price INTEGER NOT NULL,
+    provider_order_id TEXT,
+    phone_number TEXT,
+    status TEXT NOT NULL DEFAULT 'created',
+    sms_code TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    tenant INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_waiting_created ON orders(created_at) WHERE status='waiting';
+CREATE INDEX IF NOT EXISTS idx_orders_provider_order_id ON orders(provider_order_id);
+CREATE INDEX IF NOT EXISTS idx_orders_t_user ON orders(tenant, user_id, id);
+
+CREATE TABLE IF NOT EXISTS catalog(
+    id INTEGER PRIMARY KEY,
+    country TEXT NOT NULL,
+    service_code TEXT NOT NULL,
+    title TEXT NOT NULL,
+    price_usd INTEGER,
+    enabled INTEGER NOT NULL DEFAULT 1,
+    sort_order INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (country, service_code)
+);
+INSERT OR IGNORE INTO catalog(country, service_code, title) VALUES('UK', 'UK_SERVICE', '🇬🇧 UK');
+
+-- updated_at: epoch seconds
+CREATE TABLE IF NOT EXISTS provider_budget(
+    endpoint TEXT PRIMARY KEY,
+    refill_per_sec REAL NOT NULL,
+    capacity REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+def init_db(tenants: Optional[List[int]] = None) -> bool:
+    """Create the schema if needed and seed default settings for every tenant. Returns True if it migrated."""
+    conn = _read()
+    row = None
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='schema_version'").fetchone():
+        row = conn.execute("SELECT version FROM schema_version WHERE id=1").fetchone()
+    migrated = row is None or row[0] != db.SCHEMA_VERSION
+    if migrated:
+        _write_lock_script(_SCHEMA)
+    now = _now()
+    with _write() as conn:
+        if migrated:
+            conn.execute("""
+                INSERT INTO schema_version(id, version, updated_at) VALUES(1, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET version=excluded.version, updated_at=excluded.updated_at
+            """, (db.SCHEMA_VERSION, now))
+        defaults = [("price_usd", str(DEFAULT_PRICE_USD)),
+                    ("maintenance", "0"),
+                    ("start_message", db.DEFAULT_START_MESSAGE())]
+        conn.executemany(
+            "INSERT OR IGNORE INTO settings(tenant,key,value,updated_at) VALUES(?,?,?,?)",
+            [(t, k, v, now) for t in (tenants or [db.DEFAULT_TENANT]) for k, v in defaults],
+        )
+    return migrated
+
+
+def _write_lock_script(script: str) -> None:
+    # executescript() commits on its own, so it runs outside _write()'s transaction
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _connect()
+        _writer.executescript(script)
+
+
+def ensure_partitions(months_ahead: int = 0) -> List[str]:
+    """No partitions in SQLite."""
+    return []
+
+
+def archive_partitions(older_than_months: int, directory: Optional[str] = None) -> List[str]:
+    """
+    Same cut-off as the Postgres version, one month at a time: rows of whole
+    months before it are dumped to <directory>/<table>_pYYYYMM.csv.gz and
+    deleted, or without `directory` moved to a <table>_pYYYYMM table.
+    """
+    cutoff = db._add_months(db._month_start(date.today()), -older_than_months).isoformat()
+    done = []
+    for table in db.PARTITIONED_TABLES:
+        months = [r[0] for r in _read().execute(
+            f"SELECT DISTINCT substr(created_at, 1, 7) FROM {table} WHERE created_at < ? ORDER BY 1", (cutoff,))]
+        for month in months:
+            lo = date.fromisoformat(f"{month}-01")
+            hi = db._add_months(lo, 1)
+            name = f"{table}_p{lo:%Y%m}"
+            with _write() as conn:
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                    path = os.path.join(directory, f"{name}.csv.gz")
+                    cur = conn.execute(f"SELECT * FROM {table} WHERE created_at >= ? AND created_at < ? ORDER BY id",
+                                       (lo.isoformat(), hi.isoformat()))
+                    with gzip.open(path + ".tmp", "wb") as f:
+                        _write_csv(cur, f)
+                    os.replace(path + ".tmp", path)
+                else:
+                    conn.execute(f"CREATE TABLE IF NOT EXISTS {name} AS SELECT * FROM {table} WHERE 0")
+                    conn.execute(f"INSERT INTO {name} SELECT * FROM {table} WHERE created_at >= ? AND created_at < ?",
+                                 (lo.isoformat(), hi.isoformat()))
+                conn.execute(f"DELETE FROM {table} WHERE created_at >= ? AND created_at < ?", (lo.isoformat(), hi.isoformat()))
+            done.append(name)
+    return done
+
+
+# ---------- Settings / catalog ----------
+def _get_setting(key: str) -> Optional[str]:
+    row = _read().execute("SELECT value FROM settings WHERE tenant=? AND key=?", (db._tenant.get(), key)).fetchone()
+    return row[0] if row else None
+
+
+def set_setting(key: str, value: str) -> None:
+    with _write() as conn:
+        conn.execute("""
+            INSERT INTO settings(tenant,key,value,updated_at) VALUES(?,?,?,?)
+            ON CONFLICT (tenant, key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
+        """, (db._tenant.get(), key, value, _now()))
+    db._settings_cache.put((db._tenant.get(), key), (value,))
+
+
+def list_catalog() -> List[Dict]:
+    rows = _read().execute("""
+        SELECT id, country, service_code, title, price_usd
+        FROM catalog
+        WHERE enabled
+        ORDER BY sort_order, id
+    """).fetchall()
+    return [{**dict(r), "price_usd": _money(r["price_usd"])} for r in rows]
+
+
+# ---------- Users ----------
+# daily_count is evaluated lazily: a row whose daily_date is not today counts as 0
+_USER_COLUMNS = """
+    user_id, balance, is_allowed, is_banned, daily_limit,
+    CASE WHEN daily_date = :today THEN daily_count ELSE 0 END AS daily_count,
+    MAX(daily_date, :today) AS daily_date
+"""
+_SELECT_USER = f"SELECT {_USER_COLUMNS} FROM users WHERE tenant=:tenant AND user_id=:user_id"
+
+
+def _row_to_user(row) -> db.User:
+    return db.User(
+        user_id=int(row["user_id"]),
+        balance=float(_money(row["balance"])),
+        is_allowed=bool(row["is_allowed"]),
+        is_banned=bool(row["is_banned"]),
+        daily_limit=int(row["daily_limit"]),
+        daily_count=int(row["daily_count"]),
+        daily_date=date.fromisoformat(row["daily_date"]),
+    )
+
+
+def _update_user(sql: str, **params: Any) -> Optional[db.User]:
+    """Run a single-user UPDATE ... RETURNING {_USER_COLUMNS} and write the result through to the cache."""
+    tenant = db._tenant.get()
+    with _write() as conn:
+        row = conn.execute(sql, {"tenant": tenant, "today": _today(), "now": _now(), **params}).fetchone()
+    user = _row_to_user(row) if row else None
+    if user:
+        db._user_cache.put((tenant, user.user_id), user)
+    return user
+
+
+def ensure_user(user_id: int) -> db.User:
+    tenant = db._tenant.get()
+    cached = db._cached_user(tenant, user_id)
+    if cached is not None:
+        metrics.incr("user_cache_hits")
+        return cached
+    metrics.incr("user_cache_misses")
+
+    params = {"tenant": tenant, "user_id": user_id, "today": _today()}
+    row = _read().execute(_SELECT_USER, params).fetchone()
+    if not row:
+        now = _now()
+        with _write() as conn:
+            conn.execute("""
+                INSERT OR IGNORE INTO users(tenant,user_id,daily_date,created_at,updated_at)
+                VALUES(:tenant,:user_id,:today,:now,:now)
+            """, {**params, "now": now})
+            row = conn.execute(_SELECT_USER, params).fetchone()
+        db._mark_wrote()
+
+    user = _row_to_user(row)
+    db._user_cache.put((tenant, user_id), user)
+    return user
+
+
+def set_allowed(user_id: int, allowed: bool) -> None:
+    _update_user(f"UPDATE users SET is_allowed=:v, updated_at=:now WHERE tenant=:tenant AND user_id=:user_id RETURNING {_USER_COLUMNS}",
+                 v=int(allowed), user_id=user_id)
+
+
+def set_banned(user_id: int, banned: bool) -> None:
+    _update_user(f"UPDATE users SET is_banned=:v, updated_at=:now WHERE tenant=:tenant AND user_id=:user_id RETURNING {_USER_COLUMNS}",
+                 v=int(banned), user_id=user_id)
+
+
+def set_daily_limit(user_id: int, limit: int) -> None:
+    _update_user(f"UPDATE users SET daily_limit=:v, updated_at=:now WHERE tenant=:tenant AND user_id=:user_id RETURNING {_USER_COLUMNS}",
+                 v=limit, user_id=user_id)
+
+
+def increment_daily(user_id: int) -> None:
+    _update_user(f"""
+        UPDATE users SET
+            daily_count = CASE WHEN daily_date = :today THEN daily_count + 1 ELSE 1 END,
+            daily_date = :today,
+            updated_at = :now
+        WHERE tenant=:tenant AND user_id=:user_id
+        RETURNING {_USER_COLUMNS}
+    """, user_id=user_id)
+
+
+def normalize_daily_counters() -> int:
+    """Housekeeping: zero out counters left over from previous days (not needed for correctness)."""
+    with _write() as conn:
+        return conn.execute("UPDATE users SET daily_count=0, daily_date=:today WHERE daily_date < :today",
+                            {"today": _today()}).rowcount
+
+
+# ---------- User directory (admin) ----------
+_ID_TEXT = "CAST(user_id AS TEXT)"
+
+
+def search_users(
+    allowed: Optional[bool] = None,
+    banned: Optional[bool] = None,
+    min_balance: Optional[float] = None,
+    max_balance: Optional[float] = None,
+    active_days: Optional[int] = None,
+    id_prefix: Optional[str] = None,
+    after: Optional[int] = None,
+    limit: int = 20,
+) -> List[Dict]:
+    """Keyset-paged user listing, as db.search_users."""
+    where, params = ["tenant = ?"], [db._tenant.get()]
+    if allowed is not None:
+        where.append("is_allowed" if allowed else "NOT is_allowed")
+    if banned is not None:
+        where.append("is_banned" if banned else "NOT is_banned")
+    if min_balance is not None:
+        where.append("balance >= ?")
+        params.append(_cents(min_balance))
+    if max_balance is not None:
+        where.append("balance <= ?")
+        params.append(_cents(max_balance))
+    if active_days is not None:
+        where.append("updated_at >= ?")
+        params.append((datetime.now() - timedelta(days=active_days)).isoformat(sep=" ", timespec="microseconds"))
+
+    if id_prefix:
+        # digits sort before ':' so [prefix, prefix':') is exactly "starts with prefix"
+        where += [f"{_ID_TEXT} >= ?", f"{_ID_TEXT} < ?"]
+        params += [id_prefix, id_prefix + ":"]
+        if after is not None:
+            where.append(f"{_ID_TEXT} > ?")
+            params.append(str(after))
+        order = _ID_TEXT
+    else:
+        if after is not None:
+            where.append("user_id > ?")
+            params.append(after)
+        order = "user_id"
+
+    sql = "SELECT user_id, balance, is_allowed, is_banned, updated_at FROM users"
+    sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order} LIMIT ?"
+    params.append(limit)
+
+    return [
+        {"user_id": r["user_id"], "balance": _money(r["balance"]), "is_allowed": bool(r["is_allowed"]),
+         "is_banned": bool(r["is_banned"]), "updated_at": _dt(r["updated_at"])}
+        for r in _read().execute(sql, params).fetchall()
+    ]
+
+
+# ---------- Balance / Transactions ----------
+def add_balance(user_id: int, amount: float, kind: str, note: str | None = None) -> None:
+    tenant = db._tenant.get()
+    now = _now()
+    with _write() as conn:
+        row = conn.execute(f"""
+            INSERT INTO users(tenant,user_id,balance,daily_date,created_at,updated_at)
+            VALUES(:tenant,:user_id,:amount,:today,:now,:now)
+            ON CONFLICT (tenant, user_id) DO UPDATE SET balance = balance + excluded.balance, updated_at=:now
+            RETURNING {_USER_COLUMNS}
+        """, {"tenant": tenant, "user_id": user_id, "amount": _cents(amount), "today": _today(), "now": now}).fetchone()
+        conn.execute("INSERT INTO transactions(tenant,user_id,amount,kind,note,created_at) VALUES(?,?,?,?,?,?)",
+                     (tenant, user_id, _cents(amount), kind, note, now))
+    db._user_cache.put((tenant, user_id), _row_to_user(row))
+
+
+def deduct_balance(user_id: int, amount: float, kind: str, note: str | None = None) -> bool:
+    tenant = db._tenant.get()
+    now = _now()
+    with _write() as conn:
+        row = conn.execute(f"""
+            UPDATE users SET balance=balance-:amount, updated_at=:now
+            WHERE tenant=:tenant AND user_id=:user_id AND balance >= :amount
+            RETURNING {_USER_COLUMNS}
+        """, {"tenant": tenant, "user_id": user_id, "amount": _cents(amount), "today": _today(), "now": now}).fetchone()
+        if row:
+            conn.execute("INSERT INTO transactions(tenant,user_id,amount,kind,note,created_at) VALUES(?,?,?,?,?,?)",
+                         (tenant, user_id, -abs(_cents(amount)), kind, note, now))
+    if row:
+        db._user_cache.put((tenant, user_id), _row_to_user(row))
+    return row is not None
+
+
+# ---------- Topup Requests ----------
+def create_topup_request(user_id: int, amount: float) -> int:
+    with _write() as conn:
+        return int(conn.execute(
+            "INSERT INTO topup_requests(tenant,user_id,amount,created_at) VALUES(?,?,?,?) RETURNING id",
+            (db._tenant.get(), user_id, _cents(amount), _now()),
+        ).fetchone()[0])
+
+
+def list_pending_topups(limit: int = 20) -> List[Tuple]:
+    rows = _read().execute("""
+        SELECT id, user_id, amount, created_at
+        FROM topup_requests
+        WHERE tenant=? AND status='pending'
+        ORDER BY id ASC
+        LIMIT ?
+    """, (db._tenant.get(), limit)).fetchall()
+    return [(r[0], r[1], _money(r[2]), _dt(r[3])) for r in rows]
+
+
+def decide_topup(req_id: int, admin_id: int, approve: bool) -> Optional[Tuple[int, float]]:
+    with _write() as conn:
+        row = conn.execute("""
+            UPDATE topup_requests SET status=?, admin_id=?, decided_at=?
+            WHERE id=? AND tenant=? AND status='pending'
+            RETURNING user_id, amount
+        """, ("approved" if approve else "rejected", admin_id, _now(), req_id, db._tenant.get())).fetchone()
+    if not row:
+        return None
+    return (int(row["user_id"]), float(_money(row["amount"])))
+
+
+# ---------- Bulk user administration ----------
+def bulk_apply_users(rows: List[Tuple[int, Optional[str], Optional[int], Optional[float]]],
+                     admin_id: int) -> Dict[str, Any]:
+    """Apply many user changes in a single transaction, as db.bulk_apply_users."""
+    merged: Dict[int, List[Any]] = {}
+    for uid, action, limit, delta in rows:
+        m = merged.setdefault(uid, [uid, None, None, None, None])
+        if action == "allow":
+            m[1] = True
+        elif action == "deny":
+            m[1] = False
+        elif action == "ban":
+            m[2] = True
+        elif action == "unban":
+            m[2] = False
+        if limit is not None:
+            m[3] = limit
+        if delta:
+            m[4] = round((m[4] or 0) + delta, 2)
+
+    if not merged:
+        return {"users": 0, "created": 0, "balance_rows": 0, "rejected": []}
+
+    tenant = db._tenant.get()
+    now, today = _now(), _today()
+    with _write() as conn:
+        created = conn.executemany(
+            "INSERT OR IGNORE INTO users(tenant,user_id,daily_date,created_at,updated_at) VALUES(?,?,?,?,?)",
+            [(tenant, uid, today, now, now) for uid in merged],
+        ).rowcount
+        rejected = []
+        for m in merged.values():
+            if not m[4]:
+                continue
+            applied = conn.execute("""
+                UPDATE users SET balance = balance + :delta
+                WHERE tenant = :tenant AND user_id = :uid
+                  AND balance + :delta >= 0 AND balance + :delta < :max
+            """, {"delta": _cents(m[4]), "tenant": tenant, "uid": m[0], "max": _cents(10 ** 10)}).rowcount
+            if not applied:
+                rejected.append(m[0])
+                m[4] = None
+        updated = conn.executemany("""
+            UPDATE users SET
+                is_allowed = COALESCE(?, is_allowed),
+                is_banned = COALESCE(?, is_banned),
+                daily_limit = COALESCE(?, daily_limit),
+                updated_at = ?
+            WHERE tenant = ? AND user_id = ?
+        """, [(None if a is None else int(a), None if b is None else int(b), lim, now, tenant, uid)
+              for uid, a, b, lim, _d in merged.values()]).rowcount
+        balance_rows = conn.executemany(
+            "INSERT INTO transactions(tenant,user_id,amount,kind,note,created_at) VALUES(?,?,?,'adjust',?,?)",
+            [(tenant, uid, _cents(d), f"Admin bulk by {admin_id}", now)
+             for uid, _a, _b, _lim, d in merged.values() if d and _cents(d) != 0],
+        ).rowcount
+        summary = {"users": updated, "created": created, "balance_rows": balance_rows, "rejected": sorted(rejected)}
+        conn.execute("INSERT INTO admin_logs(tenant,admin_id,action,payload,created_at) VALUES(?,?,?,?,?)",
+                     (tenant, admin_id, "bulk_users", json.dumps(summary), now))
+    for uid in merged:
+        db._user_cache.invalidate((tenant, uid))
+    return summary
+
+
+# ---------- Admin Logs / stats / exports ----------
+def _write_audit_rows(rows: List[Tuple]) -> None:
+    with _write() as conn:
+        conn.executemany(
+            "INSERT INTO admin_logs(tenant,admin_id,action,payload,created_at) VALUES(?,?,?,?,?)",
+            [(t, a, action, payload, created.isoformat(sep=" ", timespec="microseconds"))
+             for t, a, action, payload, created in rows],
+        )
+
+
+def stats_today() -> Dict[str, Any]:
+    conn = _read()
+    tenant = db._tenant.get()
+    today, tomorrow = _today(), (date.today() + timedelta(days=1)).isoformat()
+    conn.execute("BEGIN")  # one snapshot for all three counts
+    try:
+        tx_count, sum_amount = conn.execute("""
+            SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM transactions
+            WHERE tenant=? AND created_at >= ? AND created_at < ?
+        """, (tenant, today, tomorrow)).fetchone()
+        users_count = conn.execute("SELECT COUNT(*) FROM users WHERE tenant=?", (tenant,)).fetchone()[0]
+        active_today = conn.execute("SELECT COUNT(*) FROM users WHERE tenant=? AND updated_at >= ?",
+                                    (tenant, today)).fetchone()[0]
+    finally:
+        conn.execute("COMMIT")
+    return {
+        "tx_count": int(tx_count),
+        "sum_amount": float(_money(sum_amount)),
+        "users_count": int(users_count),
+        "active_today": int(active_today),
+    }
+
+
+_EXPORT_TABLES = {"transactions": "transactions", "orders": "orders", "topups": "topup_requests"}
+_MONEY_COLUMNS = {"balance", "amount", "sell_price", "price_usd"}
+
+
+def _write_csv(cur: sqlite3.Cursor, out) -> None:
+    """Rows of `cur` as CSV with a header into the binary file `out` (money as decimals, NULL as empty)."""
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    w = csv.writer(text, lineterminator="\n")
+    names = [d[0] for d in cur.description]
+    money = [n in _MONEY_COLUMNS for n in names]
+    w.writerow(names)
+    for row in cur:
+        w.writerow(["" if v is None else _money(v) if m else v for v, m in zip(row, money)])
+    text.flush()
+    text.detach()
+
+
+def export_csv(kind: str, start: date, end: date, out) -> None:
+    """Rows of db.EXPORTS[kind] created between start and end (inclusive) as CSV into `out`."""
+    columns = db.EXPORTS[kind].split("SELECT", 1)[1].split("FROM", 1)[0]
+    cur = _read().execute(
+        f"SELECT {columns} FROM {_EXPORT_TABLES[kind]} WHERE tenant = ? AND created_at >= ? AND created_at < ? ORDER BY created_at, id",
+        (db._tenant.get(), start.isoformat(), (end + timedelta(days=1)).isoformat()),
+    )
+    _write_csv(cur, out)
+
+
+def list_user_ids_nonbanned() -> List[int]:
+    return [int(r[0]) for r in _read().execute("SELECT user_id FROM users WHERE tenant=? AND NOT is_banned",
+                                               (db._tenant.get(),))]
+
+
+# ---------- Provider call budget ----------
+def configure_provider_budget(limits: Dict[str, Tuple[float, float]]) -> None:
+    """Make provider_budget match `limits` ({endpoint: (calls_per_sec, burst)})."""
+    now = time.time()
+    with _write() as conn:
+        conn.executemany("""
+            INSERT INTO provider_budget(endpoint, refill_per_sec, capacity, tokens, updated_at) VALUES(?,?,?,?,?)
+            ON CONFLICT (endpoint) DO UPDATE SET
+                refill_per_sec = excluded.refill_per_sec,
+                capacity = excluded.capacity,
+                tokens = MIN(tokens, excluded.capacity)
+        """, [(name, rate, burst, burst, now) for name, (rate, burst) in limits.items()])
+        conn.execute(f"DELETE FROM provider_budget WHERE endpoint NOT IN ({','.join('?' * len(limits))})", list(limits))
+
+
+def take_provider_token(endpoint: str, reserve: float = 0.0) -> float:
+    """Take one call from the endpoint's and the '*' bucket, as db.take_provider_token."""
+    with _write() as conn:
+        now = time.time()
+        rows = conn.execute("""
+            SELECT endpoint, capacity, refill_per_sec, MIN(capacity, tokens + refill_per_sec * (? - updated_at)) AS level
+            FROM provider_budget
+            WHERE endpoint IN (?, '*')
+        """, (now, endpoint)).fetchall()
+        wait = 0.0
+        for name, capacity, rate, level in rows:
+            need = 1 + (reserve * capacity if name == "*" else 0)
+            if level < need:
+                wait = max(wait, (need - level) / rate if rate > 0 else 60.0)
+        if rows and wait == 0:
+            conn.execute("""
+                UPDATE provider_budget SET tokens = MIN(capacity, tokens + refill_per_sec * (? - updated_at)) - 1, updated_at = ?
+                WHERE endpoint IN (?, '*')
+            """, (now, now, endpoint))
+    return wait
+
+
+# ---------- Orders ----------
+def _order(row) -> Optional[Dict]:
+    if row is None:
+        return None
+    o = dict(row)
+    o["sell_price"] = _money(o["sell_price"])
+    o["created_at"] = _dt(o["created_at"])
+    o["updated_at"] = _dt(o["updated_at"])
+    return o
+
+
+def create_order_row(
+    user_id: int,
+    country: str,
+    service_code: str,
+    sell_price: float,
+    provider_order_id: str,
+    phone_number: str,
+    status: str = "waiting",
+) -> int:
+    now = _now()
+    with _write() as conn:
+        return int(conn.execute("""
+            INSERT INTO orders(tenant, user_id, country, service_code, sell_price, provider_order_id, phone_number,
+                               status, created_at, updated_at)
+            VALUES(?,?,?,?,?,?,?,?,?,?)
+            RETURNING id
+        """, (db._tenant.get(), user_id, country, service_code, _cents(sell_price), provider_order_id, phone_number,
+              status, now, now)).fetchone()[0])
+
+
+def get_order(order_id: int, user_id: Optional[int] = None) -> Optional[Dict]:
+    if user_id is None:
+        row = _read().execute("SELECT * FROM orders WHERE id=? AND tenant=?", (order_id, db._tenant.get())).fetchone()
+    else:
+        row = _read().execute("SELECT * FROM orders WHERE id=? AND tenant=? AND user_id=?",
+                              (order_id, db._tenant.get(), user_id)).fetchone()
+    return _order(row)
+
+
+def get_order_by_provider_id(provider_order_id: str) -> Optional[Dict]:
+    return _order(_read().execute("SELECT * FROM orders WHERE provider_order_id=? ORDER BY id DESC LIMIT 1",
+                                  (provider_order_id,)).fetchone())
+
+
+def list_orders_for_user(user_id: int, limit: int = 10, status: Optional[str] = None) -> List[Dict]:
+    rows = _read().execute("""
+        SELECT * FROM orders
+        WHERE tenant=? AND user_id=? AND (? IS NULL OR status=?)
+        ORDER BY id DESC
+        LIMIT ?
+    """, (db._tenant.get(), user_id, status, status, limit)).fetchall()
+    return [_order(r) for r in rows]
+
+
+# As in db.py, status changes only apply to orders still 'waiting'
+def set_order_status(order_id: int, status: str) -> bool:
+    with _write() as conn:
+        return conn.execute("UPDATE orders SET status=?, updated_at=? WHERE id=? AND status='waiting'",
+                            (status, _now(), order_id)).rowcount == 1
+
+
+def set_order_sms(order_id: int, sms_code: str) -> bool:
+    with _write() as conn:
+        return conn.execute("UPDATE orders SET sms_code=?, status='received', updated_at=? WHERE id=? AND status='waiting'",
+                            (sms_code, _now(), order_id)).rowcount == 1
+
+
+def set_orders_sms(codes: List[Tuple[int, str]]) -> int:
+    """Record SMS codes for several waiting orders in one statement, as db.set_orders_sms."""
+    if not codes:
+        return 0
+    with _write() as conn:
+        # rowcount is not reported for statements starting with WITH
+        return len(conn.execute(f"""
+            WITH c(id, sms_code) AS (VALUES {','.join(['(?,?)'] * len(codes))})
+            UPDATE orders SET sms_code = (SELECT sms_code FROM c WHERE c.id = orders.id), status='received', updated_at=?
+            WHERE id IN (SELECT id FROM c) AND status='waiting'
+            RETURNING id
+        """, [v for code in codes for v in code] + [_now()]).fetchall())
+
+
+def set_order_cancelled(order_id: int) -> bool:
+    with _write() as conn:
+        return conn.execute("UPDATE orders SET status='cancelled', updated_at=? WHERE id=? AND status='waiting'",
+                            (_now(), order_id)).rowcount == 1
+
+
+def list_stale_waiting_orders(ttl_minutes: int, limit: int = 200) -> List[Dict]:
+    cutoff = (datetime.now() - timedelta(minutes=ttl_minutes)).isoformat(sep=" ", timespec="microseconds")
+    rows = _read().execute("""
+        SELECT id, tenant, user_id, provider_order_id, sell_price
+        FROM orders
+        WHERE status='waiting' AND created_at < ?
+        ORDER BY created_at ASC
+        LIMIT ?
+    """, (cutoff, limit)).fetchall()
+    return [{**dict(r), "sell_price": _money(r["sell_price"])} for r in rows]
+
+
+def close_waiting_orders(cancelled_ids: List[int], refund_ids: List[int], note: str = "Order expired") -> Dict[str, int]:
+    """Close waiting orders in one transaction, as db.close_waiting_orders."""
+    now = _now()
+    refunded: List[Tuple] = []
+    with _write() as conn:
+        cancelled = 0
+        if cancelled_ids:
+            cancelled = conn.execute(f"""
+                UPDATE orders SET status='cancelled', updated_at=?
+                WHERE id IN ({','.join('?' * len(cancelled_ids))}) AND status='waiting'
+            """, [now, *cancelled_ids]).rowcount
+        if refund_ids:
+            refunded = [tuple(r) for r in conn.execute(f"""
+                UPDATE orders SET status='refunded', updated_at=?
+                WHERE id IN ({','.join('?' * len(refund_ids))}) AND status='waiting'
+                RETURNING id, tenant, user_id, sell_price
+            """, [now, *refund_ids]).fetchall()]
+        if refunded:
+            conn.executemany(
+                "UPDATE users SET balance = balance + ?, updated_at=? WHERE tenant = ? AND user_id = ?",
+                [(amt, now, t, uid) for t, uid, amt in db._sum_by_user(((t, uid), amt) for _, t, uid, amt in refunded)],
+            )
+            conn.executemany(
+                "INSERT INTO transactions(tenant,user_id,amount,kind,note,created_at) VALUES(?,?,?,?,?,?)",
+                [(t, uid, amt, "refund", f"{note} #{oid}", now) for oid, t, uid, amt in refunded],
+            )
+    for _, t, uid, _ in refunded:
+        db._user_cache.invalidate((t, uid))
+    return {"cancelled": cancelled, "refunded": len(refunded)}
@@ -0,0 +1,57 @@
+"""
+Per-key token buckets kept in memory, used for per-user flood control.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, List
+
+
+class TokenBucketLimiter:
+    """
+    Each key gets a bucket of `capacity` tokens refilled at `refill_per_sec`.
+    Memory is bounded: at most `max_keys` buckets are kept (LRU), and a bucket
+    idle long enough to be full again is dropped since it is equivalent to a
+    fresh one.
+    """
+
+    def __init__(self, capacity: float, refill_per_sec: float, max_keys: int = 50000):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.max_keys = max_keys
+        self.idle_ttl = capacity / refill_per_sec if refill_per_sec > 0 else float("inf")
+        self._buckets: "OrderedDict[Hashable, List[float]]" = OrderedDict()  # key -> [tokens, last]
+        self._lock = threading.Lock()
+
+    def allow(self, key: Hashable, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            b = self._buckets.get(key)
+            if b is None:
+                b = [self.capacity, now]
+                self._buckets[key] = b
+            else:
+                b[0] = min(self.capacity, b[0] + (now - b[1]) * self.refill_per_sec)
+                b[1] = now
+                self._buckets.move_to_end(key)
+
+            allowed = b[0] >= cost
+            if allowed:
+                b[0] -= cost
+
+            self._evict(now)
+            return allowed
+
+    def _evict(self, now: float) -> None:
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        while self._buckets:
+            _key, (_tokens, last) = next(iter(self._buckets.items()))
+            if now - last < self.idle_ttl:
+                break
+            self._buckets.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
@@ -1,28 +1,82 @@
 from __future__ import annotations
 
+import asyncio
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import math
+import os
 import re
+import signal
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 from typing import Optional
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
 import db
+import metrics
+import profiler
+from capture import UpdateRecorder
+from catalog import Catalog
+from convstate import ConversationStore
+from limiter import TokenBucketLimiter
+from provider_queue import ProviderBusy, ProviderWorkQueue
+from scheduler import PerUserUpdateProcessor
 import provider  # ✅ NEW
-from config import BOT_TOKEN, ADMIN_IDS, SHOW_ADMIN_BUTTON_FOR_ADMINS
+import push_receiver
+from config import (
+    ADMIN_IDS,
+    BOT_TOKENS,
+    CAPTURE_FILE,
+    CATALOG_REFRESH_INTERVAL,
+    CONCURRENT_UPDATES,
+    CONV_MAX_USERS,
+    CONV_TOPUP_TTL,
+    CONV_TTL,
+    EXPORT_MAX_BYTES,
+    FLOOD_CAPACITY,
+    FLOOD_MAX_USERS,
+    FLOOD_REFILL_PER_SEC,
+    ORDER_TTL_MINUTES,
+    ORDERS_REFRESH_CONCURRENCY,
+    ORDERS_REFRESH_MAX,
+    PARTITION_MAINTENANCE_INTERVAL,
+    PROFILE_DEFAULT_SECONDS,
+    PROFILE_MAX_SECONDS,
+    PROVIDER_QUEUE_BUSY_AT,
+    PROVIDER_WORKERS,
+    REAPER_BATCH,
+    REAPER_CONCURRENCY,
+    REAPER_INTERVAL,
+    SHOW_ADMIN_BUTTON_FOR_ADMINS,
+)
+
+log = logging.getLogger(__name__)
 
 
-# ------------------- Constants / States (via context.user_data flags) -------------------
+# ------------------- Constants -------------------
 CB_MAIN = "main"
 CB_BAL = "bal"
 CB_BUY = "buy"
+CB_BUY_ITEM_PREFIX = "buyc_"  # +catalog id
 CB_TOPUP = "topup"
 CB_ORDERS = "orders"
 CB_PROFILE = "profile"
@@ -32,6 +86,7 @@ CB_ADMIN = "admin"
 # Orders actions (user)
 CB_ORDER_REFRESH_PREFIX = "ord_ref_"  # +order_id
 CB_ORDER_CANCEL_PREFIX = "ord_can_"   # +order_id
+CB_ORDERS_REFRESH_ALL = "ord_refall"  # all of the user's waiting orders
 
 # Admin sections
 CB_A_USERS = "a_users"
@@ -40,6 +95,9 @@ CB_A_ORDERS = "a_orders"
 CB_A_STATS = "a_stats"
 CB_A_SETTINGS = "a_settings"
 CB_A_MSGS = "a_msgs"
+CB_A_METRICS = "a_metrics"
+CB_A_EXPORT = "a_export"
+CB_A_EXPORT_PREFIX = "a_exp_"  # +transactions/orders/topups
 
 # Admin wallet actions
 CB_A_ADD_BAL = "a_add_bal"
@@ -51,6 +109,40 @@ CB_A_ALLOW = "a_allow"
 CB_A_DENY = "a_deny"
 CB_A_BAN = "a_ban"
 CB_A_UNBAN = "a_unban"
+CB_A_BULK = "a_bulk"
+CB_A_BULK_PREFIX = "a_bulk_"  # +allow/deny/ban/unban/csv
+
+BULK_ACTIONS = ("allow", "deny", "ban", "unban")
+BULK_MAX_FILE_BYTES = 2 * 1024 * 1024
+USER_ID_MAX = 2 ** 63 - 1  # users.user_id is BIGINT
+DAILY_LIMIT_MAX = 2 ** 31 - 1  # users.daily_limit is INT
+
+# Admin user directory
+CB_A_DIR = "a_dir"
+CB_A_DIR_PREFIX = "a_dl_"        # +filter_arg_after (keyset page)
+CB_A_DIR_SEARCH = "a_dsearch"
+CB_A_DIR_RANGE = "a_drange"
+CB_A_USER_PREFIX = "a_u_"        # +user_id (user card)
+CB_A_USER_SET_PREFIX = "a_uset_"  # +user_id_allow/deny/ban/unban
+
+DIR_PAGE_SIZE = 15
+BALANCE_BOUND_MAX = 10 ** 10  # users.balance is NUMERIC(12,2)
+CALLBACK_DATA_MAX = 64  # Bot API limit, in bytes
+DIR_FILTERS = {
+    "all": ("👥 الكل", {}),
+    "ok": ("✅ المفعّلون", {"allowed": True}),
+    "wait": ("⏳ غير المفعّلين", {"allowed": False, "banned": False}),
+    "ban": ("🚫 المحظورون", {"banned": True}),
+    "bal": ("💰 لديهم رصيد", {"min_balance": 0.01}),
+    "act": ("🕒 نشطون آخر 7 أيام", {"active_days": 7}),
+}
+# action -> (db setter, value, admin log action, message to the user)
+USER_SETTERS = {
+    "allow": (db.set_allowed, True, "allow_user", "✅ تم تفعيل حسابك. أرسل /start."),
+    "deny": (db.set_allowed, False, "deny_user", None),
+    "ban": (db.set_banned, True, "ban_user", "🚫 تم حظر حسابك."),
+    "unban": (db.set_banned, False, "unban_user", "✅ تم فك الحظر عن حسابك."),
+}
 
 # Admin settings actions
 CB_A_SET_PRICE = "a_set_price"
@@ -67,7 +159,101 @@ CB_A_APPROVE_PREFIX = "a_appr_"  # +id
 CB_A_REJECT_PREFIX = "a_rej_"    # +id
 
 
+# Flood control: token cost per route (see route_of)
+ROUTE_COSTS = {
+    "buy": 3.0,
+    "refresh": 2.0,
+    "refresh_all": 4.0,
+    "cancel": 2.0,
+    "orders": 1.0,
+    "text": 1.0,
+    "admin": 0.0,
+    "nav": 0.5,
+}
+# Time budget per callback route (seconds) for its DB and provider work; see db.use_deadline
+ROUTE_DEADLINES = {
+    "buy": 35.0,
+    "refresh": 20.0,
+    "refresh_all": 25.0,
+    "cancel": 20.0,
+    "orders": 8.0,
+    "admin": 30.0,
+    "nav": 5.0,
+}
+DEADLINE_TEXT = "⌛ استغرق الطلب وقتاً أطول من المعتاد. حاول مرة أخرى."
+# Priority lanes for update scheduling: name -> (weight, max concurrent updates).
+# Under load freed slots go to waiting lanes in proportion to their weights, and
+# navigation can never take all of them.
+LANES = {
+    "admin": (8.0, max(1, CONCURRENT_UPDATES // 4)),
+    "money": (4.0, CONCURRENT_UPDATES),
+    "nav": (1.0, max(1, CONCURRENT_UPDATES * 3 // 4)),
+}
+flood = TokenBucketLimiter(FLOOD_CAPACITY, FLOOD_REFILL_PER_SEC, FLOOD_MAX_USERS)
+
+# Pending prompt per (tenant, user): what their next text/document answers
+conversations = ConversationStore({"topup": CONV_TOPUP_TTL}, CONV_TTL, CONV_MAX_USERS)
+# Flows whose answer is an amount of money (scheduled in the "money" lane)
+MONEY_FLOWS = ("topup", "addbal", "dedbal")
+
+# Provider calls from handlers go through a bounded queue with admission control
+PROVIDER_ROUTES = ("buy", "refresh", "refresh_all", "cancel")
+PROVIDER_BUSY_TEXT = "⏳ المزوّد مشغول حالياً، حاول مجدداً بعد قليل."
+provider_jobs = ProviderWorkQueue(PROVIDER_WORKERS, PROVIDER_QUEUE_BUSY_AT)
+
+catalog = Catalog()
+
+
 # ------------------- Helpers -------------------
+def route_of(data: str) -> str:
+    """Coarse route name for a callback_data value."""
+    if data.startswith(CB_BUY_ITEM_PREFIX):
+        return "buy"
+    if data.startswith(CB_ORDER_REFRESH_PREFIX):
+        return "refresh"
+    if data == CB_ORDERS_REFRESH_ALL:
+        return "refresh_all"
+    if data.startswith(CB_ORDER_CANCEL_PREFIX):
+        return "cancel"
+    if data == CB_ORDERS:
+        return "orders"
+    if data == CB_ADMIN or data.startswith("a_"):
+        return "admin"
+    return "nav"
+
+
+def flood_ok(user_id: int, route: str) -> bool:
+    if is_admin(user_id) or flood.allow((db.current_tenant(), user_id), ROUTE_COSTS[route]):
+        return True
+    metrics.incr("flood_rejected")
+    return False
+
+
+def lane_of(update: object) -> str:
+    """Scheduling lane of an update (see LANES); runs before any handler, so no DB access."""
+    if not isinstance(update, Update) or not update.effective_user:
+        return "nav"
+    if is_admin(update.effective_user.id):
+        return "admin"
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        return "money" if route_of(data) in PROVIDER_ROUTES or data == "topup_req" else "nav"
+    msg = update.effective_message
+    if msg and msg.text and not msg.text.startswith("/"):
+        # only answers to an amount prompt; any other text must stay under the nav cap
+        try:
+            tenant = db.tenant_of(update.get_bot().token)
+        except RuntimeError:
+            return "nav"
+        state = conversations.get((tenant, update.effective_user.id))
+        return "money" if state and state["flow"] in MONEY_FLOWS else "nav"
+    return "nav"
+
+
+def conv_key(user_id: int) -> tuple[int, int]:
+    return db.current_tenant(), user_id
+
+
 def is_admin(user_id: int) -> bool:
     return user_id in set(ADMIN_IDS)
 
@@ -82,6 +268,206 @@ def money_ok(s: str) -> Optional[float]:
     return v
 
 
+def parse_bulk_rows(text: str, default_action: Optional[str], csv_mode: bool) -> tuple[list, list]:
+    """
+    Parse a pasted ID list or CSV (user_id, action, limit, balance_delta).
+    Returns (rows, failures) where failures are (line/token, reason).
+    """
+    rows, failures = [], []
+    sums: dict[int, float] = {}
+
+    if not csv_mode:
+        for tok in re.split(r"[\s,;]+", text):
+            if not tok:
+                continue
+            if not tok.isdigit() or int(tok) > USER_ID_MAX:
+                failures.append((tok, "ID غير صحيح"))
+                continue
+            rows.append((int(tok), default_action, None, None))
+        return rows, failures
+
+    for line_no, cells in enumerate(csv.reader(io.StringIO(text)), start=1):
+        cells = [c.strip() for c in cells] + [""] * 4
+        uid_s, action, limit_s, delta_s = cells[:4]
+        if not uid_s:
+            continue
+        if not uid_s.isdigit() or int(uid_s) > USER_ID_MAX:
+            if line_no == 1 and uid_s.lower() == "user_id":
+                continue
+            failures.append((line_no, "ID غير صحيح"))
+            continue
+        uid = int(uid_s)
+
+        action = action.lower() or default_action
+        if action and action not in BULK_ACTIONS:
+            failures.append((line_no, f"إجراء غير معروف: {action}"))
+            continue
+
+        limit = None
+        if limit_s:
+            if not limit_s.isdigit() or int(limit_s) > DAILY_LIMIT_MAX:
+                failures.append((line_no, "حد يومي غير صحيح"))
+                continue
+            limit = int(limit_s)
+
+        delta = None
+        if delta_s:
+            sign = -1 if delta_s.startswith("-") else 1
+            delta = money_ok(delta_s.lstrip("+-"))
+            if delta is None or delta >= 10 ** 9:
+                failures.append((line_no, "مبلغ غير صحيح"))
+                continue
+            delta *= sign
+            # rows for one user are summed into a single NUMERIC(12,2) delta
+            total = round(sums.get(uid, 0) + delta, 2)
+            if abs(total) >= BALANCE_BOUND_MAX:
+                failures.append((line_no, "مجموع المبالغ لهذا المستخدم كبير جداً"))
+                continue
+            sums[uid] = total
+
+        if not action and limit is None and delta is None:
+            failures.append((line_no, "لا يوجد أي تغيير"))
+            continue
+        rows.append((uid, action or None, limit, delta))
+
+    return rows, failures
+
+
+def bulk_summary_text(summary: Optional[dict], failures: list, error: Optional[str] = None) -> str:
+    lines = ["📋 نتيجة العملية الجماعية\n"]
+    if error:
+        lines.append(f"⛔ فشل تطبيق التغييرات (لم يتم تعديل أي شيء):\n{error}")
+    elif summary:
+        lines.append(f"✅ مستخدمين تم تعديلهم: {summary['users']}")
+        lines.append(f"🆕 مستخدمين جدد: {summary['created']}")
+        lines.append(f"💰 حركات رصيد: {summary['balance_rows']}")
+    lines.append(f"❌ أسطر مرفوضة: {len(failures)}")
+    for where, reason in failures[:20]:
+        lines.append(f"• {where}: {reason}")
+    if len(failures) > 20:
+        lines.append(f"… و {len(failures) - 20} أخرى")
+    return "\n".join(lines)
+
+
+def parse_date_range(text: str) -> Optional[tuple[date, date]]:
+    """'2026-01-01 2026-01-31' or a single date; returns (start, end) inclusive."""
+    parts = text.replace(",", " ").split()
+    try:
+        dates = [date.fromisoformat(p) for p in parts]
+    except ValueError:
+        return None
+    if len(dates) == 1:
+        return dates[0], dates[0]
+    if len(dates) == 2 and dates[0] <= dates[1]:
+        return dates[0], dates[1]
+    return None
+
+
+def parse_balance_bound(s: str) -> float:
+    """A balance bound rounded to cents; ValueError unless finite and within users.balance (NUMERIC(12,2))."""
+    v = round(float(s), 2)
+    if not math.isfinite(v) or abs(v) >= BALANCE_BOUND_MAX:
+        raise ValueError(s)
+    return v
+
+
+def parse_balance_range(text: str) -> Optional[tuple[Optional[float], Optional[float]]]:
+    """'5 20' -> (5, 20); '5' -> (5, None); '-' as either bound leaves it open."""
+    parts = text.replace(",", " ").split()
+    if not 1 <= len(parts) <= 2:
+        return None
+    bounds = []
+    for p in parts:
+        if p == "-":
+            bounds.append(None)
+            continue
+        try:
+            bounds.append(parse_balance_bound(p))
+        except ValueError:
+            return None
+    lo, hi = (bounds + [None])[:2]
+    if lo is not None and hi is not None and lo > hi:
+        return None
+    return lo, hi
+
+
+def directory_filters(flt: str, arg: str) -> Optional[dict]:
+    """Callback filter code + argument -> db.search_users keyword arguments."""
+    if flt in DIR_FILTERS:
+        return dict(DIR_FILTERS[flt][1])
+    if flt == "pre" and arg.isdigit():
+        return {"id_prefix": arg}
+    if flt == "rng":
+        lo, _, hi = arg.partition("~")
+        try:
+            return {"min_balance": parse_balance_bound(lo) if lo else None,
+                    "max_balance": parse_balance_bound(hi) if hi else None}
+        except ValueError:
+            return None
+    return None
+
+
+def render_directory(flt: str, arg: str, after: Optional[int]) -> tuple[str, InlineKeyboardMarkup]:
+    filters_kw = directory_filters(flt, arg)
+    if filters_kw is None:
+        return "⚠️ فلتر غير معروف.", k_back(CB_A_DIR)
+    # page buttons carry the filter; the longest one ends with a 19-digit user id
+    if len(f"{CB_A_DIR_PREFIX}{flt}_{arg}_{'9' * 19}".encode()) > CALLBACK_DATA_MAX:
+        return "⚠️ الفلتر طويل جداً.", k_back(CB_A_DIR)
+
+    rows = db.search_users(**filters_kw, after=after, limit=DIR_PAGE_SIZE + 1)
+    has_next = len(rows) > DIR_PAGE_SIZE
+    rows = rows[:DIR_PAGE_SIZE]
+
+    if flt == "pre":
+        title = f"🔎 IDs تبدأ بـ {arg}"
+    elif flt == "rng":
+        lo, _, hi = arg.partition("~")
+        title = f"💰 الرصيد بين {lo or '-'} و {hi or '-'}"
+    else:
+        title = DIR_FILTERS[flt][0]
+
+    lines = [f"📇 دليل المستخدمين — {title}", ""]
+    if not rows:
+        lines.append("لا يوجد مستخدمون." if after is None else "لا توجد نتائج أخرى.")
+    for r in rows:
+        mark = "🚫" if r["is_banned"] else ("✅" if r["is_allowed"] else "⏳")
+        lines.append(f"{mark} {r['user_id']} | {float(r['balance']):.2f}$ | {r['updated_at']:%Y-%m-%d}")
+
+    buttons = [InlineKeyboardButton(f"👤 {r['user_id']}", callback_data=f"{CB_A_USER_PREFIX}{r['user_id']}") for r in rows]
+    kb = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    nav = []
+    if after is not None:
+        nav.append(InlineKeyboardButton("⏮ البداية", callback_data=f"{CB_A_DIR_PREFIX}{flt}_{arg}_0"))
+    if has_next:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"{CB_A_DIR_PREFIX}{flt}_{arg}_{rows[-1]['user_id']}"))
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton("🔙 رجوع", callback_data=CB_A_DIR)])
+    return "\n".join(lines), InlineKeyboardMarkup(kb)
+
+
+def render_user_card(uid: int) -> tuple[str, InlineKeyboardMarkup]:
+    u = db.ensure_user(uid)
+    status = "🚫 محظور" if u.is_banned else ("✅ مفعل" if u.is_allowed else "⏳ غير مفعل")
+    text = (
+        f"👤 المستخدم {u.user_id}\n\n"
+        f"💰 الرصيد: {u.balance:.2f}$\n"
+        f"📌 الحالة: {status}\n"
+        f"📆 اليوم: {u.daily_count}/{u.daily_limit}"
+    )
+    kb = [
+        [InlineKeyboardButton("⛔ إلغاء التفعيل", callback_data=f"{CB_A_USER_SET_PREFIX}{uid}_deny")
+         if u.is_allowed else
+         InlineKeyboardButton("✅ تفعيل", callback_data=f"{CB_A_USER_SET_PREFIX}{uid}_allow")],
+        [InlineKeyboardButton("✅ فك الحظر", callback_data=f"{CB_A_USER_SET_PREFIX}{uid}_unban")
+         if u.is_banned else
+         InlineKeyboardButton("🚫 حظر", callback_data=f"{CB_A_USER_SET_PREFIX}{uid}_ban")],
+        [InlineKeyboardButton("🔙 رجوع", callback_data=CB_A_DIR)],
+    ]
+    return text, InlineKeyboardMarkup(kb)
+
+
 def k_main(is_admin_user: bool) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton("💰 رصيدي", callback_data=CB_BAL)],
@@ -106,6 +492,8 @@ def k_admin_main() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("💰 إدارة الرصيد", callback_data=CB_A_WALLET)],
         [InlineKeyboardButton("📦 إدارة الطلبات", callback_data=CB_A_ORDERS)],
         [InlineKeyboardButton("📊 الإحصائيات", callback_data=CB_A_STATS)],
+        [InlineKeyboardButton("📈 مؤشرات الأداء", callback_data=CB_A_METRICS)],
+        [InlineKeyboardButton("📤 تصدير البيانات", callback_data=CB_A_EXPORT)],
         [InlineKeyboardButton("⚙️ إعدادات النظام", callback_data=CB_A_SETTINGS)],
         [InlineKeyboardButton("📝 إدارة الرسائل", callback_data=CB_A_MSGS)],
         [InlineKeyboardButton("🔙 رجوع", callback_data=CB_MAIN)],
@@ -115,7 +503,6 @@ def k_admin_main() -> InlineKeyboardMarkup:
 
 def gate_user(user_id: int) -> tuple[bool, str]:
     u = db.ensure_user(user_id)
-    db.reset_daily_if_needed(user_id)
 
     if u.is_banned:
         return False, "🚫 حسابك محظور."
@@ -126,11 +513,126 @@ def gate_user(user_id: int) -> tuple[bool, str]:
     return True, ""
 
 
+# Last rendered content per (tenant, chat_id, message_id), to skip edits that change nothing
+RENDER_CACHE_MAX = 20000
+_render_cache: "OrderedDict[tuple[int, int, int], str]" = OrderedDict()
+
+# Edit failures where sending a new message instead is the right thing to do
+_REPLY_ON_EDIT_ERRORS = (
+    "message to edit not found",
+    "message can't be edited",
+    "there is no text in the message to edit",
+)
+
+
+def _render_hash(text: str, reply_markup: Optional[InlineKeyboardMarkup], parse_mode) -> str:
+    payload = json.dumps([text, reply_markup.to_dict() if reply_markup else None, str(parse_mode)], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def _remember_render(key: tuple[int, int, int], h: str) -> None:
+    _render_cache[key] = h
+    _render_cache.move_to_end(key)
+    while len(_render_cache) > RENDER_CACHE_MAX:
+        _render_cache.popitem(last=False)
+
+
 async def safe_edit(query, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, parse_mode=None):
+    msg = query.message
+    key = (db.current_tenant(), msg.chat.id, msg.message_id) if msg else None
+    h = _render_hash(text, reply_markup, parse_mode)
+    if key and _render_cache.get(key) == h:
+        metrics.incr("tg_edits_skipped")
+        return
+
     try:
         await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
-    except Exception:
-        await query.message.reply_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        err = str(e).lower()
+        if "message is not modified" in err:
+            metrics.incr("tg_edits_not_modified")
+            if key:
+                _remember_render(key, h)
+            return
+        if msg is None or not any(s in err for s in _REPLY_ON_EDIT_ERRORS):
+            log.warning("edit_message_text failed: %s", e)
+            return
+        metrics.incr("tg_edit_fallback_replies")
+        await msg.reply_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return
+    except Exception as e:
+        # network errors etc.: a reply could duplicate an edit that actually went through
+        log.warning("edit_message_text failed: %s", e)
+        return
+
+    if key:
+        _remember_render(key, h)
+
+
+async def provider_call(query, processing_text: str, fn, *args, **kwargs):
+    """
+    Queue a provider call and show `processing_text` while it runs; the caller
+    replaces it with the result. Raises ProviderBusy if the queue is full.
+    """
+    fut = provider_jobs.submit(fn, *args, **kwargs)
+    metrics.incr(f"provider_calls.{db.current_tenant()}")
+    await safe_edit(query, processing_text)
+    result = await fut
+    # the provider has acted: recording it (charge, order row...) must not be cut short
+    db.use_deadline(None)
+    return result
+
+
+async def fetch_order_codes(orders: list[dict]) -> tuple[list[tuple[int, str]], int]:
+    """
+    Ask the provider for the status of each order, at most
+    ORDERS_REFRESH_CONCURRENCY at a time. Returns ([(order_id, sms_code)], failures).
+    """
+    sem = asyncio.Semaphore(ORDERS_REFRESH_CONCURRENCY)
+
+    async def fetch(o: dict) -> Optional[dict]:
+        async with sem:
+            try:
+                # admitted as a whole by on_callback; single calls must not be turned away halfway
+                return await provider_jobs.submit(provider.order_status, o["provider_order_id"], admit=False)
+            except Exception as e:
+                log.warning("refresh of order #%s failed: %s", o["id"], e)
+                return None
+
+    metrics.incr(f"provider_calls.{db.current_tenant()}", len(orders))
+    results = await asyncio.gather(*(fetch(o) for o in orders))
+    codes = []
+    for o, st in zip(orders, results):
+        sms = st and (st.get("sms_code") or st.get("code") or st.get("otp"))
+        if sms:
+            codes.append((o["id"], str(sms)))
+    return codes, sum(st is None for st in results)
+
+
+def render_orders(user_id: int, header: str = "") -> tuple[str, InlineKeyboardMarkup]:
+    orders = db.list_orders_for_user(user_id, limit=10)
+    if not orders:
+        return "📩 لا توجد طلبات بعد.", k_back(CB_MAIN)
+
+    lines = [header] if header else []
+    lines.append("📩 **طلباتي (آخر 10)**\n")
+    rows = []
+    for o in orders:
+        oid = o["id"]
+        status = o.get("status") or "-"
+        num = o.get("phone_number") or "-"
+        code = f" | 🔐 `{o['sms_code']}`" if o.get("sms_code") else ""
+        lines.append(f"• #{oid} | {status} | `{num}`{code}")
+
+        rows.append([
+            InlineKeyboardButton("🔄 تحديث", callback_data=f"{CB_ORDER_REFRESH_PREFIX}{oid}"),
+            InlineKeyboardButton("❌ إلغاء", callback_data=f"{CB_ORDER_CANCEL_PREFIX}{oid}"),
+        ])
+
+    if sum(o.get("status") == "waiting" for o in orders) > 1:
+        rows.append([InlineKeyboardButton("🔄 تحديث كل الطلبات المنتظرة", callback_data=CB_ORDERS_REFRESH_ALL)])
+    rows.append([InlineKeyboardButton("🔙 رجوع", callback_data=CB_MAIN)])
+    return "\n".join(lines), InlineKeyboardMarkup(rows)
 
 
 def k_order_actions(order_id: int) -> InlineKeyboardMarkup:
@@ -144,28 +646,74 @@ def k_order_actions(order_id: int) -> InlineKeyboardMarkup:
 # ------------------- /start -------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.ensure_user(user_id)
+    if not flood_ok(user_id, "text"):
+        return
+    await asyncio.to_thread(db.ensure_user, user_id)
 
-    ok, msg = gate_user(user_id)
+    ok, msg = await asyncio.to_thread(gate_user, user_id)
     if not ok:
         await update.message.reply_text(msg)
         return
 
     await update.message.reply_text(
-        db.get_start_message(),
+        await asyncio.to_thread(db.get_start_message),
         reply_markup=k_main(is_admin(user_id))
     )
 
 
+# ------------------- /profile (admin) -------------------
+async def on_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    arg = context.args[0] if context.args else str(PROFILE_DEFAULT_SECONDS)
+    if not arg.isdigit() or not 1 <= int(arg) <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"⛔ الاستخدام: /profile N (ثوانٍ من 1 إلى {PROFILE_MAX_SECONDS})")
+        return
+    seconds = int(arg)
+    await update.message.reply_text(f"⏳ جاري قياس الأداء لمدة {seconds} ثانية...")
+    # off the update processor, so this admin's next updates are not held up meanwhile
+    context.application.create_task(run_profile(context, update.effective_chat.id, seconds), update=update)
+    db.admin_log(user_id, "profile", {"seconds": seconds})
+
+
+async def run_profile(context: ContextTypes.DEFAULT_TYPE, chat_id: int, seconds: int):
+    prof = await asyncio.to_thread(profiler.sample, seconds)
+    if prof is None:
+        await context.bot.send_message(chat_id=chat_id, text="⛔ هناك قياس آخر قيد التشغيل.")
+        return
+    text = prof.summary()
+    if len(text) > 4000:
+        text = text[:4000] + "\n…"
+    await context.bot.send_message(chat_id=chat_id, text=f"🔬 نتيجة القياس\n\n{text}")
+    await context.bot.send_document(
+        chat_id=chat_id,
+        document=prof.collapsed().encode(),
+        filename=f"profile_{datetime.now():%Y%m%d_%H%M%S}.txt",
+        caption="Collapsed stacks (flamegraph.pl / speedscope)",
+    )
+
+
 # ------------------- Callback router -------------------
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
-    data = query.data
+    data = query.data or ""
+
+    # Flood control and provider admission before any DB/provider work
+    route = route_of(data)
+    if not flood_ok(user_id, route):
+        await query.answer("⏳ طلبات كثيرة، انتظر قليلاً ثم حاول مجدداً.")
+        return
+    if route in PROVIDER_ROUTES and provider_jobs.is_busy():
+        metrics.incr("provider_queue_rejected")
+        await query.answer(PROVIDER_BUSY_TEXT, show_alert=True)
+        return
+    await query.answer()
+    db.use_deadline(ROUTE_DEADLINES[route])
 
     # Gate for non-admin
-    ok, msg = gate_user(user_id)
+    ok, msg = await asyncio.to_thread(gate_user, user_id)
     if not ok and data != CB_ADMIN:
         await safe_edit(query, msg)
         return
@@ -173,13 +721,18 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # -------- Orders: Refresh / Cancel handlers --------
     if data.startswith(CB_ORDER_REFRESH_PREFIX):
         order_id = int(data.replace(CB_ORDER_REFRESH_PREFIX, ""))
-        o = db.get_order(order_id, user_id=None if is_admin(user_id) else user_id)
+        o = await asyncio.to_thread(db.get_order, order_id, user_id=None if is_admin(user_id) else user_id)
         if not o:
             await safe_edit(query, "⛔ الطلب غير موجود.", reply_markup=k_back(CB_MAIN))
             return
 
         try:
-            st = provider.order_status(o["provider_order_id"])
+            st = await provider_call(query, f"⏳ جاري تحديث الطلب #{order_id}...", provider.order_status, o["provider_order_id"])
+        except db.DeadlineExceeded:
+            raise
+        except (ProviderBusy, provider.ProviderRateLimited):
+            await safe_edit(query, PROVIDER_BUSY_TEXT, reply_markup=k_order_actions(order_id))
+            return
         except Exception as e:
             await safe_edit(query, f"⛔ فشل التحديث من المزوّد:\n{e}", reply_markup=k_back(CB_MAIN))
             return
@@ -187,8 +740,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sms = st.get("sms_code") or st.get("code") or st.get("otp")
         state = st.get("state") or st.get("status") or o.get("status") or "waiting"
 
-        if sms:
-            db.set_order_sms(order_id, str(sms))
+        # a code is only recorded and shown for an order that is (or already was) received
+        if sms and (o["status"] == "received" or await asyncio.to_thread(db.set_order_sms, order_id, str(sms))):
             await safe_edit(
                 query,
                 f"✅ وصل الكود للطلب #{order_id}\n\n"
@@ -200,8 +753,9 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ]),
                 parse_mode=ParseMode.MARKDOWN
             )
+        elif sms or o["status"] != "waiting":
+            await safe_edit(query, f"⛔ الطلب #{order_id} لم يعد بانتظار الكود (الحالة: {o['status']}).", reply_markup=k_back(CB_ORDERS))
         else:
-            db.set_order_status(order_id, "waiting")
             await safe_edit(
                 query,
                 f"⏳ لم يصل كود بعد للطلب #{order_id}\n"
@@ -213,35 +767,43 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith(CB_ORDER_CANCEL_PREFIX):
         order_id = int(data.replace(CB_ORDER_CANCEL_PREFIX, ""))
-        o = db.get_order(order_id, user_id=None if is_admin(user_id) else user_id)
+        o = await asyncio.to_thread(db.get_order, order_id, user_id=None if is_admin(user_id) else user_id)
         if not o:
             await safe_edit(query, "⛔ الطلب غير موجود.", reply_markup=k_back(CB_MAIN))
             return
+        if o["status"] != "waiting":
+            await safe_edit(query, f"⛔ لا يمكن إلغاء الطلب #{order_id} (الحالة: {o['status']}).", reply_markup=k_back(CB_ORDERS))
+            return
 
         try:
-            provider.cancel_order(o["provider_order_id"])
+            await provider_call(query, f"⏳ جاري إلغاء الطلب #{order_id}...", provider.cancel_order, o["provider_order_id"])
+        except db.DeadlineExceeded:
+            raise
+        except (ProviderBusy, provider.ProviderRateLimited):
+            await safe_edit(query, PROVIDER_BUSY_TEXT, reply_markup=k_order_actions(order_id))
+            return
         except Exception as e:
             await safe_edit(query, f"⛔ فشل الإلغاء من المزوّد:\n{e}", reply_markup=k_back(CB_MAIN))
             return
 
-        db.set_order_cancelled(order_id)
+        if not await asyncio.to_thread(db.set_order_cancelled, order_id):
+            await safe_edit(query, f"⛔ تغيّرت حالة الطلب #{order_id} أثناء الإلغاء، راجع طلباتك.", reply_markup=k_back(CB_ORDERS))
+            return
         await safe_edit(query, f"✅ تم إلغاء الطلب #{order_id}.", reply_markup=k_back(CB_MAIN))
         return
 
     # -------- Main navigation --------
     if data == CB_MAIN:
-        await safe_edit(query, db.get_start_message(), reply_markup=k_main(is_admin(user_id)))
+        await safe_edit(query, await asyncio.to_thread(db.get_start_message), reply_markup=k_main(is_admin(user_id)))
         return
 
     if data == CB_BAL:
-        u = db.ensure_user(user_id)
+        u = await asyncio.to_thread(db.ensure_user, user_id)
         await safe_edit(query, f"💰 رصيدك الحالي: **{u.balance:.2f}$**", reply_markup=k_back(CB_MAIN), parse_mode=ParseMode.MARKDOWN)
         return
 
     if data == CB_PROFILE:
-        u = db.ensure_user(user_id)
-        db.reset_daily_if_needed(user_id)
-        u = db.ensure_user(user_id)
+        u = await asyncio.to_thread(db.ensure_user, user_id)
         text = (
             f"👤 **حسابي**\n\n"
             f"🆔 ID: `{u.user_id}`\n"
@@ -267,11 +829,28 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # -------- Buy number (REAL) --------
     if data == CB_BUY:
-        u = db.ensure_user(user_id)
-        db.reset_daily_if_needed(user_id)
-        u = db.ensure_user(user_id)
+        items = catalog.in_stock()
+        if not items:
+            await safe_edit(query, "⛔ لا توجد أرقام متاحة حالياً. حاول لاحقاً.", reply_markup=k_back(CB_MAIN))
+            return
+        default_price = await asyncio.to_thread(db.get_price_usd)
+        rows = [
+            [InlineKeyboardButton(f"{it.title} — {catalog.price(it, default_price):.2f}$", callback_data=f"{CB_BUY_ITEM_PREFIX}{it.id}")]
+            for it in items
+        ]
+        rows.append([InlineKeyboardButton("🔙 رجوع", callback_data=CB_MAIN)])
+        await safe_edit(query, "📲 اختر الدولة / الخدمة:", reply_markup=InlineKeyboardMarkup(rows))
+        return
+
+    if data.startswith(CB_BUY_ITEM_PREFIX):
+        item = catalog.get(int(data.replace(CB_BUY_ITEM_PREFIX, "")))
+        if item is None or not catalog.available(item):
+            await safe_edit(query, "⛔ هذا الخيار غير متاح حالياً.", reply_markup=k_back(CB_BUY))
+            return
 
-        price = db.get_price_usd()
+        u = await asyncio.to_thread(db.ensure_user, user_id)
+
+        price = catalog.price(item, await asyncio.to_thread(db.get_price_usd))
 
         if u.daily_count >= u.daily_limit and not is_admin(user_id):
             await safe_edit(query, "⛔ وصلت للحد اليومي. حاول غداً.", reply_markup=k_back(CB_MAIN))
@@ -281,24 +860,41 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await safe_edit(query, f"رصيدك غير كافي.\nالسعر: {price:.2f}$", reply_markup=k_back(CB_MAIN))
             return
 
-        # ثابت حسب طلبك (UK فقط) + service ثابت (عدله حسب مزودك إذا يلزم)
-        country = "UK"
-        service_code = "UK_SERVICE"
+        country = item.country
+        service_code = item.service_code
 
         try:
-            res = provider.create_order(service=service_code, country=country)
+            res = await provider_call(query, "⏳ جاري إنشاء الطلب...", provider.create_order, service=service_code, country=country)
             provider_order_id = res["provider_order_id"]
             number = res["number"]
+        except db.DeadlineExceeded:
+            raise
+        except (ProviderBusy, provider.ProviderRateLimited):
+            await safe_edit(query, PROVIDER_BUSY_TEXT, reply_markup=k_back(CB_MAIN))
+            return
+        except provider.ProviderOutOfStock:
+            # hidden until the next availability refresh; other failures leave the catalog alone
+            catalog.mark_sold_out(item)
+            await safe_edit(query, "⛔ نفدت الأرقام لهذا الخيار حالياً. حاول لاحقاً.", reply_markup=k_back(CB_BUY))
+            return
         except Exception as e:
             await safe_edit(query, f"⛔ فشل إنشاء الطلب من المزوّد:\n{e}", reply_markup=k_back(CB_MAIN))
             return
 
         # خصم الرصيد بعد نجاح إنشاء الطلب
         if not is_admin(user_id):
-            db.deduct_balance(user_id, price, kind="deduct", note="Buy UK number")
-            db.increment_daily(user_id)
+            if not await asyncio.to_thread(db.deduct_balance, user_id, price, kind="deduct", note=f"Buy {country} number"):
+                # the balance changed since the check above; release the number instead of handing it out unpaid
+                try:
+                    await provider_jobs.submit(provider.cancel_order, provider_order_id, admit=False)
+                except Exception as e:
+                    log.warning("buy: cancel of unpaid provider order %s failed: %s", provider_order_id, e)
+                await safe_edit(query, f"رصيدك غير كافي.\nالسعر: {price:.2f}$", reply_markup=k_back(CB_MAIN))
+                return
+            await asyncio.to_thread(db.increment_daily, user_id)
 
-        order_id = db.create_order_row(
+        order_id = await asyncio.to_thread(
+            db.create_order_row,
             user_id=user_id,
             country=country,
             service_code=service_code,
@@ -320,26 +916,29 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # -------- Orders list --------
     if data == CB_ORDERS:
-        orders = db.list_orders_for_user(user_id, limit=10)
-        if not orders:
-            await safe_edit(query, "📩 لا توجد طلبات بعد.", reply_markup=k_back(CB_MAIN))
-            return
-
-        lines = ["📩 **طلباتي (آخر 10)**\n"]
-        rows = []
-        for o in orders:
-            oid = o["id"]
-            status = o.get("status") or "-"
-            num = o.get("phone_number") or "-"
-            lines.append(f"• #{oid} | {status} | `{num}`")
+        text, kb = await asyncio.to_thread(render_orders, user_id)
+        await safe_edit(query, text, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+        return
 
-            rows.append([
-                InlineKeyboardButton("🔄 تحديث", callback_data=f"{CB_ORDER_REFRESH_PREFIX}{oid}"),
-                InlineKeyboardButton("❌ إلغاء", callback_data=f"{CB_ORDER_CANCEL_PREFIX}{oid}"),
-            ])
+    if data == CB_ORDERS_REFRESH_ALL:
+        waiting = [o for o in await asyncio.to_thread(db.list_orders_for_user, user_id, limit=ORDERS_REFRESH_MAX, status="waiting")
+                   if o.get("provider_order_id")]
+        if not waiting:
+            text, kb = await asyncio.to_thread(render_orders, user_id, "ℹ️ لا توجد طلبات بانتظار الكود.\n")
+            await safe_edit(query, text, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+            return
 
-        rows.append([InlineKeyboardButton("🔙 رجوع", callback_data=CB_MAIN)])
-        await safe_edit(query, "\n".join(lines), reply_markup=InlineKeyboardMarkup(rows), parse_mode=ParseMode.MARKDOWN)
+        await safe_edit(query, f"⏳ جاري تحديث {len(waiting)} طلب...")
+        codes, failed = await fetch_order_codes(waiting)
+        # codes already fetched are recorded even if the route ran out of time meanwhile
+        db.use_deadline(None)
+        received = await asyncio.to_thread(db.set_orders_sms, codes)
+        metrics.incr("orders_refresh_all")
+        header = f"✅ وصل الكود لـ {received} طلب" if received else "⏳ لم يصل أي كود جديد"
+        if failed:
+            header += f" (تعذّر تحديث {failed})"
+        text, kb = await asyncio.to_thread(render_orders, user_id, header + "\n")
+        await safe_edit(query, text, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
         return
 
     # -------- Topup --------
@@ -358,7 +957,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if data == "topup_req":
-        context.user_data["await_topup_amount"] = True
+        conversations.start(conv_key(user_id), "topup")
         await safe_edit(query, "✍️ اكتب مبلغ الشحن المطلوب (مثال: 5 أو 10.5):", reply_markup=k_back(CB_TOPUP))
         return
 
@@ -381,10 +980,87 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("⛔ إلغاء التفعيل", callback_data=CB_A_DENY)],
             [InlineKeyboardButton("🚫 حظر مستخدم", callback_data=CB_A_BAN)],
             [InlineKeyboardButton("✅ فك الحظر", callback_data=CB_A_UNBAN)],
+            [InlineKeyboardButton("📋 إدارة جماعية", callback_data=CB_A_BULK)],
+            [InlineKeyboardButton("📇 دليل المستخدمين", callback_data=CB_A_DIR)],
             [InlineKeyboardButton("🔙 رجوع", callback_data=CB_ADMIN)],
         ]), parse_mode=ParseMode.MARKDOWN)
         return
 
+    if data == CB_A_DIR:
+        kb = [[InlineKeyboardButton(label, callback_data=f"{CB_A_DIR_PREFIX}{code}__0")] for code, (label, _) in DIR_FILTERS.items()]
+        kb.append([InlineKeyboardButton("🔎 بحث ببداية الـ ID", callback_data=CB_A_DIR_SEARCH)])
+        kb.append([InlineKeyboardButton("💵 نطاق رصيد", callback_data=CB_A_DIR_RANGE)])
+        kb.append([InlineKeyboardButton("🔙 رجوع", callback_data=CB_A_USERS)])
+        await safe_edit(query, "📇 دليل المستخدمين\n\nاختر الفلتر:", reply_markup=InlineKeyboardMarkup(kb))
+        return
+
+    if data.startswith(CB_A_DIR_PREFIX):
+        parts = data.replace(CB_A_DIR_PREFIX, "").split("_")
+        if len(parts) != 3 or not parts[2].isdigit():
+            await safe_edit(query, "⚠️ أمر غير معروف.", reply_markup=k_back(CB_A_DIR))
+            return
+        flt, arg, after = parts
+        text, kb = await asyncio.to_thread(render_directory, flt, arg, int(after) or None)
+        await safe_edit(query, text, reply_markup=kb)
+        return
+
+    if data == CB_A_DIR_SEARCH:
+        conversations.start(conv_key(user_id), "dir_search")
+        await safe_edit(query, "🔎 أرسل بداية الـ ID (أرقام فقط):", reply_markup=k_back(CB_A_DIR))
+        return
+
+    if data == CB_A_DIR_RANGE:
+        conversations.start(conv_key(user_id), "dir_range")
+        await safe_edit(query, "💵 أرسل حدّي الرصيد مثل: `5 20`\nاستخدم `-` لحد مفتوح، مثل: `- 1`", reply_markup=k_back(CB_A_DIR), parse_mode=ParseMode.MARKDOWN)
+        return
+
+    if data.startswith(CB_A_USER_PREFIX):
+        uid = data.replace(CB_A_USER_PREFIX, "")
+        if not uid.isdigit():
+            await safe_edit(query, "⚠️ أمر غير معروف.", reply_markup=k_back(CB_A_DIR))
+            return
+        text, kb = await asyncio.to_thread(render_user_card, int(uid))
+        await safe_edit(query, text, reply_markup=kb)
+        return
+
+    if data.startswith(CB_A_USER_SET_PREFIX):
+        uid, _, action = data.replace(CB_A_USER_SET_PREFIX, "").partition("_")
+        if not uid.isdigit() or action not in USER_SETTERS:
+            await safe_edit(query, "⚠️ أمر غير معروف.", reply_markup=k_back(CB_A_DIR))
+            return
+        uid = int(uid)
+        setter, value, log_action, notice = USER_SETTERS[action]
+        await asyncio.to_thread(setter, uid, value)
+        db.admin_log(user_id, log_action, {"user_id": uid})
+        if notice:
+            try:
+                await context.bot.send_message(chat_id=uid, text=notice)
+            except Exception:
+                pass
+        text, kb = await asyncio.to_thread(render_user_card, uid)
+        await safe_edit(query, text, reply_markup=kb)
+        return
+
+    if data == CB_A_BULK:
+        await safe_edit(query, "📋 **إدارة جماعية**\n\nاختر الإجراء ثم أرسل قائمة IDs، أو اختر CSV وأرسل ملفاً بالأعمدة:\n`user_id,action,limit,balance_delta`", reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ تفعيل قائمة", callback_data=f"{CB_A_BULK_PREFIX}allow")],
+            [InlineKeyboardButton("⛔ إلغاء تفعيل قائمة", callback_data=f"{CB_A_BULK_PREFIX}deny")],
+            [InlineKeyboardButton("🚫 حظر قائمة", callback_data=f"{CB_A_BULK_PREFIX}ban")],
+            [InlineKeyboardButton("✅ فك حظر قائمة", callback_data=f"{CB_A_BULK_PREFIX}unban")],
+            [InlineKeyboardButton("📄 ملف CSV", callback_data=f"{CB_A_BULK_PREFIX}csv")],
+            [InlineKeyboardButton("🔙 رجوع", callback_data=CB_A_USERS)],
+        ]), parse_mode=ParseMode.MARKDOWN)
+        return
+
+    if data.startswith(CB_A_BULK_PREFIX):
+        bulk_action = data.replace(CB_A_BULK_PREFIX, "")
+        conversations.start(conv_key(user_id), "bulk", bulk_action=bulk_action if bulk_action in BULK_ACTIONS else None)
+        if bulk_action in BULK_ACTIONS:
+            await safe_edit(query, "🆔 أرسل قائمة IDs (مفصولة بمسافات أو أسطر أو فواصل)، أو ملف CSV:", reply_markup=k_back(CB_A_BULK))
+        else:
+            await safe_edit(query, "📄 أرسل ملف CSV أو الصق الأسطر بالصيغة:\n`user_id,action,limit,balance_delta`", reply_markup=k_back(CB_A_BULK), parse_mode=ParseMode.MARKDOWN)
+        return
+
     if data == CB_A_WALLET:
         await safe_edit(query, "💰 **إدارة الرصيد**", reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("➕ إضافة رصيد", callback_data=CB_A_ADD_BAL)],
@@ -399,7 +1075,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if data == CB_A_STATS:
-        s = db.stats_today()
+        s = await asyncio.to_thread(db.stats_today)
         text = (
             "📊 **إحصائيات اليوم**\n\n"
             f"👥 المستخدمين: {s['users_count']}\n"
@@ -410,9 +1086,35 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_edit(query, text, reply_markup=k_back(CB_ADMIN), parse_mode=ParseMode.MARKDOWN)
         return
 
+    if data == CB_A_METRICS:
+        metrics.set_gauge("flood_buckets", len(flood))
+        await safe_edit(query, f"📈 مؤشرات الأداء\n\n{metrics.render_text()}", reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 تحديث", callback_data=CB_A_METRICS)],
+            [InlineKeyboardButton("🔙 رجوع", callback_data=CB_ADMIN)],
+        ]))
+        return
+
+    if data == CB_A_EXPORT:
+        await safe_edit(query, "📤 **تصدير البيانات**\n\nاختر الجدول المطلوب تصديره (CSV مضغوط):", reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔁 حركات الرصيد", callback_data=f"{CB_A_EXPORT_PREFIX}transactions")],
+            [InlineKeyboardButton("📦 الطلبات", callback_data=f"{CB_A_EXPORT_PREFIX}orders")],
+            [InlineKeyboardButton("💳 طلبات الشحن", callback_data=f"{CB_A_EXPORT_PREFIX}topups")],
+            [InlineKeyboardButton("🔙 رجوع", callback_data=CB_ADMIN)],
+        ]), parse_mode=ParseMode.MARKDOWN)
+        return
+
+    if data.startswith(CB_A_EXPORT_PREFIX):
+        kind = data.replace(CB_A_EXPORT_PREFIX, "")
+        if kind not in db.EXPORTS:
+            await safe_edit(query, "⚠️ أمر غير معروف.", reply_markup=k_back(CB_A_EXPORT))
+            return
+        conversations.start(conv_key(user_id), "export", kind=kind)
+        await safe_edit(query, "📅 أرسل الفترة بالصيغة:\n`2026-01-01 2026-01-31`\nأو تاريخاً واحداً.", reply_markup=k_back(CB_A_EXPORT), parse_mode=ParseMode.MARKDOWN)
+        return
+
     if data == CB_A_SETTINGS:
-        price = db.get_price_usd()
-        maint = "✅ ON" if db.is_maintenance() else "❌ OFF"
+        price = await asyncio.to_thread(db.get_price_usd)
+        maint = "✅ ON" if await asyncio.to_thread(db.is_maintenance) else "❌ OFF"
         await safe_edit(query, f"⚙️ **إعدادات النظام**\n\nالسعر الحالي: {price:.2f}$\nالصيانة: {maint}", reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("💲 تغيير السعر", callback_data=CB_A_SET_PRICE)],
             [InlineKeyboardButton("📆 تحديد حد يومي لمستخدم", callback_data=CB_A_SET_LIMIT)],
@@ -432,20 +1134,20 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Admin: maintenance toggle
     if data == CB_A_MAINT_ON:
-        db.set_setting("maintenance", "1")
+        await asyncio.to_thread(db.set_setting, "maintenance", "1")
         db.admin_log(user_id, "maintenance_on", {})
         await safe_edit(query, "✅ تم تشغيل وضع الصيانة.", reply_markup=k_back(CB_A_SETTINGS))
         return
 
     if data == CB_A_MAINT_OFF:
-        db.set_setting("maintenance", "0")
+        await asyncio.to_thread(db.set_setting, "maintenance", "0")
         db.admin_log(user_id, "maintenance_off", {})
         await safe_edit(query, "✅ تم إيقاف وضع الصيانة.", reply_markup=k_back(CB_A_SETTINGS))
         return
 
     # Admin: pending topups list
     if data == CB_A_TOPUP_REQS:
-        pending = db.list_pending_topups()
+        pending = await asyncio.to_thread(db.list_pending_topups)
         if not pending:
             await safe_edit(query, "🔔 لا توجد طلبات شحن معلّقة.", reply_markup=k_back(CB_ADMIN))
             return
@@ -466,13 +1168,13 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith(CB_A_APPROVE_PREFIX) or data.startswith(CB_A_REJECT_PREFIX):
         approve = data.startswith(CB_A_APPROVE_PREFIX)
         rid = int(data.split("_")[-1])
-        decided = db.decide_topup(rid, user_id, approve=approve)
+        decided = await asyncio.to_thread(db.decide_topup, rid, user_id, approve=approve)
         if not decided:
             await safe_edit(query, "⛔ الطلب غير موجود أو تم اتخاذ قرار مسبقاً.", reply_markup=k_back(CB_ADMIN))
             return
         tuid, amt = decided
         if approve:
-            db.add_balance(tuid, amt, kind="topup", note=f"Topup approved #{rid}")
+            await asyncio.to_thread(db.add_balance, tuid, amt, kind="topup", note=f"Topup approved #{rid}")
             db.admin_log(user_id, "topup_approved", {"req_id": rid, "user_id": tuid, "amount": amt})
             try:
                 await context.bot.send_message(chat_id=tuid, text=f"✅ تم شحن رصيدك بمبلغ {amt:.2f}$")
@@ -491,43 +1193,43 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Admin action prompts (handled in on_text)
     if data in (CB_A_ADD_BAL, CB_A_DED_BAL, CB_A_ALLOW, CB_A_DENY, CB_A_BAN, CB_A_UNBAN, CB_A_SET_PRICE, CB_A_SET_LIMIT, CB_A_EDIT_START, CB_A_BROADCAST):
         if data == CB_A_ADD_BAL:
-            context.user_data["admin_action"] = "addbal"
+            conversations.start(conv_key(user_id), "addbal")
             await safe_edit(query, "🆔 أرسل ID المستخدم:", reply_markup=k_back(CB_ADMIN))
             return
         if data == CB_A_DED_BAL:
-            context.user_data["admin_action"] = "dedbal"
+            conversations.start(conv_key(user_id), "dedbal")
             await safe_edit(query, "🆔 أرسل ID المستخدم:", reply_markup=k_back(CB_ADMIN))
             return
         if data == CB_A_ALLOW:
-            context.user_data["admin_action"] = "allow"
+            conversations.start(conv_key(user_id), "allow")
             await safe_edit(query, "🆔 أرسل ID المستخدم لتفعيله:", reply_markup=k_back(CB_ADMIN))
             return
         if data == CB_A_DENY:
-            context.user_data["admin_action"] = "deny"
+            conversations.start(conv_key(user_id), "deny")
             await safe_edit(query, "🆔 أرسل ID المستخدم لإلغاء تفعيله:", reply_markup=k_back(CB_ADMIN))
             return
         if data == CB_A_BAN:
-            context.user_data["admin_action"] = "ban"
+            conversations.start(conv_key(user_id), "ban")
             await safe_edit(query, "🆔 أرسل ID المستخدم لحظره:", reply_markup=k_back(CB_ADMIN))
             return
         if data == CB_A_UNBAN:
-            context.user_data["admin_action"] = "unban"
+            conversations.start(conv_key(user_id), "unban")
             await safe_edit(query, "🆔 أرسل ID المستخدم لفك الحظر:", reply_markup=k_back(CB_ADMIN))
             return
         if data == CB_A_SET_PRICE:
-            context.user_data["admin_action"] = "setprice"
+            conversations.start(conv_key(user_id), "setprice")
             await safe_edit(query, "💲 أرسل السعر الجديد (مثال: 0.5):", reply_markup=k_back(CB_ADMIN))
             return
         if data == CB_A_SET_LIMIT:
-            context.user_data["admin_action"] = "setlimit_uid"
+            conversations.start(conv_key(user_id), "setlimit_uid")
             await safe_edit(query, "🆔 أرسل ID المستخدم لتحديد حدّه اليومي:", reply_markup=k_back(CB_ADMIN))
             return
         if data == CB_A_EDIT_START:
-            context.user_data["admin_action"] = "editstart"
+            conversations.start(conv_key(user_id), "editstart")
             await safe_edit(query, "✏️ أرسل رسالة /start الجديدة كاملة:", reply_markup=k_back(CB_ADMIN))
             return
         if data == CB_A_BROADCAST:
-            context.user_data["admin_action"] = "broadcast"
+            conversations.start(conv_key(user_id), "broadcast")
             await safe_edit(query, "📢 أرسل الرسالة التي تريد إرسالها للجميع:", reply_markup=k_back(CB_ADMIN))
             return
 
@@ -537,12 +1239,16 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------- Text handler -------------------
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    if not flood_ok(user_id, "text"):
+        return
     text = (update.message.text or "").strip()
+    key = conv_key(user_id)
+    state = conversations.get(key)
 
     # Topup request flow
-    if context.user_data.get("await_topup_amount"):
-        context.user_data["await_topup_amount"] = False
-        ok, msg = gate_user(user_id)
+    if state and state["flow"] == "topup":
+        conversations.end(key)
+        ok, msg = await asyncio.to_thread(gate_user, user_id)
         if not ok:
             await update.message.reply_text(msg)
             return
@@ -552,7 +1258,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⛔ صيغة غير صحيحة. اكتب رقم مثل: 5 أو 10.5")
             return
 
-        req_id = db.create_topup_request(user_id, amt)
+        req_id = await asyncio.to_thread(db.create_topup_request, user_id, amt)
 
         # notify admins
         for aid in ADMIN_IDS:
@@ -569,15 +1275,15 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Admin prompts
-    if is_admin(user_id) and context.user_data.get("admin_action"):
-        action = context.user_data.get("admin_action")
+    if is_admin(user_id) and state:
+        action = state["flow"]
 
         if action == "addbal":
-            if "admin_uid" not in context.user_data:
+            if "admin_uid" not in state:
                 if not text.isdigit():
                     await update.message.reply_text("⛔ أرسل ID صحيح (أرقام فقط).")
                     return
-                context.user_data["admin_uid"] = int(text)
+                conversations.update(key, admin_uid=int(text))
                 await update.message.reply_text("💰 أرسل المبلغ للإضافة (مثال: 5 أو 10.5):")
                 return
             else:
@@ -585,9 +1291,9 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if amt is None:
                     await update.message.reply_text("⛔ مبلغ غير صحيح.")
                     return
-                uid = context.user_data.pop("admin_uid")
-                context.user_data.pop("admin_action", None)
-                db.add_balance(uid, amt, kind="adjust", note=f"Admin add by {user_id}")
+                uid = state["admin_uid"]
+                conversations.end(key)
+                await asyncio.to_thread(db.add_balance, uid, amt, kind="adjust", note=f"Admin add by {user_id}")
                 db.admin_log(user_id, "add_balance", {"user_id": uid, "amount": amt})
                 try:
                     await context.bot.send_message(chat_id=uid, text=f"✅ تم إضافة {amt:.2f}$ إلى رصيدك.")
@@ -597,11 +1303,11 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
         if action == "dedbal":
-            if "admin_uid" not in context.user_data:
+            if "admin_uid" not in state:
                 if not text.isdigit():
                     await update.message.reply_text("⛔ أرسل ID صحيح (أرقام فقط).")
                     return
-                context.user_data["admin_uid"] = int(text)
+                conversations.update(key, admin_uid=int(text))
                 await update.message.reply_text("➖ أرسل المبلغ للخصم (مثال: 1 أو 2.5):")
                 return
             else:
@@ -609,9 +1315,11 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if amt is None:
                     await update.message.reply_text("⛔ مبلغ غير صحيح.")
                     return
-                uid = context.user_data.pop("admin_uid")
-                context.user_data.pop("admin_action", None)
-                db.deduct_balance(uid, amt, kind="adjust", note=f"Admin deduct by {user_id}")
+                uid = state["admin_uid"]
+                conversations.end(key)
+                if not await asyncio.to_thread(db.deduct_balance, uid, amt, kind="adjust", note=f"Admin deduct by {user_id}"):
+                    await update.message.reply_text("⛔ رصيد المستخدم أقل من المبلغ (أو المستخدم غير موجود). لم يتم الخصم.")
+                    return
                 db.admin_log(user_id, "deduct_balance", {"user_id": uid, "amount": amt})
                 try:
                     await context.bot.send_message(chat_id=uid, text=f"ℹ️ تم خصم {amt:.2f}$ من رصيدك.")
@@ -625,11 +1333,11 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("⛔ أرسل ID صحيح (أرقام فقط).")
                 return
             uid = int(text)
-            context.user_data.pop("admin_action", None)
+            conversations.end(key)
 
             if action == "allow":
-                db.ensure_user(uid)
-                db.set_allowed(uid, True)
+                await asyncio.to_thread(db.ensure_user, uid)
+                await asyncio.to_thread(db.set_allowed, uid, True)
                 db.admin_log(user_id, "allow_user", {"user_id": uid})
                 await update.message.reply_text("✅ تم تفعيل المستخدم.")
                 try:
@@ -639,15 +1347,15 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             if action == "deny":
-                db.ensure_user(uid)
-                db.set_allowed(uid, False)
+                await asyncio.to_thread(db.ensure_user, uid)
+                await asyncio.to_thread(db.set_allowed, uid, False)
                 db.admin_log(user_id, "deny_user", {"user_id": uid})
                 await update.message.reply_text("✅ تم إلغاء تفعيل المستخدم.")
                 return
 
             if action == "ban":
-                db.ensure_user(uid)
-                db.set_banned(uid, True)
+                await asyncio.to_thread(db.ensure_user, uid)
+                await asyncio.to_thread(db.set_banned, uid, True)
                 db.admin_log(user_id, "ban_user", {"user_id": uid})
                 await update.message.reply_text("✅ تم حظر المستخدم.")
                 try:
@@ -657,8 +1365,8 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             if action == "unban":
-                db.ensure_user(uid)
-                db.set_banned(uid, False)
+                await asyncio.to_thread(db.ensure_user, uid)
+                await asyncio.to_thread(db.set_banned, uid, False)
                 db.admin_log(user_id, "unban_user", {"user_id": uid})
                 await update.message.reply_text("✅ تم فك حظر المستخدم.")
                 try:
@@ -667,13 +1375,51 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     pass
                 return
 
+        if action == "bulk":
+            default_action = state["bulk_action"]
+            conversations.end(key)
+            await apply_bulk(update, user_id, text, default_action, csv_mode=default_action is None)
+            return
+
+        if action == "export":
+            rng = parse_date_range(text)
+            if rng is None:
+                await update.message.reply_text("⛔ صيغة غير صحيحة. مثال: 2026-01-01 2026-01-31")
+                return
+            kind = state["kind"]
+            conversations.end(key)
+            await update.message.reply_text("⏳ جاري تجهيز الملف...")
+            await send_export(context, update.effective_chat.id, kind, *rng)
+            db.admin_log(user_id, "export", {"kind": kind, "from": str(rng[0]), "to": str(rng[1])})
+            return
+
+        if action == "dir_search":
+            if not text.isdigit() or len(text) > 20:
+                await update.message.reply_text("⛔ أرسل أرقاماً فقط.")
+                return
+            conversations.end(key)
+            page, kb = await asyncio.to_thread(render_directory, "pre", text, None)
+            await update.message.reply_text(page, reply_markup=kb)
+            return
+
+        if action == "dir_range":
+            rng = parse_balance_range(text)
+            if rng is None:
+                await update.message.reply_text("⛔ صيغة غير صحيحة. مثال: 5 20")
+                return
+            conversations.end(key)
+            arg = "~".join("" if b is None else f"{b:.2f}" for b in rng)
+            page, kb = await asyncio.to_thread(render_directory, "rng", arg, None)
+            await update.message.reply_text(page, reply_markup=kb)
+            return
+
         if action == "setprice":
             amt = money_ok(text)
             if amt is None:
                 await update.message.reply_text("⛔ سعر غير صحيح.")
                 return
-            context.user_data.pop("admin_action", None)
-            db.set_setting("price_usd", str(amt))
+            conversations.end(key)
+            await asyncio.to_thread(db.set_setting, "price_usd", str(amt))
             db.admin_log(user_id, "set_price", {"price": amt})
             await update.message.reply_text(f"✅ تم تغيير السعر إلى {amt:.2f}$")
             return
@@ -682,8 +1428,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not text.isdigit():
                 await update.message.reply_text("⛔ أرسل ID صحيح.")
                 return
-            context.user_data["admin_uid"] = int(text)
-            context.user_data["admin_action"] = "setlimit_val"
+            conversations.start(key, "setlimit_val", admin_uid=int(text))
             await update.message.reply_text("📆 أرسل الحد اليومي الجديد (مثال: 5):")
             return
 
@@ -692,27 +1437,27 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("⛔ أرسل رقم صحيح.")
                 return
             limit = int(text)
-            uid = context.user_data.pop("admin_uid")
-            context.user_data.pop("admin_action", None)
-            db.ensure_user(uid)
-            db.set_daily_limit(uid, limit)
+            uid = state["admin_uid"]
+            conversations.end(key)
+            await asyncio.to_thread(db.ensure_user, uid)
+            await asyncio.to_thread(db.set_daily_limit, uid, limit)
             db.admin_log(user_id, "set_daily_limit", {"user_id": uid, "limit": limit})
             await update.message.reply_text("✅ تم ضبط الحد اليومي.")
             return
 
         if action == "editstart":
-            context.user_data.pop("admin_action", None)
+            conversations.end(key)
             new_msg = text
-            db.set_setting("start_message", new_msg)
+            await asyncio.to_thread(db.set_setting, "start_message", new_msg)
             db.admin_log(user_id, "edit_start_message", {"len": len(new_msg)})
             await update.message.reply_text("✅ تم حفظ رسالة /start الجديدة.")
             return
 
         if action == "broadcast":
-            context.user_data.pop("admin_action", None)
+            conversations.end(key)
             msg = text
 
-            user_ids = db.list_user_ids_nonbanned()
+            user_ids = await asyncio.to_thread(db.list_user_ids_nonbanned)
 
             sent = 0
             for uid in user_ids:
@@ -730,20 +1475,320 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("اكتب /start لفتح القائمة.")
 
 
+async def apply_bulk(update: Update, admin_id: int, text: str, default_action: Optional[str], csv_mode: bool):
+    rows, failures = parse_bulk_rows(text, default_action, csv_mode)
+    summary, error = None, None
+    try:
+        summary = await asyncio.to_thread(db.bulk_apply_users, rows, admin_id)
+        failures += [(f"ID {uid}", "الرصيد الناتج خارج الحدود (لم يُعدّل الرصيد)") for uid in summary["rejected"]]
+    except Exception as e:
+        error = str(e)
+    await update.message.reply_text(bulk_summary_text(summary, failures, error))
+
+
+async def send_export(context: ContextTypes.DEFAULT_TYPE, chat_id: int, kind: str, start: date, end: date):
+    """Stream the export into a gzip temp file off the event loop, then send it as a document."""
+    fd, path = tempfile.mkstemp(suffix=".csv.gz")
+    os.close(fd)
+
+    def write():
+        with gzip.open(path, "wb") as gz:
+            db.export_csv(kind, start, end, gz)
+
+    try:
+        await asyncio.to_thread(write)
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            await context.bot.send_message(chat_id=chat_id, text="⛔ الملف أكبر من حد تيليجرام (50MB). اختر فترة أقصر.")
+            return
+        with open(path, "rb") as f:
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=f,
+                filename=f"{kind}_{start}_{end}.csv.gz",
+                caption=f"📤 {kind}: {start} → {end}",
+            )
+    except Exception as e:
+        await context.bot.send_message(chat_id=chat_id, text=f"⛔ فشل التصدير:\n{e}")
+    finally:
+        os.remove(path)
+
+
+# ------------------- Document handler -------------------
+async def on_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    key = conv_key(user_id)
+    state = conversations.get(key)
+    if not (is_admin(user_id) and state and state["flow"] == "bulk"):
+        await update.message.reply_text("اكتب /start لفتح القائمة.")
+        return
+
+    doc = update.message.document
+    if doc.file_size and doc.file_size > BULK_MAX_FILE_BYTES:
+        await update.message.reply_text("⛔ الملف كبير جداً (الحد 2MB).")
+        return
+
+    default_action = state["bulk_action"]
+    conversations.end(key)
+
+    f = await doc.get_file()
+    raw = await f.download_as_bytearray()
+    try:
+        text = bytes(raw).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await update.message.reply_text("⛔ الملف يجب أن يكون نصاً بترميز UTF-8.")
+        return
+
+    await apply_bulk(update, user_id, text, default_action, csv_mode=True)
+
+
+# ------------------- Cold start -------------------
+_first_update_seen = False
+
+
+def process_age() -> Optional[float]:
+    """Seconds since this process was started (Linux), or None if unknown."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+
+async def before_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs ahead of every handler (group -1)."""
+    global _first_update_seen
+    db.use_tenant(db.tenant_of(context.bot.token))
+    db.begin_request()
+    db.use_deadline(None)
+    if not _first_update_seen:
+        _first_update_seen = True
+        age = process_age()
+        if age is not None:
+            metrics.set_gauge("cold_start_first_update_seconds", round(age, 3))
+            log.info("cold start: first update handled %.2fs after process start", age)
+
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """A callback that ran out of its deadline gets a "try again" answer; anything else is logged."""
+    if isinstance(update, Update) and update.callback_query and db.is_deadline_error(context.error):
+        metrics.incr(f"deadline_expired.{route_of(update.callback_query.data or '')}")
+        await safe_edit(update.callback_query, DEADLINE_TEXT, reply_markup=k_back(CB_MAIN))
+        return
+    log.error("Exception while handling an update", exc_info=context.error)
+
+
+recorder: Optional[UpdateRecorder] = None
+
+
+async def capture_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Group -2, only with CAPTURE_FILE: append the update to the capture file."""
+    recorder.record(db.tenant_of(context.bot.token), update.to_dict())
+
+
+# ------------------- Background jobs -------------------
+_background_tasks: list[asyncio.Task] = []
+
+
+async def partition_maintenance_loop():
+    # first pass right after start-up, off the boot path
+    while True:
+        try:
+            res = await asyncio.to_thread(db.maintain_partitions)
+            if res["created"] or res["archived"]:
+                log.info("partitions created=%s archived=%s", res["created"], res["archived"])
+        except Exception:
+            log.exception("partition maintenance failed")
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+
+async def daily_normalize_loop():
+    while True:
+        now = datetime.now()
+        next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        await asyncio.sleep((next_midnight - now).total_seconds() + 5)
+        try:
+            n = await asyncio.to_thread(db.normalize_daily_counters)
+            log.info("daily counters normalized for %d users", n)
+        except Exception:
+            log.exception("daily counter normalization failed")
+
+
+async def reap_stale_orders() -> dict:
+    """Cancel waiting orders older than ORDER_TTL_MINUTES and refund non-admin buyers."""
+    t0 = time.monotonic()
+    stale = await asyncio.to_thread(db.list_stale_waiting_orders, ORDER_TTL_MINUTES, REAPER_BATCH)
+    sem = asyncio.Semaphore(REAPER_CONCURRENCY)
+
+    async def cancel(o: dict) -> bool:
+        async with sem:
+            try:
+                # cancel_order raises unless the provider confirms; unconfirmed orders stay 'waiting'
+                if o["provider_order_id"]:
+                    await provider_jobs.submit(provider.cancel_order, o["provider_order_id"], admit=False)
+                return True
+            except Exception as e:
+                log.warning("reaper: cancel of order #%s failed: %s", o["id"], e)
+                return False
+
+    results = await asyncio.gather(*(cancel(o) for o in stale))
+    done = [o for o, ok in zip(stale, results) if ok]
+    refund_ids = {o["id"] for o in done if not is_admin(o["user_id"]) and float(o["sell_price"]) > 0}
+    cancel_ids = [o["id"] for o in done if o["id"] not in refund_ids]
+    res = await asyncio.to_thread(db.close_waiting_orders, cancel_ids, sorted(refund_ids))
+
+    res["failed"] = len(stale) - len(done)
+    res["seconds"] = time.monotonic() - t0
+    metrics.incr("reaper_orders_cancelled", res["cancelled"])
+    metrics.incr("reaper_orders_refunded", res["refunded"])
+    metrics.incr("reaper_cancel_failed", res["failed"])
+    metrics.observe("reaper_run", res["seconds"])
+    return res
+
+
+async def order_reaper_loop():
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        try:
+            res = await reap_stale_orders()
+            if res["cancelled"] or res["refunded"] or res["failed"]:
+                log.info("reaper: cancelled=%d refunded=%d failed=%d in %.2fs",
+                         res["cancelled"], res["refunded"], res["failed"], res["seconds"])
+        except Exception:
+            log.exception("order reaper failed")
+
+
+async def refresh_catalog() -> None:
+    catalog.load_items(await asyncio.to_thread(db.list_catalog))
+    try:
+        stock = await provider_jobs.submit(provider.availability, admit=False)
+    except Exception as e:
+        # provider can't report stock: offer every enabled item, create_order decides
+        log.debug("availability unavailable: %s", e)
+        stock = None
+    catalog.load_stock(stock)
+
+
+async def catalog_refresh_loop():
+    while True:
+        try:
+            await refresh_catalog()
+        except Exception:
+            log.exception("catalog refresh failed")
+        await asyncio.sleep(CATALOG_REFRESH_INTERVAL)
+
+
+async def start_services(bots: dict):
+    """Start what all hosted bots share, once per process. `bots` maps tenant -> Bot."""
+    if provider.RATE_LIMITS:
+        await asyncio.to_thread(db.configure_provider_budget, provider.RATE_LIMITS)
+    await provider_jobs.start()
+    push_receiver.start(bots, asyncio.get_running_loop())
+    age = process_age()
+    if age is not None:
+        metrics.set_gauge("cold_start_ready_seconds", round(age, 3))
+        log.info("cold start: ready to poll %.2fs after process start", age)
+    db.audit_writer.start()
+    db.start_cache_listener()
+    _background_tasks.append(asyncio.create_task(partition_maintenance_loop()))
+    _background_tasks.append(asyncio.create_task(daily_normalize_loop()))
+    _background_tasks.append(asyncio.create_task(catalog_refresh_loop()))
+    if ORDER_TTL_MINUTES > 0:
+        _background_tasks.append(asyncio.create_task(order_reaper_loop()))
+
+
+async def stop_services():
+    for t in _background_tasks:
+        t.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await asyncio.to_thread(db.audit_writer.stop)
+    await asyncio.to_thread(db.stop_cache_listener)
+    await provider_jobs.stop()
+    await asyncio.to_thread(push_receiver.stop)
+    await asyncio.to_thread(db.close_pools)
+    if recorder is not None:
+        recorder.close()
+
+
 # ------------------- Main -------------------
+def build_app(token: str, request: Optional[BaseRequest] = None) -> Application:
+    """
+    One Application per hosted bot; each gets its own update processor.
+    `request` replaces the HTTP transport to the Bot API (replay.py uses a fake one).
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(PerUserUpdateProcessor(
+            CONCURRENT_UPDATES, label=str(db.tenant_of(token)), lanes=LANES, lane_of=lane_of,
+        ))
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+    if recorder is not None:
+        app.add_handler(TypeHandler(Update, capture_update), group=-2)
+    app.add_handler(TypeHandler(Update, before_update), group=-1)
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("profile", on_profile))
+    app.add_handler(CallbackQueryHandler(on_callback))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    app.add_handler(MessageHandler(filters.Document.ALL, on_document))
+    app.add_error_handler(on_error)
+    return app
+
+
+async def run_bots(apps: list[Application]):
+    """
+    Run several Applications on one event loop (Application.run_polling can
+    only drive one), with the shared services started once, until SIGINT/SIGTERM.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    for app in apps:
+        await app.initialize()
+    await start_services({db.tenant_of(app.bot.token): app.bot for app in apps})
+    try:
+        for app in apps:
+            await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            await app.start()
+            log.info("polling as @%s", app.bot.username)
+        await stop.wait()
+    finally:
+        for app in apps:
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+        await stop_services()
+        for app in apps:
+            await app.shutdown()
+
+
 def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("BOT_TOKEN is missing")
+    global recorder
+    if not BOT_TOKENS:
+        raise RuntimeError("BOT_TOKEN (or BOT_TOKENS) is missing")
     if not ADMIN_IDS:
         raise RuntimeError("ADMIN_IDS is missing (comma-separated)")
 
-    db.init_db()
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
 
-    app = Application.builder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(on_callback))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if db.init_db([db.tenant_of(t) for t in BOT_TOKENS]):
+        log.info("database schema migrated to version %d", db.SCHEMA_VERSION)
+
+    if CAPTURE_FILE:
+        recorder = UpdateRecorder(CAPTURE_FILE, ADMIN_IDS)
+        log.info("capturing anonymised updates to %s", CAPTURE_FILE)
+
+    asyncio.run(run_bots([build_app(t) for t in BOT_TOKENS]))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+"""
+In-process counters, gauges and timings.
+Shown to admins from the admin panel (📈 مؤشرات الأداء).
+"""
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_timings: Dict[str, List[float]] = {}  # name -> [count, total, max, last]
+
+
+def incr(name: str, n: float = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def set_gauge(name: str, value: float) -> None:
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, seconds: float) -> None:
+    with _lock:
+        t = _timings.get(name)
+        if t is None:
+            _timings[name] = [1, seconds, seconds, seconds]
+        else:
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+            t[3] = seconds
+
+
+@contextmanager
+def timer(name: str):
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - t0)
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": {
+                k: {"count": int(v[0]), "avg": v[1] / v[0], "max": v[2], "last": v[3]}
+                for k, v in _timings.items()
+            },
+        }
+
+
+def render_text() -> str:
+    s = snapshot()
+    lines = []
+    for k in sorted(s["counters"]):
+        v = s["counters"][k]
+        lines.append(f"{k}: {int(v) if float(v).is_integer() else round(v, 3)}")
+    for k in sorted(s["gauges"]):
+        lines.append(f"{k}: {s['gauges'][k]:g}")
+    for k in sorted(s["timings"]):
+        t = s["timings"][k]
+        lines.append(f"{k}: n={t['count']} avg={t['avg'] * 1000:.1f}ms max={t['max'] * 1000:.1f}ms")
+    return "\n".join(lines) if lines else "-"
@@ -0,0 +1,129 @@
+"""
+On-demand sampling profiler for the running bot (admin command /profile N).
+
+A sampler thread reads every thread's Python stack (sys._current_frames) at a
+fixed interval for the requested duration, so the event loop, provider workers
+and to_thread jobs are all covered. Nothing is installed while no session is
+running, so it costs nothing the rest of the time.
+
+Samples whose innermost frame is a known blocking wait (selector, condition,
+idle executor worker...) are counted as idle and left out of the ranking. A
+thread blocked inside C code (e.g. a psycopg2 query or an HTTP read) counts
+against the Python function that called it.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+DEFAULT_INTERVAL = 0.005  # seconds between samples
+
+# (file name, function) of frames where a thread sits waiting for work
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("thread.py", "_worker"),          # concurrent.futures idle worker
+    ("queue.py", "get"),
+    ("socketserver.py", "serve_forever"),
+    ("db.py", "_listen_loop"),         # LISTEN connection between notifications
+}
+
+_session_lock = threading.Lock()
+
+Frame = Tuple[str, str, int]  # (file name, qualified function name, first line)
+
+
+class Profile:
+    """Result of one sampling session."""
+
+    def __init__(self, seconds: float, interval: float):
+        self.seconds = seconds
+        self.interval = interval
+        self.stacks: Counter = Counter()  # (thread name, frame, ...) outermost first -> samples
+        self.samples = 0
+        self.idle = 0
+
+    def add(self, thread_name: str, stack: Tuple[Frame, ...]) -> None:
+        if not stack:
+            return
+        self.samples += 1
+        leaf = stack[-1]
+        if (leaf[0], leaf[1].rsplit(".", 1)[-1]) in IDLE_FRAMES:
+            self.idle += 1
+            return
+        self.stacks[(thread_name,) + stack] += 1
+
+    @property
+    def active(self) -> int:
+        return self.samples - self.idle
+
+    def top(self, n: int = 20) -> list:
+        """[(frame, cumulative samples, self samples)] ordered by cumulative samples."""
+        cum: Counter = Counter()
+        own: Counter = Counter()
+        for key, count in self.stacks.items():
+            frames = key[1:]
+            for f in set(frames):
+                cum[f] += count
+            own[frames[-1]] += count
+        return [(f, c, own[f]) for f, c in cum.most_common(n)]
+
+    def summary(self, n: int = 20) -> str:
+        lines = [
+            f"⏱ {self.seconds:g}s, {self.samples} samples every {self.interval * 1000:g}ms "
+            f"({self.active} active, {self.idle} idle)",
+            "",
+            "cum%   self%  function",
+        ]
+        total = max(self.active, 1)
+        for (fname, func, line), c, s in self.top(n):
+            lines.append(f"{c * 100 / total:5.1f}  {s * 100 / total:5.1f}  {func} ({fname}:{line})")
+        if not self.active:
+            lines.append("-")
+        return "\n".join(lines)
+
+    def collapsed(self) -> str:
+        """Collapsed-stack text ("thread;outer;...;inner count"), for flamegraph.pl / speedscope."""
+        out = []
+        for key, count in self.stacks.most_common():
+            thread_name, frames = key[0], key[1:]
+            names = [f"{func} ({fname}:{line})" for fname, func, line in frames]
+            out.append(";".join([thread_name] + names).replace("\n", " ") + f" {count}")
+        return "\n".join(out) + "\n"
+
+
+def _stack(frame) -> Tuple[Frame, ...]:
+    out = []
+    while frame is not None:
+        code = frame.f_code
+        out.append((os.path.basename(code.co_filename), code.co_qualname, code.co_firstlineno))
+        frame = frame.f_back
+    out.reverse()
+    return tuple(out)
+
+
+def sample(seconds: float, interval: float = DEFAULT_INTERVAL) -> Optional[Profile]:
+    """
+    Sample all threads for `seconds` (blocking: run it in a worker thread).
+    Returns None if another session is already running.
+    """
+    if not _session_lock.acquire(blocking=False):
+        return None
+    try:
+        prof = Profile(seconds, interval)
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names: Dict[int, str] = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    prof.add(names.get(ident, str(ident)), _stack(frame))
+            time.sleep(interval)
+        return prof
+    finally:
+        _session_lock.release()
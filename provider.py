@@ -1,14 +1,63 @@
 import os
-import requests
+import threading
+import time
+
+import db
+import metrics
+from config import PROVIDER_WORKERS
 
 API_BASE = (os.getenv("PROVIDER_API_BASE") or "").rstrip("/")
 API_KEY = (os.getenv("PROVIDER_API_KEY") or "").strip()
+# keep-alive connections to the provider, one per provider worker thread
+POOL_SIZE = PROVIDER_WORKERS
+# Seconds per HTTP call; less when the handler's deadline (db.use_deadline) is closer
+HTTP_TIMEOUT = 30
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def parse_rate_limits(spec: str) -> dict:
+    """'*=20/40,create-order=5' -> {'*': (20.0, 40.0), 'create-order': (5.0, 5.0)} (calls/sec, burst)."""
+    out = {}
+    for item in spec.split(","):
+        name, _, rate = item.partition("=")
+        if not name.strip() or not rate.strip():
+            continue
+        per_sec, _, burst = rate.partition("/")
+        out[name.strip()] = (float(per_sec), float(burst or per_sec))
+    return out
+
+
+# Call budget shared by every bot process, kept as token buckets in Postgres
+# (db.take_provider_token): "endpoint=calls_per_sec/burst,..."; "*" limits all
+# endpoints together. Empty = unlimited.
+RATE_LIMITS = parse_rate_limits(os.getenv("PROVIDER_RATE_LIMITS", ""))
+# Share of the "*" budget only purchases and cancels may use
+RATE_RESERVE = float(os.getenv("PROVIDER_RATE_RESERVE", "0.3"))
+# Seconds a purchase/cancel may wait for budget; status polls never wait
+RATE_MAX_WAIT = float(os.getenv("PROVIDER_RATE_MAX_WAIT", "10"))
+HIGH_PRIORITY = ("create-order", "cancel-order")
+# Order states meaning the number is gone and no code will come
+CANCELLED_STATES = ("cancelled", "canceled", "expired", "refunded", "timeout")
 
 
 class ProviderError(Exception):
     pass
 
 
+class ProviderRateLimited(ProviderError):
+    """The shared call budget has no room for this call right now."""
+
+
+class ProviderOutOfStock(ProviderError):
+    """The provider has no numbers for the requested country/service."""
+
+
+# Error codes/messages of create-order replies that mean "no numbers left"
+OUT_OF_STOCK_MARKERS = ("no_numbers", "no numbers", "out_of_stock", "out of stock", "sold out")
+
+
 def _check_config():
     if not API_BASE:
         raise ProviderError("PROVIDER_API_BASE is missing")
@@ -16,6 +65,63 @@ def _check_config():
         raise ProviderError("PROVIDER_API_KEY is missing")
 
 
+def _http():
+    """The process-wide requests.Session, shared by every bot and worker thread."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # requests is imported on first use to keep bot start-up fast
+                import requests
+
+                s = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                _session = s
+    return _session
+
+
+def _take_budget(path: str) -> None:
+    high = path in HIGH_PRIORITY
+    t0 = time.monotonic()
+    deadline = t0 + (RATE_MAX_WAIT if high else 0)
+    left = db.time_left()
+    if left is not None:
+        deadline = min(deadline, t0 + left)
+    while True:
+        wait = db.take_provider_token(path, 0 if high else RATE_RESERVE)
+        if wait <= 0:
+            if time.monotonic() > t0 + 0.001:
+                metrics.observe("provider_budget_wait", time.monotonic() - t0)
+            return
+        if time.monotonic() + wait > deadline:
+            metrics.incr(f"provider_rate_limited.{path}")
+            raise ProviderRateLimited(f"{path}: provider call budget exhausted")
+        time.sleep(wait)
+
+
+def _get(path: str, params: dict) -> dict:
+    if RATE_LIMITS:
+        _take_budget(path)
+    timeout = HTTP_TIMEOUT
+    left = db.time_left()
+    if left is not None:
+        if left <= 0:
+            raise db.DeadlineExceeded(f"{path}: deadline passed before the call")
+        timeout = min(timeout, left)
+    session = _http()
+    import requests  # loaded by _http()
+
+    try:
+        r = session.get(f"{API_BASE}/{path}", params={"api_key": API_KEY, **params}, timeout=timeout)
+    except requests.Timeout as e:
+        if timeout < HTTP_TIMEOUT:
+            raise db.DeadlineExceeded(f"{path}: deadline reached waiting for the provider") from e
+        raise
+    return r.json()
+
+
 def create_order(service: str, country: str) -> dict:
     """
     Create an order.
@@ -24,13 +130,12 @@ def create_order(service: str, country: str) -> dict:
     """
     _check_config()
 
-    url = f"{API_BASE}/create-order"
-    params = {"api_key": API_KEY, "service": service, "country": country}
-
-    r = requests.get(url, params=params, timeout=30)
-    data = r.json()
+    data = _get("create-order", {"service": service, "country": country})
 
     if str(data.get("status")).lower() not in ("success", "ok", "true"):
+        reason = " ".join(str(data.get(k) or "") for k in ("error", "message", "state")).lower()
+        if any(m in reason for m in OUT_OF_STOCK_MARKERS):
+            raise ProviderOutOfStock(f"create_order: no numbers: {data}")
         raise ProviderError(f"create_order failed: {data}")
 
     provider_order_id = data.get("id") or data.get("order_id")
@@ -51,12 +156,7 @@ def order_status(provider_order_id: str) -> dict:
     """
     _check_config()
 
-    url = f"{API_BASE}/order-status"
-    params = {"api_key": API_KEY, "order_id": provider_order_id}
-
-    r = requests.get(url, params=params, timeout=30)
-    data = r.json()
-    return data
+    return _get("order-status", {"order_id": provider_order_id})
 
 
 def cancel_order(provider_order_id: str) -> dict:
@@ -64,12 +164,37 @@ def cancel_order(provider_order_id: str) -> dict:
     Cancel order.
     Expected response example:
     {"status":"success","state":"cancelled"}
+    Raises ProviderError unless the provider confirms the cancellation
+    (an order whose code already arrived cannot be cancelled).
     """
     _check_config()
 
-    url = f"{API_BASE}/cancel-order"
-    params = {"api_key": API_KEY, "order_id": provider_order_id}
-
-    r = requests.get(url, params=params, timeout=30)
-    data = r.json()
+    data = _get("cancel-order", {"order_id": provider_order_id})
+    state = str(data.get("state") or "").lower()
+    if (str(data.get("status")).lower() not in ("success", "ok", "true")
+            or (state and state not in CANCELLED_STATES)
+            or data.get("sms_code") or data.get("code") or data.get("otp")):
+        raise ProviderError(f"cancel_order failed: {data}")
     return data
+
+
+def availability() -> dict:
+    """
+    Stock per country/service.
+    Expected response example:
+    {"status":"success","items":[{"country":"UK","service":"UK_SERVICE","count":12}]}
+    Returns {(country, service): count}. Raises ProviderError if unsupported.
+    """
+    _check_config()
+
+    data = _get("availability", {})
+    if str(data.get("status")).lower() not in ("success", "ok", "true") or not isinstance(data.get("items"), list):
+        raise ProviderError(f"availability failed: {data}")
+
+    out = {}
+    for it in data["items"]:
+        country = it.get("country")
+        service = it.get("service") or it.get("service_code")
+        if country and service:
+            out[(str(country), str(service))] = int(it.get("count") or 0)
+    return out
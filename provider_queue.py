@@ -0,0 +1,93 @@
+"""
+Bounded work queue for provider calls.
+A fixed number of worker threads run provider functions; when too many jobs
+are already waiting, new ones are refused with ProviderBusy instead of piling up.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import metrics
+
+
+class ProviderBusy(Exception):
+    pass
+
+
+class ProviderWorkQueue:
+    def __init__(self, workers: int, busy_at: int):
+        self.workers = workers
+        self.busy_at = busy_at
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def is_busy(self) -> bool:
+        return self.depth >= self.busy_at
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="provider")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while self._queue and not self._queue.empty():
+            _, _, fut, _ = self._queue.get_nowait()
+            fut.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, fn: Callable[..., Any], *args, admit: bool = True, **kwargs) -> asyncio.Future:
+        """
+        Queue fn(*args, **kwargs) and return a future for its result.
+        Raises ProviderBusy when `admit` and the queue is at the busy threshold.
+        Before start() the call simply runs in a thread.
+        """
+        if self._queue is None:
+            return asyncio.ensure_future(asyncio.to_thread(fn, *args, **kwargs))
+        if admit and self.is_busy():
+            metrics.incr("provider_queue_rejected")
+            raise ProviderBusy("provider queue is full")
+
+        fut = asyncio.get_running_loop().create_future()
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        self._queue.put_nowait((call, time.monotonic(), fut, fn.__name__))
+        metrics.set_gauge("provider_queue_depth", self._queue.qsize())
+        return fut
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            call, queued_at, fut, name = await self._queue.get()
+            metrics.set_gauge("provider_queue_depth", self._queue.qsize())
+            if fut.cancelled():
+                continue
+            metrics.observe("provider_queue_wait", time.monotonic() - queued_at)
+            t0 = time.monotonic()
+            try:
+                result = await loop.run_in_executor(self._executor, call)
+            except asyncio.CancelledError:
+                fut.cancel()
+                raise
+            except Exception as e:
+                if not fut.cancelled():
+                    fut.set_exception(e)
+            else:
+                if not fut.cancelled():
+                    fut.set_result(result)
+            finally:
+                metrics.observe(f"provider_{name}", time.monotonic() - t0)
@@ -0,0 +1,193 @@
+"""
+Optional HTTP endpoint for provider delivery callbacks (push instead of polling).
+
+The provider POSTs JSON to /provider/callback:
+    {"order_id": "<provider order id>", "state": "received", "code": "1234"}
+signed with header X-Signature: hex(HMAC-SHA256(PUSH_SECRET, raw body)).
+Orders of providers that never push are still refreshed by polling (ord_ref_).
+
+Local stand-in for testing, posting a signed callback:
+    python push_receiver.py send <provider_order_id> received 1234
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+import db
+import metrics
+from config import ADMIN_IDS, PUSH_LISTEN_HOST, PUSH_LISTEN_PORT, PUSH_SECRET
+from provider import CANCELLED_STATES
+
+log = logging.getLogger(__name__)
+
+CALLBACK_PATH = "/provider/callback"
+MAX_BODY_BYTES = 64 * 1024
+
+_server: Optional[ThreadingHTTPServer] = None
+_bots: Dict[int, object] = {}  # tenant -> Bot that sells to that tenant's users
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def sign(body: bytes, secret: str = PUSH_SECRET) -> str:
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def apply_callback(data: dict) -> Tuple[int, dict, Optional[Tuple[int, str]]]:
+    """
+    Apply one provider callback.
+    Returns (http status, response body, (tenant, user_id, message) to notify or None).
+    """
+    pid = data.get("order_id") or data.get("id")
+    if not pid:
+        return 400, {"ok": False, "error": "order_id missing"}, None
+    code = data.get("code") or data.get("sms_code") or data.get("otp")
+    state = str(data.get("state") or data.get("status") or "").lower()
+
+    o = db.get_order_by_provider_id(str(pid))
+    if not o:
+        return 404, {"ok": False, "error": "unknown order"}, None
+    oid = o["id"]
+    db.use_tenant(o["tenant"])
+
+    if code:
+        if o["status"] == "received" and o.get("sms_code") == str(code):
+            return 200, {"ok": True, "duplicate": True}, None
+        # a late or replayed push must not deliver the code of a cancelled/refunded order
+        if not db.set_orders_sms([(oid, str(code))]):
+            metrics.incr("push_codes_ignored")
+            return 200, {"ok": True, "ignored": o["status"]}, None
+        metrics.incr("push_codes")
+        return 200, {"ok": True}, (
+            o["tenant"],
+            o["user_id"],
+            f"✅ وصل الكود للطلب #{oid}\n\n📞 الرقم: {o.get('phone_number')}\n🔐 الكود: {code}",
+        )
+
+    if state in CANCELLED_STATES:
+        if o["status"] != "waiting":
+            return 200, {"ok": True, "duplicate": True}, None
+        charged = o["user_id"] not in ADMIN_IDS and float(o["sell_price"]) > 0
+        db.close_waiting_orders([] if charged else [oid], [oid] if charged else [], note="Order cancelled by provider")
+        metrics.incr("push_cancellations")
+        text = f"❌ تم إلغاء الطلب #{oid} من المزوّد."
+        if charged:
+            text += f"\n💰 تم إرجاع {float(o['sell_price']):.2f}$ إلى رصيدك."
+        return 200, {"ok": True}, (o["tenant"], o["user_id"], text)
+
+    return 200, {"ok": True, "ignored": state or None}, None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != CALLBACK_PATH:
+            return self._reply(404, {"ok": False})
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > MAX_BODY_BYTES:
+            return self._reply(400, {"ok": False, "error": "bad length"})
+        body = self.rfile.read(length)
+
+        if not hmac.compare_digest(sign(body), self.headers.get("X-Signature", "")):
+            metrics.incr("push_bad_signature")
+            return self._reply(401, {"ok": False, "error": "bad signature"})
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return self._reply(400, {"ok": False, "error": "bad json"})
+        if not isinstance(data, dict):
+            return self._reply(400, {"ok": False, "error": "bad json"})
+
+        try:
+            status, resp, notify = apply_callback(data)
+        except Exception:
+            log.exception("push callback failed: %s", data)
+            return self._reply(500, {"ok": False})
+
+        if notify and _loop is not None:
+            asyncio.run_coroutine_threadsafe(_notify(*notify), _loop)
+        self._reply(status, resp)
+
+    def _reply(self, status: int, body: dict):
+        raw = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, fmt, *args):
+        log.debug("push: " + fmt, *args)
+
+
+async def _notify(tenant: int, user_id: int, text: str):
+    bot = _bots.get(tenant)
+    if bot is None:
+        return
+    try:
+        await bot.send_message(chat_id=user_id, text=text)
+    except Exception:
+        pass
+
+
+def start(bots: Dict[int, object], loop: asyncio.AbstractEventLoop) -> bool:
+    """
+    Start the receiver if PUSH_LISTEN_PORT is set; `bots` maps tenant -> Bot.
+    Returns True when listening.
+    """
+    global _server, _loop
+    if not PUSH_LISTEN_PORT or _server is not None:
+        return False
+    if not PUSH_SECRET:
+        log.warning("PUSH_LISTEN_PORT is set but PUSH_SECRET is empty; push receiver disabled")
+        return False
+    _bots.update(bots)
+    _loop = loop
+    _server = ThreadingHTTPServer((PUSH_LISTEN_HOST, PUSH_LISTEN_PORT), _Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="push-receiver", daemon=True).start()
+    log.info("push receiver listening on %s:%d%s", PUSH_LISTEN_HOST, PUSH_LISTEN_PORT, CALLBACK_PATH)
+    return True
+
+
+def stop() -> None:
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+
+def send_test_callback(provider_order_id: str, state: str, code: Optional[str] = None,
+                       url: Optional[str] = None) -> Tuple[int, str]:
+    """Local stand-in for the provider: POST a signed callback to the receiver."""
+    import urllib.error
+    import urllib.request
+
+    url = url or f"http://{PUSH_LISTEN_HOST}:{PUSH_LISTEN_PORT}{CALLBACK_PATH}"
+    payload = {"order_id": provider_order_id, "state": state}
+    if code:
+        payload["code"] = code
+    body = json.dumps(payload).encode()
+    req = urllib.request.Request(url, data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        "X-Signature": sign(body),
+    })
+    try:
+        with urllib.request.urlopen(req, timeout=10) as r:
+            return r.status, r.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != "send":
+        print("usage: python push_receiver.py send <provider_order_id> <state> [code]")
+        sys.exit(2)
+    print(*send_test_callback(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None))
@@ -0,0 +1,447 @@
+"""
+Replay a capture (see capture.py) through the real handlers, with a fake Bot
+API transport, a stub provider and a local database, and report latency and
+DB query counts per route; then compare the reports of two code versions.
+
+    python replay.py run capture.jsonl --database-url postgresql:///replay_a --speed 10 --report a.json
+    python replay.py compare a.json b.json
+
+The same pair compares storage backends for one code version:
+
+    python replay.py run capture.jsonl --database-url postgresql:///replay_pg --report pg.json
+    python replay.py run capture.jsonl --database-url sqlite:////tmp/replay.db --report sqlite.json
+    python replay.py compare pg.json sqlite.json
+
+Use a fresh database for every run: the replay seeds each captured user as
+allowed with --seed-balance, and refuses a database that already has users.
+Everything else (flood control, caches, queue sizes) is the production
+configuration from the environment, so at high --speed flood control will
+turn part of the traffic away, as it would live.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+_DIGITS = re.compile(r"\d+")
+_queries: ContextVar[Optional[List[int]]] = ContextVar("replay_queries", default=None)
+
+
+# ---------- Capture file ----------
+def load_capture(path: str) -> Tuple[List[int], List[Tuple[float, int, dict]]]:
+    """(admin ids, [(seconds from start, tenant, update)]); sessions are laid end to end."""
+    admins, events = set(), []
+    base = last = 0.0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            if "capture" in rec:
+                admins.update(rec.get("admins", []))
+                base = last
+                continue
+            last = base + rec["t"]
+            events.append((last, rec["bot"], rec["u"]))
+    return sorted(admins), events
+
+
+def _user_ids(update: dict) -> List[int]:
+    out = []
+    for kind in ("message", "edited_message", "callback_query"):
+        sender = (update.get(kind) or {}).get("from")
+        if sender:
+            out.append(sender["id"])
+    return out
+
+
+# ---------- Fakes ----------
+class FakeBotRequest(BaseRequest):
+    """Answers Bot API calls locally (after `latency` seconds) and counts them per method."""
+
+    def __init__(self, bot_id: int, latency: float = 0.0):
+        self.bot_id = bot_id
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if "/file/bot" in url:
+            return 200, b""  # File.download_*: documents are not captured
+        name = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[name] += 1
+        if name == "getMe":
+            result = {"id": self.bot_id, "is_bot": True, "first_name": "replay", "username": f"replay_{self.bot_id}"}
+        elif name == "getFile":
+            result = {"file_id": "x", "file_unique_id": "x", "file_path": "documents/x"}
+        elif name.startswith(("send", "edit")):
+            self._message_id += 1
+            result = {
+                "message_id": int(params.get("message_id") or self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class _StubProvider(BaseHTTPRequestHandler):
+    """Provider API stand-in: orders get their code on the second status poll."""
+
+    latency = 0.0
+    polls: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        path, _, query = self.path.partition("?")
+        params = dict(urllib.parse.parse_qsl(query))
+        name = path.rsplit("/", 1)[-1]
+        if name == "create-order":
+            with self.lock:
+                oid = str(len(self.polls) + 1)
+                self.polls[oid] = 0
+            body = {"status": "success", "id": oid, "number": f"+447000{int(oid):06d}", "cost": 0.3}
+        elif name == "order-status":
+            oid = params.get("order_id", "")
+            with self.lock:
+                self.polls[oid] = self.polls.get(oid, 0) + 1
+                seen = self.polls[oid]
+            body = {"status": "success", "state": "received", "sms_code": "12345"} if seen >= 2 \
+                else {"status": "success", "state": "waiting"}
+        elif name == "cancel-order":
+            body = {"status": "success", "state": "cancelled"}
+        elif name == "availability":
+            body = {"status": "success", "items": [{"country": "UK", "service": "UK_SERVICE", "count": 1000}]}
+        else:
+            body = {"status": "error"}
+        raw = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+# ---------- Query counting ----------
+class _CountingCursor:
+    def __init__(self, cur):
+        self._cur = cur
+
+    @staticmethod
+    def _count():
+        c = _queries.get()
+        if c is not None:
+            c[0] += 1
+
+    def execute(self, *args, **kwargs):
+        self._count()
+        return self._cur.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._count()
+        return self._cur.executemany(*args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        self._count()
+        return self._cur.copy_expert(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+def _count_sqlite(statement: str) -> None:
+    # transaction control and pragmas have no counterpart in the Postgres counts
+    if not statement.lstrip().upper().startswith(("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA")):
+        _CountingCursor._count()
+
+
+class _CountingConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self._conn.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+# ---------- Replay ----------
+def route_name(update: Update) -> str:
+    if update.callback_query:
+        return "cb " + _DIGITS.sub("#", update.callback_query.data or "")
+    msg = update.effective_message
+    if msg is None:
+        return "other"
+    if msg.text and msg.text.startswith("/"):
+        return "cmd " + msg.text.split()[0]
+    if msg.document:
+        return "document"
+    return "text"
+
+
+def _database_has_users(url: str) -> bool:
+    if url.startswith("sqlite:"):
+        import sqlite3
+
+        path = url.split("sqlite:///", 1)[-1]
+        if not os.path.exists(path):
+            return False
+        conn = sqlite3.connect(path)
+        found = conn.execute("SELECT 1 FROM sqlite_master WHERE name='users'").fetchone() is not None
+        if found:
+            found = conn.execute("SELECT EXISTS(SELECT 1 FROM users)").fetchone()[0] == 1
+        conn.close()
+        return found
+
+    import psycopg2
+
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('users') IS NOT NULL")
+    found = cur.fetchone()[0]
+    if found:
+        cur.execute("SELECT EXISTS(SELECT 1 FROM users)")
+        found = cur.fetchone()[0]
+    conn.close()
+    return found
+
+
+async def replay(events, args) -> dict:
+    import db
+    import main as bot_main
+
+    if db.DATABASE_URL.startswith("sqlite:"):
+        import db_sqlite
+
+        db_sqlite.trace = _count_sqlite
+    else:
+        real_conn = db._conn
+        db._conn = lambda: _CountingConnection(real_conn())
+
+    tenants = sorted({tenant for _, tenant, _ in events})
+    db.init_db(tenants)
+    for tenant in tenants:
+        users = {uid for _, t, u in events if t == tenant for uid in _user_ids(u)}
+        db.use_tenant(tenant)
+        db.bulk_apply_users([(uid, "allow", None, args.seed_balance) for uid in sorted(users)], admin_id=0)
+
+    sent: Dict[int, float] = {}
+    counters: Dict[int, List[int]] = {}
+    results: List[Tuple[str, float, int]] = []
+    errors: Counter = Counter()
+    finished = asyncio.Event()
+
+    async def begin(update: Update, context):
+        counters[update.update_id] = c = [0]
+        _queries.set(c)
+
+    async def end(update: Update, context):
+        results.append((route_name(update), time.monotonic() - sent[update.update_id], counters.pop(update.update_id)[0]))
+        if len(results) == len(events):
+            finished.set()
+
+    async def on_error(update, context):
+        errors[route_name(update) if isinstance(update, Update) else "other"] += 1
+
+    from telegram.ext import TypeHandler
+
+    apps, requests = {}, {}
+    for tenant in tenants:
+        requests[tenant] = FakeBotRequest(tenant, args.bot_latency)
+        app = bot_main.build_app(f"{tenant}:replay", request=requests[tenant])
+        app.add_handler(TypeHandler(Update, begin), group=-3)
+        app.add_handler(TypeHandler(Update, end), group=10**6)
+        app.add_error_handler(on_error)
+        await app.initialize()
+        apps[tenant] = app
+    await bot_main.start_services({t: app.bot for t, app in apps.items()})
+    for app in apps.values():
+        await app.start()
+
+    t0 = time.monotonic()
+    for seq, (t, tenant, u) in enumerate(events, 1):
+        delay = t0 + t / args.speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        app = apps[tenant]
+        update = Update.de_json({**u, "update_id": seq}, app.bot)
+        sent[seq] = time.monotonic()
+        await app.update_queue.put(update)
+    try:
+        await asyncio.wait_for(finished.wait(), args.settle)
+    except asyncio.TimeoutError:
+        print(f"warning: {len(events) - len(results)} updates still running after {args.settle}s", file=sys.stderr)
+    wall = time.monotonic() - t0
+
+    for app in apps.values():
+        await app.stop()
+    await bot_main.stop_services()
+    for app in apps.values():
+        await app.shutdown()
+
+    bot_calls = Counter()
+    for r in requests.values():
+        bot_calls.update(r.calls)
+    return summarize(results, wall, errors, bot_calls)
+
+
+def _pct(sorted_vals: List[float], p: float) -> float:
+    return sorted_vals[min(len(sorted_vals) - 1, int(round(p / 100 * (len(sorted_vals) - 1))))]
+
+
+def _stats(rows: List[Tuple[float, int]]) -> dict:
+    lat = sorted(r[0] for r in rows)
+    return {
+        "n": len(rows),
+        "p50_ms": round(_pct(lat, 50) * 1000, 2),
+        "p95_ms": round(_pct(lat, 95) * 1000, 2),
+        "max_ms": round(lat[-1] * 1000, 2),
+        "queries_avg": round(sum(r[1] for r in rows) / len(rows), 2),
+    }
+
+
+def summarize(results, wall: float, errors: Counter, bot_calls: Counter) -> dict:
+    by_route: Dict[str, list] = {}
+    for route, lat, queries in results:
+        by_route.setdefault(route, []).append((lat, queries))
+    return {
+        "wall_seconds": round(wall, 3),
+        "total": _stats([(lat, q) for _, lat, q in results]) if results else {"n": 0},
+        "routes": {route: _stats(rows) for route, rows in sorted(by_route.items())},
+        "errors": dict(errors),
+        "bot_calls": dict(bot_calls),
+    }
+
+
+# ---------- Output ----------
+def print_report(rep: dict) -> None:
+    print(f"{'route':32} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'q/upd':>6}")
+    for route, s in [("TOTAL", rep["total"])] + list(rep["routes"].items()):
+        if not s.get("n"):
+            continue
+        print(f"{route[:32]:32} {s['n']:>6} {s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} {s['max_ms']:>9.1f} {s['queries_avg']:>6.1f}")
+    print(f"\nwall {rep['wall_seconds']}s  errors {sum(rep['errors'].values())}  bot calls {rep['bot_calls']}")
+
+
+def _delta(a: Optional[float], b: Optional[float]) -> str:
+    if a is None or b is None:
+        return f"{'-' if a is None else f'{a:.1f}'} → {'-' if b is None else f'{b:.1f}'}"
+    pct = f"{(b - a) / a * 100:+.0f}%" if a else ""
+    return f"{a:.1f} → {b:.1f} {pct}"
+
+
+def compare(a: dict, b: dict) -> None:
+    print(f"{'route':32} {'n a/b':>11}  {'p50 ms':>22}  {'p95 ms':>22}  {'queries/update':>20}")
+    routes = [("TOTAL", a["total"], b["total"])] + [
+        (r, a["routes"].get(r, {}), b["routes"].get(r, {}))
+        for r in sorted(set(a["routes"]) | set(b["routes"]), key=lambda r: -a["routes"].get(r, {}).get("n", 0))
+    ]
+    for route, sa, sb in routes:
+        print(f"{route[:32]:32} {sa.get('n', 0):>5}/{sb.get('n', 0):<5}  "
+              f"{_delta(sa.get('p50_ms'), sb.get('p50_ms')):>22}  "
+              f"{_delta(sa.get('p95_ms'), sb.get('p95_ms')):>22}  "
+              f"{_delta(sa.get('queries_avg'), sb.get('queries_avg')):>20}")
+    ea, eb = sum(a["errors"].values()), sum(b["errors"].values())
+    print(f"\nerrors {ea} → {eb}")
+    for method in sorted(set(a["bot_calls"]) | set(b["bot_calls"])):
+        print(f"bot {method}: {a['bot_calls'].get(method, 0)} → {b['bot_calls'].get(method, 0)}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Replay captured updates and compare runs.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    run = sub.add_parser("run", help="replay a capture file")
+    run.add_argument("capture")
+    run.add_argument("--database-url", required=True, help="a fresh local database (postgresql://... or sqlite:///file)")
+    run.add_argument("--speed", type=float, default=1.0, help="1 = captured pace, 10 = ten times faster")
+    run.add_argument("--report", help="write the JSON report here")
+    run.add_argument("--seed-balance", type=float, default=100.0)
+    run.add_argument("--provider-latency", type=float, default=0.05, help="seconds per stub provider call")
+    run.add_argument("--bot-latency", type=float, default=0.0, help="seconds per fake Bot API call")
+    run.add_argument("--settle", type=float, default=60.0, help="seconds to wait for the last updates")
+    cmp_ = sub.add_parser("compare", help="compare two JSON reports (a = baseline)")
+    cmp_.add_argument("a")
+    cmp_.add_argument("b")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "compare":
+        with open(args.a) as fa, open(args.b) as fb:
+            compare(json.load(fa), json.load(fb))
+        return 0
+
+    admins, events = load_capture(args.capture)
+    if not events:
+        print("capture has no updates", file=sys.stderr)
+        return 1
+    if _database_has_users(args.database_url):
+        print("refusing to replay into a database that already has users; use a fresh one", file=sys.stderr)
+        return 1
+
+    _StubProvider.latency = args.provider_latency
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), _StubProvider)
+    threading.Thread(target=stub.serve_forever, name="stub-provider", daemon=True).start()
+
+    # config.py reads the environment on import, so this goes before importing the bot
+    tenants = sorted({tenant for _, tenant, _ in events})
+    os.environ.update({
+        "DATABASE_URL": args.database_url,
+        "READ_DATABASE_URL": "",
+        "BOT_TOKENS": ",".join(f"{t}:replay" for t in tenants),
+        "ADMIN_IDS": ",".join(str(a) for a in admins),
+        "PROVIDER_API_BASE": f"http://127.0.0.1:{stub.server_address[1]}",
+        "PROVIDER_API_KEY": "replay",
+        "PUSH_LISTEN_PORT": "0",
+        "CAPTURE_FILE": "",
+    })
+    try:
+        rep = asyncio.run(replay(events, args))
+    finally:
+        stub.shutdown()
+
+    print_report(rep)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(rep, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Update scheduling for the Application (passed to ApplicationBuilder.concurrent_updates).
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+_in_flight_total = 0  # across all processors (one per hosted bot)
+_lane_in_flight: Counter = Counter()
+_lane_waiting: Counter = Counter()
+
+
+def ordering_key(update: object) -> Optional[int]:
+    """Updates with the same key are processed strictly in arrival order."""
+    if isinstance(update, Update) and update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class _Lane:
+    def __init__(self, weight: float, limit: int):
+        self.weight = weight
+        self.limit = limit
+        self.running = 0
+        self.pass_ = 0.0  # stride scheduling: advances by 1/weight per granted slot
+        self.waiters: Deque[asyncio.Future] = deque()
+
+
+class LaneSlots:
+    """
+    `total` slots shared by priority lanes ({name: (weight, limit)}). A lane
+    never holds more than its own `limit` slots; when a slot frees up and
+    several lanes are waiting, it goes to the one with the lowest pass, so
+    under contention lanes are served in proportion to their weights and a
+    low-weight lane is slowed down, never starved. Within a lane, FIFO.
+    """
+
+    def __init__(self, total: int, lanes: Dict[str, Tuple[float, int]]):
+        self.free = total
+        self.lanes = {name: _Lane(weight, limit) for name, (weight, limit) in lanes.items()}
+        self._vtime = 0.0  # pass of the last grant; a lane that was idle restarts from here
+
+    async def acquire(self, name: str) -> None:
+        lane = self.lanes[name]
+        if self.free > 0 and lane.running < lane.limit and not lane.waiters:
+            self._grant(lane)
+            return
+        if not lane.waiters:
+            lane.pass_ = max(lane.pass_, self._vtime)
+        fut = asyncio.get_running_loop().create_future()
+        lane.waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(name)  # granted just before the cancel: hand it on
+            else:
+                lane.waiters.remove(fut)
+            raise
+
+    def release(self, name: str) -> None:
+        self.lanes[name].running -= 1
+        self.free += 1
+        while self.free > 0:
+            ready = [lane for lane in self.lanes.values() if lane.waiters and lane.running < lane.limit]
+            if not ready:
+                return
+            lane = min(ready, key=lambda l: l.pass_)
+            self._grant(lane)
+            lane.waiters.popleft().set_result(None)
+
+    def _grant(self, lane: _Lane) -> None:
+        lane.running += 1
+        self.free -= 1
+        self._vtime = lane.pass_
+        lane.pass_ += 1 / lane.weight
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently, at most `max_concurrent`
+    at a time, while each user's updates run one after another in arrival
+    order (so multi-step conversation flows and purchases are never interleaved).
+
+    PTB's own semaphore (`max_pending`) only bounds how many updates may be
+    waiting here; the real concurrency limit is `max_concurrent`.
+
+    With `lanes` ({name: (weight, limit)}, see LaneSlots) and `lane_of`
+    (update -> lane name), the slots are shared by priority lanes, and queue
+    wait, in-flight and waiting updates are recorded per lane.
+
+    With a `label` (the bot's tenant id when several bots share the process)
+    update counts, handling time and in-flight updates are also recorded per bot.
+    """
+
+    def __init__(self, max_concurrent: int, max_pending: int = 10000, label: Optional[str] = None,
+                 lanes: Optional[Dict[str, Tuple[float, int]]] = None,
+                 lane_of: Optional[Callable[[object], str]] = None):
+        super().__init__(max_concurrent_updates=max_pending)
+        self.max_concurrent = max_concurrent
+        self.label = label
+        self.lane_of = lane_of if lanes and lane_of else (lambda update: "all")
+        self._slots = LaneSlots(max_concurrent, lanes if lanes and lane_of else {"all": (1.0, max_concurrent)})
+        self._user_locks: Dict[int, List[Any]] = {}  # key -> [lock, waiters]
+        self._in_flight = 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        arrived = time.monotonic()
+        lane = self.lane_of(update)
+        key = ordering_key(update)
+        if key is None:
+            await self._run(arrived, lane, coroutine)
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(arrived, lane, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def _run(self, arrived: float, lane: str, coroutine: Awaitable[Any]) -> None:
+        global _in_flight_total
+        _lane_waiting[lane] += 1
+        try:
+            await self._slots.acquire(lane)
+        finally:
+            _lane_waiting[lane] -= 1
+        started = time.monotonic()
+        metrics.observe("update_queue_wait", started - arrived)
+        metrics.observe(f"update_queue_wait.{lane}", started - arrived)
+        self._in_flight += 1
+        _in_flight_total += 1
+        _lane_in_flight[lane] += 1
+        self._gauge(lane)
+        try:
+            await coroutine
+        finally:
+            self._in_flight -= 1
+            _in_flight_total -= 1
+            _lane_in_flight[lane] -= 1
+            self._slots.release(lane)
+            self._gauge(lane)
+            if self.label:
+                metrics.incr(f"updates.{self.label}")
+                metrics.observe(f"update_handling.{self.label}", time.monotonic() - started)
+
+    def _gauge(self, lane: str) -> None:
+        metrics.set_gauge("updates_in_flight", _in_flight_total)
+        metrics.set_gauge(f"lane_in_flight.{lane}", _lane_in_flight[lane])
+        metrics.set_gauge(f"lane_waiting.{lane}", _lane_waiting[lane])
+        if self.label:
+            metrics.set_gauge(f"updates_in_flight.{self.label}", self._in_flight)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass